@@ -0,0 +1,150 @@
+"""Per-request account snapshot shared by the pages and the entitlement check"""
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from flask import g, has_request_context
+
+from db import get_cursor
+from entitlements import build_entitlement, entitlement_cache
+
+# End of the user's live paid subscriptions, for build_entitlement(); every
+# entitlement query selects it so the sync and async paths cannot drift
+PAID_UNTIL_SQL = """(SELECT MAX(a.end_date) FROM subscriptions a
+            WHERE a.user_id = u.id AND a.status = 'active' AND a.end_date > NOW())"""
+
+ACCOUNT_STATE_SQL = f"""
+    SELECT u.id, u.name, u.email, u.trial_end_date,
+           latest.status AS subscription_status,
+           latest.start_date AS subscription_start_date,
+           latest.end_date AS subscription_end_date,
+           latest.plan_name,
+           latest.price AS plan_price,
+           {PAID_UNTIL_SQL} AS paid_until
+    FROM users u
+    LEFT JOIN LATERAL (
+        SELECT s.status, s.start_date, s.end_date, sp.name AS plan_name, sp.price
+        FROM subscriptions s
+        JOIN subscription_plans sp ON s.plan_id = sp.id
+        WHERE s.user_id = u.id
+        ORDER BY s.created_at DESC
+        LIMIT 1
+    ) latest ON TRUE
+    WHERE u.id = %s
+"""
+
+# Just the entitlement, for the asyncpg path (asgi.py)
+ENTITLEMENT_SQL = f"""
+    SELECT u.trial_end_date, {PAID_UNTIL_SQL} AS paid_until
+    FROM users u
+    WHERE u.id = $1
+"""
+
+
+def get_trial_status(trial_end_date):
+    """Consistently calculate trial status across the app"""
+    if not trial_end_date:
+        return {'status': 'no_trial', 'message': 'No trial period', 'days_left': 0}
+
+    now = datetime.now()
+
+    # Handle timezone comparison
+    if hasattr(trial_end_date, 'tzinfo') and trial_end_date.tzinfo is not None:
+        now = now.replace(tzinfo=timezone.utc)
+
+    if now < trial_end_date:
+        days_left = (trial_end_date - now).days
+        return {
+            'status': 'active',
+            'message': f'Trial active ({days_left} days left)',
+            'days_left': days_left
+        }
+    else:
+        return {
+            'status': 'expired',
+            'message': 'Trial expired',
+            'days_left': 0
+        }
+
+
+def load_account_state(user_id):
+    """User, latest subscription with its plan, and entitlement in one round trip
+
+    Returns None when the user no longer exists. The computed entitlement
+    also refreshes the entitlement cache.
+    """
+    with get_cursor() as cursor:
+        cursor.execute(ACCOUNT_STATE_SQL, (user_id,))
+        row = cursor.fetchone()
+
+    if not row:
+        return None
+
+    subscription = None
+    if row['subscription_status'] is not None:
+        subscription = {
+            'status': row['subscription_status'],
+            'start_date': row['subscription_start_date'],
+            'end_date': row['subscription_end_date'],
+            'plan_name': row['plan_name'],
+            'price': row['plan_price'],
+        }
+
+    entitlement = build_entitlement(row['trial_end_date'], row['paid_until'])
+    entitlement_cache.set(user_id, entitlement)
+
+    return {
+        'user': {
+            'id': row['id'],
+            'name': row['name'],
+            'email': row['email'],
+            'trial_end_date': row['trial_end_date'],
+        },
+        'subscription': subscription,
+        'entitlement': entitlement,
+        'trial_status': get_trial_status(row['trial_end_date']),
+    }
+
+
+async def load_entitlement_async(db, user_id):
+    """The user's entitlement read through asyncpg; db is a pool or connection"""
+    row = await db.fetchrow(ENTITLEMENT_SQL, user_id)
+    if not row:
+        return build_entitlement(None, None)
+    return build_entitlement(row['trial_end_date'], row['paid_until'])
+
+
+def get_account_state(user_id):
+    """load_account_state() memoized for the current request"""
+    if not has_request_context():
+        return load_account_state(user_id)
+
+    states = g.setdefault('account_states', {})
+    if user_id not in states:
+        states[user_id] = load_account_state(user_id)
+    return states[user_id]
+
+
+def forget_account_state(user_id):
+    """Drop the request snapshot after a write that changes it"""
+    if has_request_context():
+        g.setdefault('account_states', {}).pop(user_id, None)
+
+
+_plans = None
+_plans_loaded_at = 0.0
+_plans_lock = threading.Lock()
+PLANS_TTL = float(os.getenv('PLANS_CACHE_TTL', 300))
+
+
+def active_plans():
+    """Active subscription plans; they change rarely, so cached in-process"""
+    global _plans, _plans_loaded_at
+    with _plans_lock:
+        if _plans is None or time.monotonic() - _plans_loaded_at > PLANS_TTL:
+            with get_cursor() as cursor:
+                cursor.execute("SELECT * FROM subscription_plans WHERE is_active = TRUE")
+                _plans = cursor.fetchall()
+            _plans_loaded_at = time.monotonic()
+        return _plans
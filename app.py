@@ -1,216 +1,103 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash
+from flask import Flask, Response, render_template, request, jsonify, session, redirect, url_for, flash, stream_with_context
 from dotenv import load_dotenv
 import os
+import openai
 from openai import OpenAI
-import bcrypt
 import json
-import re
 from datetime import datetime, timedelta
 import hashlib
 import hmac
-import requests
+import math
+import secrets
 import json
-import traceback  
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-# Load environment variables
+# Load environment variables before the modules below read their settings
 load_dotenv()
 
+from account import active_plans, forget_account_state, get_account_state, get_trial_status
+from auth import HashingBusy, authenticate, hash_password, hasher_stats
+from billing import activate_subscription
+from db import get_cursor, pool_stats
+from entitlements import build_entitlement, entitlement_cache
+from intasend import SETTINGS as INTASEND_SETTINGS, client_stats as intasend_stats, get_client as get_intasend
+from logs import get_logger, logging_stats
+from metrics import instrument_flask, metrics_response
+from model_router import ModelsUnavailable, RouterTimeout, model_router
+from recipe_cache import cache_key, recommendation_cache
+from recipe_index import recipe_index
+from recipe_parser import RecipeParseError, RecipeStreamParser, parse_recipes, recipe_response_format
+from recipe_store import InvalidCursor, insert_recipes, recipe_history, search_recipes
+from recommendation_jobs import JobFailed, JobQueueFull, get_job_runner, job_stats
+from singleflight import LeaderFailed, recommendation_flight
+from spend_limiter import SpendLimited, approx_tokens, spend_limiter
+from webhook_queue import PermanentWebhookError, enqueue as enqueue_webhook, webhook_event_id
+
+
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', os.getenv('SECRET_KEY', 'fallback-secret-key'))
+instrument_flask(app)
+
+# Behind a load balancer, remote_addr (which login throttling keys on) is the
+# proxy's; trust that many X-Forwarded-For hops to recover the client address
+if os.getenv('TRUSTED_PROXY_HOPS'):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.getenv('TRUSTED_PROXY_HOPS')))
 
 # OpenRouter client configuration
+OPENROUTER_BASE_URL = os.getenv('OPENROUTER_BASE_URL', "https://openrouter.ai/api/v1")
+
 client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
+    base_url=OPENROUTER_BASE_URL,
     api_key=os.getenv('OPENROUTER_API_KEY')
 )
 
-# Database configuration - Updated to use PyMySQL
-def get_db_connection():
-    return psycopg2.connect(
-        host=os.getenv('PGHOST'),
-        user=os.getenv('PGUSER'), 
-        password=os.getenv('PGPASSWORD'),
-        database=os.getenv('PGDATABASE'),
-        port=os.getenv('PGPORT', 5432),
-        cursor_factory=RealDictCursor
-    )
-def setup_database():
-    conn = psycopg2.connect(
-        host=os.getenv('PGHOST'),
-        user=os.getenv('PGUSER'),
-        password=os.getenv('PGPASSWORD'),
-        database=os.getenv('PGDATABASE'),
-        port=os.getenv('PGPORT', 5432)
-    )
-    cursor = conn.cursor()
-    
-    # Create tables (adapt your MySQL schema)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            name VARCHAR(255) NOT NULL,
-            email VARCHAR(255) UNIQUE NOT NULL,
-            password VARCHAR(255) NOT NULL,
-            trial_end_date TIMESTAMP,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS subscription_plans (
-            id SERIAL PRIMARY KEY,
-            name VARCHAR(100) NOT NULL,
-            price DECIMAL(10,2) NOT NULL,
-            duration_days INTEGER NOT NULL,
-            is_active BOOLEAN DEFAULT TRUE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER REFERENCES users(id),
-            plan_id INTEGER REFERENCES subscription_plans(id),
-            status VARCHAR(50) NOT NULL,
-            start_date TIMESTAMP,
-            end_date TIMESTAMP,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS payments (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER REFERENCES users(id),
-            subscription_id INTEGER REFERENCES subscriptions(id),
-            plan_id INTEGER REFERENCES subscription_plans(id),
-            amount DECIMAL(10,2),
-            status VARCHAR(50),
-            payment_method VARCHAR(50),
-            transaction_id VARCHAR(255),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS recipes (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER REFERENCES users(id),
-            recipe_name VARCHAR(255) NOT NULL,
-            ingredients TEXT,
-            instructions TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    # Insert default subscription plans
-    cursor.execute("""
-        INSERT INTO subscription_plans (name, price, duration_days) 
-        VALUES 
-        ('Monthly', 999.00, 30),
-        ('Yearly', 9999.00, 365)
-        ON CONFLICT DO NOTHING
-    """)
-    
-    conn.commit()
-    cursor.close()
-    conn.close()
-    print("Database setup complete!")
+recommendation_log = get_logger('recommendations')
+payment_log = get_logger('payments')
+webhook_log = get_logger('webhooks')
+
+# Longest a job poll may block; keep it well under the worker timeout
+JOB_MAX_WAIT = float(os.getenv('JOB_MAX_WAIT', 20))
 
+# A batch is a week or two of pantries; its lists are looked up and generated in parallel
+# A batch reserves one LLM request per uncached list up front, so keep this
+# at or below LLM_USER_REQUEST_BURST or full uncached batches can never run
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 10))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 7))
+
+# Lowest trigram word similarity for a recipe name to match a search
+SEARCH_NAME_SIMILARITY = float(os.getenv('SEARCH_NAME_SIMILARITY', 0.5))
+
+# Database connections come from the per-worker pool in db.py (get_db/get_cursor);
+# the schema is managed by migrate.py
+
+def load_entitlement(user_id):
+    """Read trial and paid subscription state for a user from the account snapshot"""
+    state = get_account_state(user_id)
+    if not state:
+        return build_entitlement(None, None)
+    return state['entitlement']
 
 def has_active_subscription(user_id):
     """Check if user has an active subscription or is in trial period"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Check if user is in trial period
-    cursor.execute("SELECT trial_end_date FROM users WHERE id = %s", (user_id,))
-    user = cursor.fetchone()
-    
-    if user and user['trial_end_date']:
-        trial_end = user['trial_end_date']
-        now = datetime.now()
-        
-        # Handle timezone comparison
-        if hasattr(trial_end, 'tzinfo') and trial_end.tzinfo is not None:
-            from datetime import timezone
-            now = now.replace(tzinfo=timezone.utc)
-        
-        if now < trial_end:
-            cursor.close()
-            conn.close()
-            return True
-    
-    # Check for active paid subscription
-    cursor.execute("""
-        SELECT status, end_date FROM subscriptions 
-        WHERE user_id = %s AND status = 'active' AND end_date > NOW()
-    """, (user_id,))
-    
-    subscription = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    
-    return subscription is not None
-
-def get_trial_status(trial_end_date):
-    """Consistently calculate trial status across the app"""
-    if not trial_end_date:
-        return {'status': 'no_trial', 'message': 'No trial period', 'days_left': 0}
-    
-    now = datetime.now()
-    
-    # Handle timezone comparison
-    if hasattr(trial_end_date, 'tzinfo') and trial_end_date.tzinfo is not None:
-        from datetime import timezone
-        now = now.replace(tzinfo=timezone.utc)
-    
-    if now < trial_end_date:
-        days_left = (trial_end_date - now).days
-        return {
-            'status': 'active', 
-            'message': f'Trial active ({days_left} days left)',
-            'days_left': days_left
-        }
-    else:
-        return {
-            'status': 'expired', 
-            'message': 'Trial expired',
-            'days_left': 0
-        }
+    entitlement = entitlement_cache.get(user_id)
+    if entitlement is None:
+        entitlement = load_entitlement(user_id)
+        entitlement_cache.set(user_id, entitlement)
     
+    return entitlement['active']
 
 @app.route('/')
 def index():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Get user trial info
-    cursor.execute("SELECT trial_end_date FROM users WHERE id = %s", (session['user_id'],))
-    user_data = cursor.fetchone()
-    trial_end_date = user_data['trial_end_date'] if user_data else None
-    
-    # Get latest subscription
-    cursor.execute("""
-        SELECT s.status, s.end_date, sp.name 
-        FROM subscriptions s 
-        JOIN subscription_plans sp ON s.plan_id = sp.id 
-        WHERE s.user_id = %s 
-        ORDER BY s.created_at DESC 
-        LIMIT 1
-    """, (session['user_id'],))
-    
-    subscription = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    # User, latest subscription and trial state in one round trip
+    state = get_account_state(session['user_id'])
+    trial_end_date = state['user']['trial_end_date'] if state else None
+    subscription = state['subscription'] if state else None
     
     # Determine subscription status
     subscription_status = 'trial'  # Default to trial
@@ -218,12 +105,12 @@ def index():
     
     if subscription and subscription['status'] == 'active' and subscription['end_date'] > datetime.now():
         subscription_status = 'active'
-        plan_name = subscription['name']
+        plan_name = subscription['plan_name']
     elif trial_end_date and datetime.now() > trial_end_date:
         subscription_status = 'expired'
     
     # Calculate trial status
-    trial_status = get_trial_status(trial_end_date)
+    trial_status = state['trial_status'] if state else get_trial_status(trial_end_date)
     
     return render_template('index.html', 
                          user_name=session.get('user_name'),
@@ -240,17 +127,20 @@ def login():
         email = request.form['email']
         password = request.form['password']
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, password FROM users WHERE email = %s", (email,))
-        user = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        
-        if user and bcrypt.checkpw(password.encode('utf-8'), user['password'].encode('utf-8')):
-            session['user_id'] = user['id']
-            session['user_name'] = user['name']
+        # Password checks run on the bounded hashing pool in auth.py
+        try:
+            result = authenticate(email, password, request.remote_addr)
+        except HashingBusy:
+            flash('We are handling a lot of sign-ins right now. Please try again in a moment.')
+            return render_template('login.html'), 503
+        
+        if result['status'] == 'ok':
+            session['user_id'] = result['user']['id']
+            session['user_name'] = result['user']['name']
             return redirect(url_for('index'))
+        elif result['status'] == 'throttled':
+            flash('Too many failed sign-in attempts. Please try again in a few minutes.')
+            return render_template('login.html'), 429
         else:
             flash('Invalid email or password')
     
@@ -263,38 +153,37 @@ def register():
         email = request.form['email']
         password = request.form['password']
         
-        # Hash password
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        # Hash password at BCRYPT_ROUNDS on the bounded hashing pool
+        try:
+            hashed_password = hash_password(password)
+        except HashingBusy:
+            flash('We are handling a lot of sign-ups right now. Please try again in a moment.')
+            return render_template('register.html'), 503
         
         # Set trial end date (14 days from now)
         trial_end_date = datetime.now() + timedelta(days=14)
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
         try:
-            cursor.execute("INSERT INTO users (name, email, password, trial_end_date) VALUES (%s, %s, %s, %s)",
-                         (name, email, hashed_password, trial_end_date))
-            user_id = cursor.lastrowid
-            
-            # Create a trial subscription
-            cursor.execute("SELECT id FROM subscription_plans WHERE name = 'Monthly'")
-            plan = cursor.fetchone()
-            plan_id = plan['id'] if plan else None
-            
-            if plan_id:
-                cursor.execute("""
-                    INSERT INTO subscriptions (user_id, plan_id, status, start_date, end_date)
-                    VALUES (%s, %s, 'trial', NOW(), %s)
-                """, (user_id, plan_id, trial_end_date))
+            with get_cursor() as cursor:
+                cursor.execute("INSERT INTO users (name, email, password, trial_end_date) VALUES (%s, %s, %s, %s) RETURNING id",
+                             (name, email, hashed_password, trial_end_date))
+                user_id = cursor.fetchone()['id']
+                
+                # Create a trial subscription
+                cursor.execute("SELECT id FROM subscription_plans WHERE name = 'Monthly'")
+                plan = cursor.fetchone()
+                plan_id = plan['id'] if plan else None
+                
+                if plan_id:
+                    cursor.execute("""
+                        INSERT INTO subscriptions (user_id, plan_id, status, start_date, end_date)
+                        VALUES (%s, %s, 'trial', NOW(), %s)
+                    """, (user_id, plan_id, trial_end_date))
             
-            conn.commit()
             flash('Registration successful! Enjoy your 14-day free trial. Please log in.')
             return redirect(url_for('login'))
         except psycopg2.IntegrityError:
             flash('Email already exists')
-        finally:
-            cursor.close()
-            conn.close()
     
     return render_template('register.html')
 
@@ -303,6 +192,168 @@ def logout():
     session.clear()
     return redirect(url_for('login'))
 
+def recommendation_model():
+    # Primary model; the cache is keyed on it even when a fallback answered
+    return model_router.models[0]
+
+def recipe_messages(ingredients):
+    return [
+        {"role": "system", "content": "You are a helpful cooking assistant. Provide exactly 3 simple recipes in JSON format."},
+        {"role": "user", "content": f"Suggest 3 simple recipes with these ingredients: {ingredients}. Return only JSON: an object whose 'recipes' array holds objects with 'name', 'ingredients' (a list of strings) and 'instructions' fields."}
+    ]
+
+def structured_output():
+    """response_format arguments for the completion call (OPENROUTER_RESPONSE_FORMAT)
+
+    'json_schema' (default) asks models that support structured outputs for
+    exactly RECIPE_SCHEMA; 'json_object' only for valid JSON; 'none' sends
+    nothing. parse_recipes() accepts any of the resulting shapes.
+    """
+    response_format = recipe_response_format(os.getenv('OPENROUTER_RESPONSE_FORMAT', 'json_schema'))
+    return {'response_format': response_format} if response_format else {}
+
+def openrouter_headers():
+    # Optional: Add extra headers for OpenRouter
+    return {
+        "HTTP-Referer": os.getenv('OPENROUTER_REFERER', 'http://localhost:5000'),
+        "X-Title": "Recipe Recommendation App"
+    }
+
+def completion_options():
+    """Arguments for every recipe completion, whichever model the router picks"""
+    return dict(max_tokens=800, temperature=0.7, extra_headers=openrouter_headers(), **structured_output())
+
+def fetch_ai_recipes(ingredients, model, on_usage=None):
+    """Ask OpenRouter for recipes and parse them out of the response
+
+    `model` names the cache entry; model_router decides which model answers.
+    """
+    text = model_router.complete(client, recipe_messages(ingredients), mode='complete', on_usage=on_usage,
+                                 **completion_options())
+    return parse_ai_response(text)
+
+def parse_ai_response(ai_response):
+    """Up to 3 validated recipes from a completion; raises RecipeParseError if none"""
+    try:
+        return parse_recipes(ai_response, limit=3)  # Limit to 3 recipes
+    except RecipeParseError:
+        recommendation_log.warning("Unparseable LLM response",
+                                   extra={'length': len(ai_response or ''), 'head': (ai_response or '')[:200]})
+        raise
+
+def generate_recipes(ingredients, model, on_usage=None):
+    """LLM recipes for an ingredient set, coalesced with identical in-flight requests
+
+    on_usage only hears about the call if this request is the one making it.
+    """
+    def call():
+        recipes_data = fetch_ai_recipes(ingredients, model, on_usage)
+        recommendation_cache.set(ingredients, model, recipes_data)
+        return recipes_data
+    
+    return recommendation_flight.do(cache_key(ingredients, model), call, describe_error=recommendation_error)
+
+def stream_ai_recipes(ingredients, model, user_id):
+    """Yield recipes from a streamed OpenRouter completion as each one completes
+
+    Reserves the user's LLM spend when iteration starts (raising
+    SpendLimited before any outbound call) and settles it when done.
+    """
+    messages = recipe_messages(ingredients)
+    parser = RecipeStreamParser()
+    text = []
+    with spend_limiter.reserve(user_id) as spend:
+        deltas = model_router.stream(client, messages, mode='stream', on_usage=spend.record,
+                                     **completion_options())
+        try:
+            for delta in deltas:
+                text.append(delta)
+                for recipe in parser.feed(delta):
+                    if parser.count <= 3:  # Limit to 3 recipes
+                        yield recipe
+                if parser.count >= 3:
+                    return
+        finally:
+            # Stops the model's request once we have what we need
+            deltas.close()
+            # A stream closed early reports no usage
+            spend.fallback_tokens = approx_tokens(messages[-1]['content'], ''.join(text))
+    
+    if parser.count == 0:
+        # Fallback parsing once the whole response is in
+        yield from parse_ai_response(''.join(text))
+
+def recommendation_error(e):
+    """Map an OpenRouter/API exception to a user-facing message and status code"""
+    error_message = str(e)
+    
+    # Our own limits, routing outcomes and typed SDK errors first, then message matching
+    if isinstance(e, LeaderFailed):
+        # Already described by the worker whose request made the call
+        return e.message, e.status
+    elif isinstance(e, SpendLimited):
+        if e.scope == 'global':
+            return 'Recipe suggestions are very busy right now. Please try again shortly.', 429
+        return "You've requested a lot of new recipes recently. Please try again shortly.", 429
+    elif isinstance(e, ModelsUnavailable):
+        return 'Recipe suggestions are temporarily unavailable. Please try again in a minute.', 503
+    elif isinstance(e, (RouterTimeout, openai.APITimeoutError)):
+        return 'Recipe suggestions are taking too long right now. Please try again.', 504
+    elif isinstance(e, openai.RateLimitError):
+        return 'Rate limit exceeded. Please try again in a few moments.', 429
+    elif isinstance(e, openai.AuthenticationError):
+        return 'Invalid API key. Please check your OpenRouter configuration.', 401
+    elif isinstance(e, openai.APIStatusError) and e.status_code == 402:
+        return 'OpenRouter API quota exceeded. Please check your billing details or try again later.', 429
+    elif isinstance(e, openai.NotFoundError):
+        return 'Selected model not available. Please check your model configuration.', 400
+    elif 'insufficient_quota' in error_message or 'credits' in error_message.lower():
+        return 'OpenRouter API quota exceeded. Please check your billing details or try again later.', 429
+    elif 'rate_limit' in error_message:
+        return 'Rate limit exceeded. Please try again in a few moments.', 429
+    elif 'invalid_api_key' in error_message or 'unauthorized' in error_message.lower():
+        return 'Invalid API key. Please check your OpenRouter configuration.', 401
+    elif 'model_not_found' in error_message.lower():
+        return 'Selected model not available. Please check your model configuration.', 400
+    elif isinstance(e, RecipeParseError):
+        return 'The recipe service returned an unreadable answer. Please try again.', 502
+    else:
+        return 'Failed to get recommendations. Please try again later.', 500
+
+def local_recipes(ingredients, model):
+    """Recipes from the cache or the local index, or None if the LLM is needed
+
+    Returns (recipes, from_index).
+    """
+    # Identical ingredient sets are served from cache without an LLM call
+    recipes_data = recommendation_cache.get(ingredients, model)
+    if recipes_data is not None:
+        return recipes_data, False
+    
+    # Then saved recipes that the pantry covers well enough
+    recipes_data = recipe_index.recommend(ingredients)
+    return recipes_data, recipes_data is not None
+
+def recommend(user_id, ingredients):
+    """Recipes for an ingredient list from cache, index or LLM, saved for the user"""
+    model = recommendation_model()
+    recipes_data, from_index = local_recipes(ingredients, model)
+    
+    if recipes_data is None:
+        # A fast 429 here, before any outbound call, when the user or the site is over budget
+        with spend_limiter.reserve(user_id) as spend:
+            recipes_data = generate_recipes(ingredients, model, spend.record)
+    
+    # Save recipes to database in one round trip
+    with get_cursor() as cursor:
+        saved_recipes = insert_recipes(cursor, user_id, recipes_data[:3])  # Limit to 3 recipes
+    
+    if not from_index:
+        for recipe in saved_recipes:
+            recipe_index.add(recipe['id'], recipe['name'], recipe['ingredients'], recipe['instructions'])
+    
+    return saved_recipes
+
 @app.route('/get_recommendations', methods=['POST'])
 def get_recommendations():
     if 'user_id' not in session:
@@ -319,171 +370,354 @@ def get_recommendations():
         return jsonify({'error': 'No ingredients provided'}), 400
     
     try:
-        # Call OpenRouter API using the OpenAI client interface
-        response = client.chat.completions.create(
-            model=os.getenv('OPENROUTER_MODEL', 'openai/gpt-3.5-turbo'),  # Default model, can be changed
-            messages=[
-                {"role": "system", "content": "You are a helpful cooking assistant. Provide exactly 3 simple recipes in JSON format."},
-                {"role": "user", "content": f"Suggest 3 simple recipes with these ingredients: {ingredients}. Return only a JSON array with objects containing 'name', 'ingredients', and 'instructions' fields."}
-            ],
-            max_tokens=800,
-            temperature=0.7,
-            # Optional: Add extra headers for OpenRouter
-            extra_headers={
-                "HTTP-Referer": os.getenv('OPENROUTER_REFERER', 'http://localhost:5000'),
-                "X-Title": "Recipe Recommendation App"
-            }
-        )
-        
-        # Parse OpenRouter response (same format as OpenAI)
-        ai_response = response.choices[0].message.content.strip()
+        return jsonify({'recipes': recommend(session['user_id'], ingredients)})
         
-        # Extract JSON from response
-        json_match = re.search(r'\[.*\]', ai_response, re.DOTALL)
-        if json_match:
-            recipes_data = json.loads(json_match.group())
+    except SpendLimited as e:
+        return spend_limited_response(e)
+    except Exception as e:
+        recommendation_log.exception("Recommendation failed", extra={'user_id': session['user_id']})
+        message, status = recommendation_error(e)
+        return jsonify({'error': message}), status
+
+def spend_limited_response(e):
+    message, status = recommendation_error(e)
+    return (jsonify({'error': message, 'retry_after': e.retry_after, 'limits': e.levels}), status,
+            {'Retry-After': str(e.retry_after)})
+
+def batch_recipes(recipes_data):
+    # Copies, since cached and coalesced results are shared with other requests
+    return [dict(recipe) for recipe in recipes_data[:3]]  # Limit to 3 recipes
+
+@app.route('/get_recommendations/batch', methods=['POST'])
+def get_recommendations_batch():
+    """Recipes for up to BATCH_MAX_ITEMS ingredient lists at once, keyed by input
+
+    Identical lists (same ingredients in any order or spelling the cache
+    treats as equal) are looked up once. Lists run concurrently, so the
+    batch takes about as long as its slowest list. One list failing does
+    not fail the others: its entry holds 'error' and 'status' instead of
+    'recipes'.
+
+    Lists the cache and index can't answer need the LLM. The batch reserves
+    one request per such list from the spend limiter in a single step
+    before any completion starts, so it either fits the user's request
+    budget or all of them fail fast with 429. A batch can therefore use at
+    most LLM_USER_REQUEST_BURST completions, which is why BATCH_MAX_ITEMS
+    defaults to no more than that.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    # One subscription check for the whole batch
+    if not has_active_subscription(session['user_id']):
+        return jsonify({'error': 'Subscription required. Your free trial has ended.'}), 402
+    
+    data = request.get_json(silent=True) or {}
+    ingredient_lists = data.get('ingredient_lists')
+    
+    if not isinstance(ingredient_lists, list) or not ingredient_lists:
+        return jsonify({'error': 'No ingredient lists provided'}), 400
+    if len(ingredient_lists) > BATCH_MAX_ITEMS:
+        return jsonify({'error': f'At most {BATCH_MAX_ITEMS} ingredient lists per batch'}), 400
+    
+    # Inputs may be "a, b" strings or ["a", "b"] lists; both are keyed as strings
+    inputs = []
+    for item in ingredient_lists:
+        if isinstance(item, list) and all(isinstance(i, str) for i in item):
+            item = ', '.join(i.strip() for i in item if i.strip())
+        if not isinstance(item, str) or not item.strip():
+            return jsonify({'error': 'Each ingredient list must be a non-empty string or list of strings'}), 400
+        inputs.append(item.strip())
+    
+    user_id = session['user_id']
+    model = recommendation_model()
+    
+    # Dedupe on the cache key: input -> key, key -> the first input seen for it
+    keys = {ingredients: cache_key(ingredients, model) for ingredients in inputs}
+    unique = {}
+    for ingredients, key in keys.items():
+        unique.setdefault(key, ingredients)
+    
+    outcomes = {}
+    with ThreadPoolExecutor(min(BATCH_CONCURRENCY, len(unique)), thread_name_prefix='batch') as pool:
+        def collect(futures, done):
+            for key, future in futures.items():
+                try:
+                    outcomes[key] = done(future.result())
+                except Exception as e:
+                    recommendation_log.exception("Batch recommendation failed",
+                                                 extra={'user_id': user_id, 'ingredients': unique[key]})
+                    outcomes[key] = e
+        
+        # Cache and index first; only what they miss goes to the LLM
+        collect({key: pool.submit(local_recipes, ingredients, model) for key, ingredients in unique.items()},
+                lambda found: (batch_recipes(found[0]), found[1]) if found[0] is not None else None)
+        misses = [key for key, outcome in outcomes.items() if outcome is None]
+        
+        if misses:
+            try:
+                # One reservation for every completion, before any starts
+                spend = spend_limiter.reserve(user_id, requests=len(misses))
+            except Exception as e:
+                if not isinstance(e, SpendLimited):
+                    recommendation_log.exception("Batch spend reservation failed", extra={'user_id': user_id})
+                outcomes.update((key, e) for key in misses)
+            else:
+                with spend:
+                    collect({key: pool.submit(generate_recipes, unique[key], model, spend.record) for key in misses},
+                            lambda recipes_data: (batch_recipes(recipes_data), False))
+    
+    generated = [outcome for outcome in outcomes.values() if not isinstance(outcome, Exception)]
+    try:
+        # Every list's recipes in one round trip; ids are set on the dicts in place
+        with get_cursor() as cursor:
+            insert_recipes(cursor, user_id, [recipe for recipes, _ in generated for recipe in recipes])
+    except Exception as e:
+        recommendation_log.exception("Saving batch recipes failed", extra={'user_id': user_id})
+        message, status = recommendation_error(e)
+        return jsonify({'error': message}), status
+    
+    for recipes, from_index in generated:
+        if not from_index:
+            for recipe in recipes:
+                recipe_index.add(recipe['id'], recipe['name'], recipe['ingredients'], recipe['instructions'])
+    
+    results = {}
+    for ingredients, key in keys.items():
+        outcome = outcomes[key]
+        if isinstance(outcome, Exception):
+            message, status = recommendation_error(outcome)
+            results[ingredients] = {'error': message, 'status': status}
+            if isinstance(outcome, SpendLimited):
+                results[ingredients]['retry_after'] = outcome.retry_after
         else:
-            # Fallback parsing
-            recipes_data = parse_text_recipes(ai_response)
-        
-        # Save recipes to database
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
+            results[ingredients] = {'recipes': outcome[0]}
+    
+    return jsonify({'results': results})
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+@app.route('/get_recommendations/stream', methods=['POST'])
+def stream_recommendations():
+    """Same as /get_recommendations, but sends each recipe as a Server-Sent Event once it is complete"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    # Check subscription status
+    if not has_active_subscription(session['user_id']):
+        return jsonify({'error': 'Subscription required. Your free trial has ended.'}), 402
+    
+    data = request.get_json()
+    ingredients = data.get('ingredients', '')
+    
+    if not ingredients:
+        return jsonify({'error': 'No ingredients provided'}), 400
+    
+    user_id = session['user_id']
+    model = recommendation_model()
+    
+    def generate():
         saved_recipes = []
-        for recipe in recipes_data[:3]:  # Limit to 3 recipes
-            # Convert ingredients and instructions to strings if they are lists
-            ingredients_str = recipe['ingredients']
-            if isinstance(ingredients_str, list):
-                ingredients_str = ', '.join(ingredients_str)
-                
-            instructions_str = recipe['instructions']
-            if isinstance(instructions_str, list):
-                instructions_str = ' '.join(instructions_str)
+        try:
+            recipes_data, from_index = local_recipes(ingredients, model)
+            from_llm = recipes_data is None
+            if from_llm:
+                recipes_data = stream_ai_recipes(ingredients, model, user_id)
             
-            cursor.execute(
-                "INSERT INTO recipes (recipe_name, ingredients, instructions, user_id) VALUES (%s, %s, %s, %s)",
-                (recipe['name'], ingredients_str, instructions_str, session['user_id'])
-            )
-            recipe_id = cursor.lastrowid
-            recipe['id'] = recipe_id
-            saved_recipes.append(recipe)
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
-        return jsonify({'recipes': saved_recipes})
-        
-    except Exception as e:
-        print(f"Error: {e}")
-        error_message = str(e)
-        
-        # Handle specific OpenRouter/API errors
-        if 'insufficient_quota' in error_message or 'credits' in error_message.lower():
-            return jsonify({'error': 'OpenRouter API quota exceeded. Please check your billing details or try again later.'}), 429
-        elif 'rate_limit' in error_message:
-            return jsonify({'error': 'Rate limit exceeded. Please try again in a few moments.'}), 429
-        elif 'invalid_api_key' in error_message or 'unauthorized' in error_message.lower():
-            return jsonify({'error': 'Invalid API key. Please check your OpenRouter configuration.'}), 401
-        elif 'model_not_found' in error_message.lower():
-            return jsonify({'error': 'Selected model not available. Please check your model configuration.'}), 400
-        else:
-            return jsonify({'error': 'Failed to get recommendations. Please try again later.'}), 500
+            # Persist each recipe as it arrives, then send it
+            for recipe in recipes_data:
+                with get_cursor() as cursor:
+                    insert_recipes(cursor, user_id, [recipe])
+                saved_recipes.append(recipe)
+                yield sse_event('recipe', recipe)
+            
+            if from_llm:
+                recommendation_cache.set(ingredients, model, saved_recipes)
+            if not from_index:
+                for recipe in saved_recipes:
+                    recipe_index.add(recipe['id'], recipe['name'], recipe['ingredients'], recipe['instructions'])
+            
+            yield sse_event('done', {'count': len(saved_recipes)})
+        except SpendLimited as e:
+            message, status = recommendation_error(e)
+            yield sse_event('error', {'error': message, 'status': status, 'retry_after': e.retry_after})
+        except Exception as e:
+            recommendation_log.exception("Streamed recommendation failed", extra={'user_id': user_id})
+            message, status = recommendation_error(e)
+            yield sse_event('error', {'error': message, 'status': status})
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-def parse_text_recipes(text):
-    """Fallback parser for non-JSON responses"""
-    recipes = []
-    lines = text.split('\n')
-    current_recipe = {}
+def recommendation_job(user_id, ingredients):
+    """The job run on the pool for POST /recommendation_jobs"""
+    def run():
+        try:
+            return {'recipes': recommend(user_id, ingredients)}
+        except Exception as e:
+            if not isinstance(e, SpendLimited):
+                recommendation_log.exception("Recommendation job failed", extra={'user_id': user_id})
+            raise JobFailed(*recommendation_error(e))
+    return run
+
+@app.route('/recommendation_jobs', methods=['POST'])
+def submit_recommendation_job():
+    """Queue a recommendation and return its job id at once (202); poll the Location for the result"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    # Check subscription status
+    if not has_active_subscription(session['user_id']):
+        return jsonify({'error': 'Subscription required. Your free trial has ended.'}), 402
     
-    for line in lines:
-        line = line.strip()
-        if line.startswith('1.') or line.startswith('2.') or line.startswith('3.'):
-            if current_recipe:
-                recipes.append(current_recipe)
-            current_recipe = {'name': line[2:].strip(), 'ingredients': '', 'instructions': ''}
-        elif 'ingredients' in line.lower() and current_recipe:
-            current_recipe['ingredients'] = line.split(':')[1].strip() if ':' in line else line
-        elif 'instructions' in line.lower() and current_recipe:
-            current_recipe['instructions'] = line.split(':')[1].strip() if ':' in line else line
+    data = request.get_json()
+    ingredients = data.get('ingredients', '')
     
-    if current_recipe:
-        recipes.append(current_recipe)
+    if not ingredients:
+        return jsonify({'error': 'No ingredients provided'}), 400
+    
+    user_id = session['user_id']
+    try:
+        job_id = get_job_runner().submit(user_id, ingredients, recommendation_job(user_id, ingredients))
+    except JobQueueFull:
+        return (jsonify({'error': 'Recipe suggestions are very busy right now. Please try again shortly.'}), 503,
+                {'Retry-After': '2'})
     
-    return recipes
+    location = url_for('recommendation_job_status', job_id=job_id)
+    return jsonify({'id': job_id, 'status': 'queued', 'poll': location}), 202, {'Location': location}
+
+@app.route('/recommendation_jobs/<job_id>')
+def recommendation_job_status(job_id):
+    """A job's status, and its recipes once done; ?wait=N long-polls up to JOB_MAX_WAIT seconds"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    try:
+        job_id = str(uuid.UUID(job_id))
+    except ValueError:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        wait = None
+    # NaN would slip through min/max and disable JOB_MAX_WAIT
+    if wait is None or not math.isfinite(wait):
+        return jsonify({'error': 'Invalid wait'}), 400
+    wait = min(max(wait, 0.0), JOB_MAX_WAIT)
+    
+    job = get_job_runner().get(job_id, session['user_id'], wait=wait)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/spend_limits')
+def spend_limits():
+    """How much of the user's and the site-wide LLM budget is left right now"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    if not spend_limiter.enabled:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, **spend_limiter.levels(session['user_id'])})
 
 @app.route('/get_user_recipes')
 def get_user_recipes():
+    """Saved recipes, newest first, one page at a time
+
+    Query parameters: limit (default 10, max 50), cursor (next_cursor from
+    the previous page), from/to (YYYY-MM-DD, inclusive) and name (substring).
+    """
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+        since = request.args.get('from')
+        until = request.args.get('to')
+        since = datetime.strptime(since, '%Y-%m-%d') if since else None
+        until = datetime.strptime(until, '%Y-%m-%d') + timedelta(days=1) if until else None
+    except ValueError:
+        return jsonify({'error': 'Invalid limit or date filter'}), 400
     
-    # SQL JOIN to get recipes with user information
-    cursor.execute("""
-        SELECT r.id, r.recipe_name, r.ingredients, r.instructions, r.created_at, u.name as user_name
-        FROM recipes r
-        JOIN users u ON r.user_id = u.id
-        WHERE r.user_id = %s
-        ORDER BY r.created_at DESC
-        LIMIT 10
-    """, (session['user_id'],))
+    try:
+        with get_cursor() as cursor:
+            rows, next_cursor = recipe_history(cursor, session['user_id'], limit,
+                                               after=request.args.get('cursor'),
+                                               since=since, until=until,
+                                               name=request.args.get('name'))
+    except InvalidCursor:
+        return jsonify({'error': 'Invalid cursor'}), 400
     
     recipes = []
-    for row in cursor.fetchall():
+    for row in rows:
         recipes.append({
             'id': row['id'],
             'name': row['recipe_name'],
             'ingredients': row['ingredients'],
             'instructions': row['instructions'],
             'created_at': row['created_at'].strftime('%Y-%m-%d %H:%M'),
-            'user_name': row['user_name']
+            'user_name': session.get('user_name')
         })
     
-    cursor.close()
-    conn.close()
+    return jsonify({'recipes': recipes, 'next_cursor': next_cursor})
+
+@app.route('/search_recipes')
+def search_user_recipes():
+    """Saved recipes matching a search, best match first, one page at a time
+
+    Query parameters: q (words, "quoted phrases", -excluded; misspelt recipe
+    names still match), limit (default 10, max 50) and cursor (next_cursor
+    from the previous page).
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'No search query provided'}), 400
+    if len(query) > 200:
+        return jsonify({'error': 'Search query is too long'}), 400
     
-    return jsonify({'recipes': recipes})
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    
+    try:
+        with get_cursor() as cursor:
+            rows, next_cursor = search_recipes(cursor, session['user_id'], query, limit,
+                                               after=request.args.get('cursor'),
+                                               name_similarity=SEARCH_NAME_SIMILARITY)
+    except InvalidCursor:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
+    recipes = []
+    for row in rows:
+        recipes.append({
+            'id': row['id'],
+            'name': row['recipe_name'],
+            'ingredients': row['ingredients'],
+            'instructions': row['instructions'],
+            'created_at': row['created_at'].strftime('%Y-%m-%d %H:%M'),
+            'score': round(row['score'], 4),
+            'user_name': session.get('user_name')
+        })
+    
+    return jsonify({'recipes': recipes, 'next_cursor': next_cursor})
 
 @app.route('/subscription')
 def subscription():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Get subscription plans
-    cursor.execute("SELECT * FROM subscription_plans WHERE is_active = TRUE")
-    plans = cursor.fetchall()
-    
-    # Get user's current subscription
-    cursor.execute("""
-        SELECT s.status, s.start_date, s.end_date, sp.name, sp.price, u.trial_end_date
-        FROM subscriptions s
-        JOIN subscription_plans sp ON s.plan_id = sp.id
-        JOIN users u ON s.user_id = u.id
-        WHERE s.user_id = %s
-        ORDER BY s.created_at DESC
-        LIMIT 1
-    """, (session['user_id'],))
-    
-    current_subscription = cursor.fetchone()
-    cursor.close()
-    conn.close()
+    # Plans are cached in-process; the account snapshot is one round trip
+    plans = active_plans()
+    state = get_account_state(session['user_id'])
     
     subscription_data = None
-    if current_subscription:
-        subscription_data = {
-            'status': current_subscription['status'],
-            'start_date': current_subscription['start_date'],
-            'end_date': current_subscription['end_date'],
-            'plan_name': current_subscription['name'],
-            'price': current_subscription['price'],
-            'trial_end_date': current_subscription['trial_end_date']
-        }
+    if state and state['subscription']:
+        subscription_data = dict(state['subscription'], trial_end_date=state['user']['trial_end_date'])
     
     return render_template('subscription.html', 
                      plans=plans, 
@@ -491,6 +725,42 @@ def subscription():
                      user_name=session.get('user_name'),
                      now=datetime.now())
 
+def intasend_settings():
+    """(is_test, base_url, public_key, secret_key), resolved once at startup"""
+    return INTASEND_SETTINGS
+
+def new_api_ref(user_id, plan_id):
+    """Unique checkout reference: sub_{user_id}_{plan_id}_{timestamp}{suffix}
+
+    The random suffix keeps two checkouts started in the same second apart;
+    api_ref is the payment's transaction_id, which is unique.
+    """
+    return f"sub_{user_id}_{plan_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}{secrets.token_hex(3)}"
+
+def checkout_request(public_key, user_id, plan_id, plan_name, price, user_name, user_email, api_ref, redirect_url):
+    """Body of an IntaSend checkout request for a subscription plan"""
+    return {
+        "public_key": public_key,
+        "amount": float(price),
+        "currency": "KES",
+        "email": user_email,
+        "first_name": user_name.split()[0] if user_name else "Customer",
+        "last_name": user_name.split()[-1] if len(user_name.split()) > 1 else "User",
+        "country": "KE",
+        "address": "",
+        "city": "",
+        "state": "",
+        "zipcode": "",
+        "redirect_url": redirect_url,
+        "api_ref": api_ref,
+        # This is the key fix - include user and plan data in extra field
+        "extra": {
+            "user_id": user_id,
+            "plan_id": plan_id,
+            "plan_name": plan_name
+        }
+    }
+
 @app.route('/create_subscription', methods=['POST'])
 def create_subscription():
     """Create a subscription payment with IntaSend"""
@@ -504,103 +774,41 @@ def create_subscription():
         return jsonify({'error': 'Plan ID required'}), 400
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Get plan details
-        cursor.execute("SELECT name, price, duration_days FROM subscription_plans WHERE id = %s", (plan_id,))
-        plan = cursor.fetchone()
-        
-        if not plan:
-            cursor.close()
-            conn.close()
-            return jsonify({'error': 'Plan not found'}), 404
-        
-        plan_name, price, duration = plan['name'], plan['price'], plan['duration_days']
-        
-        # Get user details
-        cursor.execute("SELECT name, email FROM users WHERE id = %s", (session['user_id'],))
-        user = cursor.fetchone()
-        
-        if not user:
-            cursor.close()
-            conn.close()
-            return jsonify({'error': 'User not found'}), 404
+        with get_cursor() as cursor:
+            # Get plan details
+            cursor.execute("SELECT name, price, duration_days FROM subscription_plans WHERE id = %s", (plan_id,))
+            plan = cursor.fetchone()
+            
+            if not plan:
+                return jsonify({'error': 'Plan not found'}), 404
+            
+            plan_name, price, duration = plan['name'], plan['price'], plan['duration_days']
+            
+            # Get user details
+            cursor.execute("SELECT name, email FROM users WHERE id = %s", (session['user_id'],))
+            user = cursor.fetchone()
             
-        user_name, user_email = user['name'], user['email']
-        cursor.close()
-        conn.close()
+            if not user:
+                return jsonify({'error': 'User not found'}), 404
+                
+            user_name, user_email = user['name'], user['email']
         
         # Generate unique API reference
-        api_ref = f"sub_{session['user_id']}_{plan_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        
-        # Determine if we're in test or live mode
-        is_test = os.getenv('INTASEND_TEST_MODE', 'true').lower() == 'true'
+        api_ref = new_api_ref(session['user_id'], plan_id)
         
-        # Set the correct base URL and keys
-        if is_test:
-            base_url = "https://sandbox.intasend.com"
-            public_key = os.getenv('INTASEND_PUBLIC_KEY_TEST', os.getenv('INTASEND_PUBLIC_KEY'))
-            secret_key = os.getenv('INTASEND_SECRET_KEY_TEST', os.getenv('INTASEND_SECRET_KEY'))
-        else:
-            base_url = "https://payment.intasend.com"
-            public_key = os.getenv('INTASEND_PUBLIC_KEY_LIVE', os.getenv('INTASEND_PUBLIC_KEY'))
-            secret_key = os.getenv('INTASEND_SECRET_KEY_LIVE', os.getenv('INTASEND_SECRET_KEY'))
+        intasend = get_intasend()
         
         # Create IntaSend checkout request with extra data for webhook
-        intasend_data = {
-            "public_key": public_key,
-            "amount": float(price),
-            "currency": "KES",
-            "email": user_email,
-            "first_name": user_name.split()[0] if user_name else "Customer",
-            "last_name": user_name.split()[-1] if len(user_name.split()) > 1 else "User",
-            "country": "KE",
-            "address": "",
-            "city": "",
-            "state": "",
-            "zipcode": "",
-            "redirect_url": url_for('payment_callback', _external=True),
-            "api_ref": api_ref,
-            # This is the key fix - include user and plan data in extra field
-            "extra": {
-                "user_id": session['user_id'],
-                "plan_id": plan_id,
-                "plan_name": plan_name
-            }
-        }
+        intasend_data = checkout_request(intasend.public_key, session['user_id'], plan_id, plan_name, price,
+                                         user_name, user_email, api_ref,
+                                         url_for('payment_callback', _external=True))
         
-        # Set up headers for API authentication
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-        }
-        
-        # Use basic authentication with public key as username and secret key as password
-        from requests.auth import HTTPBasicAuth
-        auth = HTTPBasicAuth(public_key, secret_key)
-        
-        # Use the correct IntaSend checkout endpoint
-        intasend_url = f"{base_url}/api/v1/checkout/"
-        
-        print(f"=== IntaSend Checkout Request Debug ===")
-        print(f"URL: {intasend_url}")
-        print(f"Test mode: {is_test}")
-        print(f"User ID: {session['user_id']}, Plan ID: {plan_id}")
-        print(f"Request data: {intasend_data}")
+        # Make request to IntaSend over the worker's keep-alive session
+        response = intasend.create_checkout(intasend_data)
         
-        # Make request to IntaSend
-        response = requests.post(
-            intasend_url, 
-            json=intasend_data, 
-            headers=headers, 
-            auth=auth,
-            timeout=30
-        )
-        
-        print(f"=== IntaSend Response Debug ===")
-        print(f"Status code: {response.status_code}")
-        print(f"Response text: {response.text}")
+        if response.status_code not in [200, 201]:
+            payment_log.warning("IntaSend checkout failed",
+                                extra={'status_code': response.status_code, 'body': response.text[:500], 'api_ref': api_ref})
         
         if not response.content:
             return jsonify({'error': 'Empty response from payment provider'}), 500
@@ -608,7 +816,7 @@ def create_subscription():
         try:
             payment_data = response.json()
         except json.JSONDecodeError as e:
-            print(f"JSON decode error: {e}")
+            payment_log.warning("Invalid JSON from IntaSend checkout", extra={'error': str(e), 'api_ref': api_ref})
             return jsonify({'error': 'Invalid JSON response from payment provider'}), 500
         
         if response.status_code in [200, 201]:
@@ -616,33 +824,28 @@ def create_subscription():
             
             if checkout_url:
                 # Store pending payment in database for tracking
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT INTO payments (user_id, plan_id, subscription_id, amount, status, payment_method, transaction_id, created_at)
-                    VALUES (%s, %s, NULL, %s, 'pending', 'intasend', %s, NOW())
-                """, (session['user_id'], plan_id, float(price), api_ref))
-                conn.commit()
-                cursor.close()
-                conn.close()
+                invoice_id = payment_data.get('id') or payment_data.get('invoice_id')
+                with get_cursor() as cursor:
+                    cursor.execute("""
+                        INSERT INTO payments (user_id, plan_id, subscription_id, amount, status, payment_method, transaction_id, checkout_id, created_at)
+                        VALUES (%s, %s, NULL, %s, 'pending', 'intasend', %s, %s, NOW())
+                    """, (session['user_id'], plan_id, float(price), api_ref, invoice_id))
                 
                 return jsonify({
                     'success': True,
                     'payment_url': checkout_url,
-                    'invoice_id': payment_data.get('id') or payment_data.get('invoice_id'),
+                    'invoice_id': invoice_id,
                     'api_ref': api_ref
                 })
             else:
                 return jsonify({'error': 'No payment URL received from provider'}), 500
         else:
             error_message = payment_data.get('detail', payment_data.get('message', 'Payment request failed'))
-            print(f"IntaSend error: {error_message}")
+            payment_log.warning("IntaSend rejected checkout", extra={'error': error_message, 'api_ref': api_ref})
             return jsonify({'error': f'Payment service error: {error_message}'}), 500
             
-    except Exception as e:
-        print(f"Error creating subscription: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        payment_log.exception("Error creating subscription", extra={'user_id': session['user_id'], 'plan_id': plan_id})
         return jsonify({'error': 'Failed to create subscription. Please try again.'}), 500
 
 @app.route('/payment_callback')
@@ -656,10 +859,8 @@ def payment_callback():
     checkout_id = request.args.get('checkout_id')
     signature = request.args.get('signature')
     
-    print(f"=== Payment Callback Received ===")
-    print(f"Tracking ID: {tracking_id}")
-    print(f"Checkout ID: {checkout_id}")
-    print(f"All params: {dict(request.args)}")
+    payment_log.info("Payment callback received", extra={'user_id': session['user_id'], 'tracking_id': tracking_id,
+                                                         'checkout_id': checkout_id})
     
     if not checkout_id:
         flash('Payment verification failed - missing checkout ID.')
@@ -668,27 +869,22 @@ def payment_callback():
     # For now, let's process based on the presence of tracking_id
     # which indicates successful payment completion
     if tracking_id and checkout_id:
-        print("Payment appears successful - processing...")
-        
         # Find the pending payment by checkout_id or api_ref pattern
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
             # Look for pending payment with matching checkout_id or recent payment for this user
-            cursor.execute("""
-                SELECT user_id, plan_id, transaction_id 
-                FROM payments 
-                WHERE user_id = %s AND status = 'pending'
-                ORDER BY created_at DESC 
-                LIMIT 1
-            """, (session['user_id'],))
-            
-            payment_record = cursor.fetchone()
+            with get_cursor() as cursor:
+                cursor.execute("""
+                    SELECT user_id, plan_id, transaction_id 
+                    FROM payments 
+                    WHERE user_id = %s AND status = 'pending'
+                    ORDER BY created_at DESC 
+                    LIMIT 1
+                """, (session['user_id'],))
+                
+                payment_record = cursor.fetchone()
             
             if payment_record:
                 user_id, plan_id, api_ref = payment_record['user_id'], payment_record['plan_id'], payment_record['transaction_id']
-                print(f"Found pending payment: user_id={user_id}, plan_id={plan_id}")
                 
                 # Process the payment
                 success = process_successful_payment(
@@ -701,29 +897,15 @@ def payment_callback():
                 
                 if success:
                     flash('Payment successful! Your subscription is now active.')
-                    cursor.close()
-                    conn.close()
                     return redirect(url_for('subscription'))
                 else:
                     flash('Payment processed but there was an issue activating your subscription. Please contact support.')
             else:
-                # Try to extract from checkout_id pattern if it contains our api_ref
-                # Or process any recent subscription attempt for this user
-                cursor.execute("""
-                    SELECT plan_id FROM subscription_plans 
-                    WHERE is_active = TRUE
-                    ORDER BY price DESC 
-                    LIMIT 1
-                """)
-                
                 # This is a fallback - ideally we should have the pending payment record
                 flash('Payment received but could not verify subscription details. Please contact support with your tracking ID: ' + tracking_id)
             
-            cursor.close()
-            conn.close()
-            
-        except Exception as e:
-            print(f"Error processing callback: {e}")
+        except Exception:
+            payment_log.exception("Error processing payment callback", extra={'checkout_id': checkout_id})
             flash('Payment verification failed. Please contact support if you were charged.')
     else:
         flash('Payment was not completed successfully.')
@@ -733,80 +915,24 @@ def payment_callback():
 def process_successful_payment(user_id, plan_id, amount, transaction_id, api_ref):
     """Process a successful payment and activate subscription"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        result = activate_subscription(user_id, plan_id, amount, api_ref or transaction_id, checkout_id=transaction_id)
         
-        # Check if already processed
-        cursor.execute("""
-            SELECT id FROM payments 
-            WHERE transaction_id IN (%s, %s) AND status = 'completed'
-        """, (transaction_id, api_ref))
-        existing = cursor.fetchone()
-        
-        if existing:
-            print(f"Payment {transaction_id} already processed")
-            cursor.close()
-            conn.close()
+        if result['status'] == 'plan_not_found':
+            payment_log.error("Plan not found", extra={'plan_id': plan_id, 'api_ref': api_ref})
+            return False
+        if result['status'] == 'duplicate':
+            payment_log.info("Payment already processed", extra={'transaction_id': transaction_id, 'api_ref': api_ref})
             return True
-        
-        # Get plan details
-        cursor.execute("SELECT duration_days, name FROM subscription_plans WHERE id = %s", (plan_id,))
-        plan = cursor.fetchone()
-        
-        if not plan:
-            print(f"Plan {plan_id} not found")
-            cursor.close()
-            conn.close()
+        if result['status'] == 'unclaimed':
+            payment_log.error("Payment reference belongs to another user", extra={'user_id': user_id, 'api_ref': api_ref})
             return False
         
-        duration_days, plan_name = plan['duration_days'], plan['name']
-        
-        # Calculate dates
-        start_date = datetime.now()
-        end_date = start_date + timedelta(days=duration_days)
-        
-        # Deactivate existing subscriptions
-        cursor.execute("""
-            UPDATE subscriptions 
-            SET status = 'cancelled', updated_at = NOW()
-            WHERE user_id = %s AND status IN ('active', 'trial')
-        """, (user_id,))
-        
-        print(f"Cancelled {cursor.rowcount} existing subscriptions")
-        
-        # Create new subscription
-        cursor.execute("""
-            INSERT INTO subscriptions (user_id, plan_id, status, start_date, end_date, created_at, updated_at)
-            VALUES (%s, %s, 'active', %s, %s, NOW(), NOW())
-        """, (user_id, plan_id, start_date, end_date))
-        
-        subscription_id = cursor.lastrowid
-        
-        # Update or create payment record
-        cursor.execute("""
-            UPDATE payments 
-            SET subscription_id = %s, status = 'completed', updated_at = NOW()
-            WHERE user_id = %s AND transaction_id = %s AND status = 'pending'
-        """, (subscription_id, user_id, api_ref))
-        
-        if cursor.rowcount == 0:
-            # Create new payment record
-            cursor.execute("""
-                INSERT INTO payments (user_id, subscription_id, plan_id, amount, status, payment_method, transaction_id, created_at, updated_at)
-                VALUES (%s, %s, %s, %s, 'completed', 'intasend', %s, NOW(), NOW())
-            """, (user_id, subscription_id, plan_id, amount, transaction_id))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
-        print(f"Successfully processed payment for user {user_id}, subscription {subscription_id}")
+        payment_log.info("Subscription activated", extra={'user_id': user_id, 'plan_id': plan_id,
+                                                          'subscription_id': result['subscription_id'], 'api_ref': api_ref})
         return True
         
-    except Exception as e:
-        print(f"Error processing payment: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        payment_log.exception("Error processing payment", extra={'user_id': user_id, 'api_ref': api_ref})
         return False
 
 @app.route('/verify_payment', methods=['POST'])
@@ -822,22 +948,7 @@ def verify_payment():
         return jsonify({'error': 'Checkout ID required'}), 400
     
     try:
-        is_test = os.getenv('INTASEND_TEST_MODE', 'true').lower() == 'true'
-        
-        if is_test:
-            base_url = "https://sandbox.intasend.com"
-            public_key = os.getenv('INTASEND_PUBLIC_KEY_TEST', os.getenv('INTASEND_PUBLIC_KEY'))
-            secret_key = os.getenv('INTASEND_SECRET_KEY_TEST', os.getenv('INTASEND_SECRET_KEY'))
-        else:
-            base_url = "https://payment.intasend.com"
-            public_key = os.getenv('INTASEND_PUBLIC_KEY_LIVE', os.getenv('INTASEND_PUBLIC_KEY'))
-            secret_key = os.getenv('INTASEND_SECRET_KEY_LIVE', os.getenv('INTASEND_SECRET_KEY'))
-        
-        from requests.auth import HTTPBasicAuth
-        auth = HTTPBasicAuth(public_key, secret_key)
-        
-        status_url = f"{base_url}/api/v1/checkout/{checkout_id}/"
-        response = requests.get(status_url, auth=auth, timeout=10)
+        response = get_intasend().checkout_status(checkout_id)
         
         if response.status_code == 200:
             payment_data = response.json()
@@ -888,35 +999,98 @@ def verify_payment():
                 'message': 'Unable to verify payment with IntaSend.'
             })
             
-    except Exception as e:
-        print(f"Payment verification error: {e}")
+    except Exception:
+        payment_log.exception("Payment verification error", extra={'checkout_id': checkout_id})
         return jsonify({
             'success': False, 
             'message': 'Payment verification failed due to technical error.'
         }), 500
 
+def handle_intasend_event(data):
+    """Apply one queued IntaSend webhook event; False when no action is needed
+
+    Runs in webhook_queue workers. Errors are retried by the queue, except
+    PermanentWebhookError which dead-letters the event.
+    """
+    # Handle IntaSend payment completion
+    if not (data.get('state') == 'COMPLETE' or 
+            data.get('status') == 'COMPLETE' or 
+            data.get('status') == 'PAID'):
+        return False
+    
+    # Extract payment information
+    invoice_id = data.get('invoice_id') or data.get('id')
+    amount = data.get('value') or data.get('amount')
+    api_ref = data.get('api_ref')
+    
+    # Get user and plan info from extra field or api_ref
+    user_id = None
+    plan_id = None
+    
+    # Method 1: From extra field (if IntaSend preserves it)
+    extra_data = data.get('extra', {})
+    if isinstance(extra_data, dict):
+        user_id = extra_data.get('user_id')
+        plan_id = extra_data.get('plan_id')
+    
+    # Method 2: Parse from api_ref if extra data not available
+    if not user_id and api_ref:
+        # api_ref format: sub_{user_id}_{plan_id}_{timestamp}
+        parts = api_ref.split('_')
+        if len(parts) >= 3 and parts[0] == 'sub':
+            try:
+                user_id = int(parts[1])
+                plan_id = int(parts[2])
+            except (ValueError, IndexError):
+                webhook_log.warning("Failed to parse api_ref", extra={'api_ref': api_ref})
+    
+    if not user_id or not plan_id:
+        # Try to find pending payment by api_ref
+        if not api_ref:
+            raise PermanentWebhookError("Missing user_id/plan_id and no api_ref")
+        with get_cursor() as cursor:
+            cursor.execute("""
+                SELECT user_id, plan_id FROM payments 
+                WHERE transaction_id = %s
+            """, (api_ref,))
+            payment_record = cursor.fetchone()
+        
+        if not payment_record:
+            raise PermanentWebhookError(f"No payment found for api_ref: {api_ref}")
+        user_id = payment_record['user_id']
+        plan_id = payment_record['plan_id']
+    
+    result = activate_subscription(user_id, plan_id, amount, api_ref or invoice_id, checkout_id=invoice_id)
+    
+    if result['status'] == 'plan_not_found':
+        raise PermanentWebhookError(f"Plan {plan_id} not found")
+    if result['status'] == 'duplicate':
+        webhook_log.info("Payment already processed", extra={'api_ref': api_ref, 'invoice_id': invoice_id})
+        return True
+    if result['status'] == 'unclaimed':
+        raise PermanentWebhookError(f"Payment {api_ref or invoice_id} belongs to another user")
+    
+    webhook_log.info("Subscription activated", extra={'user_id': user_id, 'plan_id': plan_id,
+                                                      'subscription_id': result['subscription_id'], 'api_ref': api_ref})
+    return True
+
 @app.route("/intasend-webhook", methods=["POST"])
 def intasend_webhook():
-    """Handle IntaSend webhook events with signature verification"""
-    
-    print("=== Webhook Request Received ===")
-    print(f"Headers: {dict(request.headers)}")
-    print(f"Method: {request.method}")
+    """Verify an IntaSend webhook, queue it and acknowledge immediately
     
+    Processing happens in webhook_queue workers (handle_intasend_event), so
+    acknowledgment latency does not depend on downstream load.
+    """
     # Handle challenge validation first
     if request.is_json:
-        data = request.get_json()
+        data = request.get_json(silent=True)
         if data and "challenge" in data:
-            print(f"Challenge validation: {data['challenge']}")
             return jsonify({"challenge": data["challenge"]})
     
     # Get raw body for signature verification
     raw_body = request.get_data()
     signature = request.headers.get('X-IntaSend-Signature')
     
-    print(f"Raw body length: {len(raw_body) if raw_body else 0}")
-    print(f"Signature present: {bool(signature)}")
-    
     # Verify signature (optional in test mode)
     webhook_secret = os.getenv('INTASEND_WEBHOOK_SECRET')
     if webhook_secret and signature:
@@ -927,184 +1101,38 @@ def intasend_webhook():
         ).hexdigest()
         
         if not hmac.compare_digest(signature, expected_signature):
-            print("Invalid webhook signature")
+            webhook_log.warning("Invalid webhook signature", extra={'remote_addr': request.remote_addr})
             return "Invalid signature", 401
     
     # Parse webhook data
     try:
         data = json.loads(raw_body) if raw_body else {}
-        print(f"Parsed webhook data: {json.dumps(data, indent=2, default=str)}")
     except json.JSONDecodeError:
-        print("Invalid JSON in webhook")
+        webhook_log.warning("Invalid JSON in webhook", extra={'body_length': len(raw_body)})
         return "Invalid JSON", 400
     
-    # Handle IntaSend payment completion
-    if (data.get('state') == 'COMPLETE' or 
-        data.get('status') == 'COMPLETE' or 
-        data.get('status') == 'PAID'):
-        
-        print("Processing successful payment webhook...")
-        
-        try:
-            # Extract payment information
-            invoice_id = data.get('invoice_id') or data.get('id')
-            amount = data.get('value') or data.get('amount')
-            api_ref = data.get('api_ref')
-            
-            # Get user and plan info from extra field or api_ref
-            user_id = None
-            plan_id = None
-            
-            # Method 1: From extra field (if IntaSend preserves it)
-            extra_data = data.get('extra', {})
-            if isinstance(extra_data, dict):
-                user_id = extra_data.get('user_id')
-                plan_id = extra_data.get('plan_id')
-            
-            # Method 2: Parse from api_ref if extra data not available
-            if not user_id and api_ref:
-                # api_ref format: sub_{user_id}_{plan_id}_{timestamp}
-                parts = api_ref.split('_')
-                if len(parts) >= 3 and parts[0] == 'sub':
-                    try:
-                        user_id = int(parts[1])
-                        plan_id = int(parts[2])
-                    except (ValueError, IndexError):
-                        print(f"Failed to parse api_ref: {api_ref}")
-            
-            print(f"Extracted data: user_id={user_id}, plan_id={plan_id}, amount={amount}, invoice_id={invoice_id}")
-            
-            if not user_id or not plan_id:
-                print("Missing user_id or plan_id in webhook data")
-                # Try to find pending payment by api_ref
-                if api_ref:
-                    conn = get_db_connection()
-                    cursor = conn.cursor()
-                    cursor.execute("""
-                        SELECT user_id, plan_id FROM payments 
-                        WHERE transaction_id = %s AND status = 'pending'
-                    """, (api_ref,))
-                    payment_record = cursor.fetchone()
-                    cursor.close()
-                    conn.close()
-                    
-                    if payment_record:
-                        user_id = payment_record['user_id']
-                        plan_id = payment_record['plan_id']
-                        print(f"Found user_id={user_id}, plan_id={plan_id} from payment record")
-                    else:
-                        print(f"No pending payment found for api_ref: {api_ref}")
-                        return "Payment record not found", 400
-                else:
-                    print("No api_ref provided")
-                    return "Missing required data", 400
-            
-            if user_id and plan_id:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                
-                # Check if payment already processed
-                cursor.execute("""
-                    SELECT id FROM payments 
-                    WHERE transaction_id = %s AND status = 'completed'
-                """, (invoice_id or api_ref,))
-                existing_payment = cursor.fetchone()
-                
-                if existing_payment:
-                    print(f"Payment {invoice_id or api_ref} already processed")
-                    cursor.close()
-                    conn.close()
-                    return "Already processed", 200
-                
-                # Get plan duration
-                cursor.execute("SELECT duration_days FROM subscription_plans WHERE id = %s", (plan_id,))
-                plan = cursor.fetchone()
-                
-                if plan:
-                    # Calculate subscription dates
-                    start_date = datetime.now()
-                    end_date = start_date + timedelta(days=plan['duration_days'])
-                    
-                    # Deactivate any existing active subscriptions
-                    cursor.execute("""
-                        UPDATE subscriptions 
-                        SET status = 'cancelled' 
-                        WHERE user_id = %s AND status IN ('active', 'trial')
-                    """, (user_id,))
-                    
-                    # Create new active subscription
-                    cursor.execute("""
-                        INSERT INTO subscriptions (user_id, plan_id, status, start_date, end_date)
-                        VALUES (%s, %s, 'active', %s, %s)
-                    """, (user_id, plan_id, start_date, end_date))
-                    
-                    subscription_id = cursor.lastrowid
-                    
-                    # Update the existing pending payment record
-                    cursor.execute("""
-                        UPDATE payments 
-                        SET subscription_id = %s, status = 'completed', updated_at = NOW()
-                        WHERE transaction_id = %s AND user_id = %s AND status = 'pending'
-                    """, (subscription_id, api_ref, user_id))
-                    
-                    # If no pending payment was found, create a new payment record
-                    if cursor.rowcount == 0:
-                        cursor.execute("""
-                            INSERT INTO payments (user_id, subscription_id, plan_id, amount, status, payment_method, transaction_id, created_at)
-                            VALUES (%s, %s, %s, %s, 'completed', 'intasend', %s, NOW())
-                        """, (user_id, subscription_id, plan_id, amount, invoice_id or api_ref))
-                    
-                    conn.commit()
-                    cursor.close()
-                    conn.close()
-                    
-                    print(f"Successfully processed webhook for user {user_id}, subscription {subscription_id}")
-                    return "Webhook processed successfully", 200
-                else:
-                    print(f"Plan {plan_id} not found")
-                    cursor.close()
-                    conn.close()
-                    return "Plan not found", 400
-            else:
-                print("Missing user_id or plan_id")
-                return "Missing required data", 400
-                
-        except Exception as e:
-            print(f"Error processing webhook: {e}")
-            import traceback
-            traceback.print_exc()
-            return "Server error", 500
+    if not isinstance(data, dict):
+        return "Invalid payload", 400
     
-    print(f"Webhook event not processed: {data.get('state') or data.get('status')}")
-    return "Event not processed", 200
+    try:
+        if not enqueue_webhook('intasend', webhook_event_id(data, raw_body), data):
+            return "Already received", 200
+    except Exception:
+        # Not stored, so let the provider retry
+        webhook_log.exception("Error queueing webhook")
+        return "Server error", 500
+    
+    return "Webhook queued", 200
 
 @app.route('/profile')
 def profile():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Get user details
-    cursor.execute("SELECT name, email, trial_end_date FROM users WHERE id = %s", (session['user_id'],))
-    user = cursor.fetchone()
-    
-    # Get subscription details
-    cursor.execute("""
-        SELECT s.status, s.start_date, s.end_date, sp.name as plan_name, sp.price
-        FROM subscriptions s
-        JOIN subscription_plans sp ON s.plan_id = sp.id
-        WHERE s.user_id = %s
-        ORDER BY s.created_at DESC
-        LIMIT 1
-    """, (session['user_id'],))
-    
-    subscription = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    
-    trial_status = get_trial_status(user['trial_end_date']) if user else None
+    state = get_account_state(session['user_id'])
+    user = state['user'] if state else None
+    subscription = state['subscription'] if state else None
+    trial_status = state['trial_status'] if state else None
     
     return render_template('profile.html', 
                          user=user,
@@ -1125,17 +1153,13 @@ def update_profile():
         return jsonify({'error': 'Name and email are required'}), 400
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("UPDATE users SET name = %s, email = %s WHERE id = %s", 
-                     (name, email, session['user_id']))
-        conn.commit()
+        with get_cursor() as cursor:
+            cursor.execute("UPDATE users SET name = %s, email = %s WHERE id = %s", 
+                         (name, email, session['user_id']))
         
         session['user_name'] = name
-        
-        cursor.close()
-        conn.close()
+        entitlement_cache.invalidate(session['user_id'])
+        forget_account_state(session['user_id'])
         
         return jsonify({'success': True, 'message': 'Profile updated successfully'})
         
@@ -1150,40 +1174,50 @@ def delete_account():
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Delete user data (in production, you might want to soft delete)
-        cursor.execute("DELETE FROM recipes WHERE user_id = %s", (session['user_id'],))
-        cursor.execute("DELETE FROM payments WHERE user_id = %s", (session['user_id'],))
-        cursor.execute("DELETE FROM subscriptions WHERE user_id = %s", (session['user_id'],))
-        cursor.execute("DELETE FROM users WHERE id = %s", (session['user_id'],))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
+        with get_cursor() as cursor:
+            # Delete user data (in production, you might want to soft delete)
+            cursor.execute("DELETE FROM recipes WHERE user_id = %s", (session['user_id'],))
+            cursor.execute("DELETE FROM payments WHERE user_id = %s", (session['user_id'],))
+            cursor.execute("DELETE FROM subscriptions WHERE user_id = %s", (session['user_id'],))
+            cursor.execute("DELETE FROM users WHERE id = %s", (session['user_id'],))
+        
+        entitlement_cache.invalidate(session['user_id'])
+        forget_account_state(session['user_id'])
         session.clear()
         return jsonify({'success': True, 'message': 'Account deleted successfully'})
         
     except Exception as e:
         return jsonify({'error': 'Failed to delete account'}), 500
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint, merged across this server's workers"""
+    body, content_type = metrics_response()
+    return Response(body, mimetype=content_type)
+
 @app.route('/health')
 def health_check():
     """Health check endpoint for monitoring"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT 1")
-        cursor.close()
-        conn.close()
-        return jsonify({'status': 'healthy', 'database': 'connected'})
+        with get_cursor() as cursor:
+            cursor.execute("SELECT 1")
+        return jsonify({'status': 'healthy', 'database': 'connected', 'pool': pool_stats(),
+                        'entitlement_cache': entitlement_cache.stats(),
+                        'recommendation_cache': recommendation_cache.stats(),
+                        'recipe_index': recipe_index.stats(),
+                        'singleflight': recommendation_flight.stats(),
+                        'intasend': intasend_stats(),
+                        'models': model_router.stats(),
+                        'spend_limits': spend_limiter.stats(),
+                        'jobs': job_stats(),
+                        'password_hashing': hasher_stats(),
+                        'logging': logging_stats()})
     except Exception as e:
-        return jsonify({'status': 'unhealthy', 'database': 'disconnected', 'error': str(e)}), 500
+        return jsonify({'status': 'unhealthy', 'database': 'disconnected', 'error': str(e), 'pool': pool_stats()}), 500
 
 if __name__ == '__main__':
-    setup_database()
+    from migrate import migrate
+    migrate()
     port = int(os.environ.get('PORT', 5000))
     debug_mode = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
     app.run(host='0.0.0.0', port=port, debug=debug_mode)
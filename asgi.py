@@ -0,0 +1,272 @@
+"""Async serving mode
+
+Run with:
+
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+
+/get_recommendations and /create_subscription are served natively on the
+event loop (AsyncOpenAI, httpx, asyncpg), so a slow OpenRouter or IntaSend
+call no longer pins an OS worker. Identical concurrent recommendations share
+one completion through recommendation_flight.do_async, within this worker
+and with any other worker, sync or async. Every other route is the unchanged Flask
+view, run on a thread pool behind a2wsgi. Both stacks share the Flask
+session cookie, so a user logged in through one is logged in on the other.
+"""
+import os
+import time
+from contextlib import asynccontextmanager
+
+import asyncpg
+import httpx
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from openai import AsyncOpenAI
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+from account import load_entitlement_async
+from app import (app as flask_app, OPENROUTER_BASE_URL, checkout_request, completion_options,
+                 intasend_settings, new_api_ref, parse_ai_response, recipe_messages,
+                 recommendation_error, recommendation_model)
+from db import connection_params
+from entitlements import entitlement_cache
+from intasend import TIMEOUTS as INTASEND_TIMEOUTS
+from logs import get_logger
+from metrics import observe_intasend, observe_request
+from model_router import model_router
+from recipe_cache import cache_key, recommendation_cache
+from recipe_index import recipe_index
+from recipe_store import insert_recipes_async
+from singleflight import recommendation_flight
+from spend_limiter import SpendLimited, spend_limiter
+
+aclient = AsyncOpenAI(
+    base_url=OPENROUTER_BASE_URL,
+    api_key=os.getenv('OPENROUTER_API_KEY')
+)
+
+recommendation_log = get_logger('recommendations')
+payment_log = get_logger('payments')
+
+db_pool = None
+http = None
+
+_session_serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    global db_pool, http
+    params = connection_params()
+    db_pool = await asyncpg.create_pool(
+        host=params['host'],
+        user=params['user'],
+        password=params['password'],
+        database=params['database'],
+        port=int(params['port']),
+        min_size=int(os.getenv('PG_POOL_MIN', 1)),
+        max_size=int(os.getenv('PG_POOL_MAX', 10)),
+    )
+    http = httpx.AsyncClient(timeout=30)
+    try:
+        yield
+    finally:
+        await http.aclose()
+        await db_pool.close()
+
+
+def flask_session(request):
+    """The Flask session dict carried in the request's cookie, or {}"""
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return {}
+    try:
+        return _session_serializer.loads(cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+async def has_active_subscription(user_id):
+    """Async twin of app.has_active_subscription sharing the same cache"""
+    entitlement = entitlement_cache.get(user_id)
+    if entitlement is None:
+        entitlement = await load_entitlement_async(db_pool, user_id)
+        entitlement_cache.set(user_id, entitlement)
+    return entitlement['active']
+
+
+async def json_body(request):
+    """The request's JSON object, or {} for a missing, invalid or non-object body"""
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+async def local_recipes(ingredients, model):
+    """Async twin of app.local_recipes on db_pool: (recipes or None, from_index)"""
+    recipes_data = await recommendation_cache.get_async(db_pool, ingredients, model)
+    if recipes_data is not None:
+        return recipes_data, False
+    recipes_data = await recipe_index.recommend_async(db_pool, ingredients)
+    return recipes_data, recipes_data is not None
+
+
+async def get_recommendations(request):
+    user_id = flask_session(request).get('user_id')
+    if not user_id:
+        return JSONResponse({'error': 'Not authenticated'}, 401)
+
+    # Check subscription status
+    if not await has_active_subscription(user_id):
+        return JSONResponse({'error': 'Subscription required. Your free trial has ended.'}, 402)
+
+    data = await json_body(request)
+    ingredients = data.get('ingredients', '')
+
+    if not ingredients:
+        return JSONResponse({'error': 'No ingredients provided'}, 400)
+
+    try:
+        model = recommendation_model()
+        # Memory first, then the cache table and the index's rows, all on db_pool
+        recipes_data, from_index = await local_recipes(ingredients, model)
+
+        if recipes_data is None:
+            # A fast 429 here, before any outbound call, when the user or the site is over budget
+            spend = await spend_limiter.reserve_async(db_pool, user_id)
+
+            async def call():
+                text = await model_router.acomplete(aclient, recipe_messages(ingredients), mode='complete',
+                                                    on_usage=spend.record, **completion_options())
+                recipes = parse_ai_response(text)
+                await recommendation_cache.set_async(db_pool, ingredients, model, recipes)
+                return recipes
+
+            try:
+                # Coalesced with identical in-flight requests; only the leader's call reports usage
+                recipes_data = await recommendation_flight.do_async(db_pool, cache_key(ingredients, model), call,
+                                                                    describe_error=recommendation_error)
+            finally:
+                await spend.settle_async(db_pool)
+
+        # Save recipes to database in one round trip
+        async with db_pool.acquire() as conn:
+            saved_recipes = await insert_recipes_async(conn, user_id, recipes_data[:3])  # Limit to 3 recipes
+
+        if not from_index:
+            for recipe in saved_recipes:
+                recipe_index.add(recipe['id'], recipe['name'], recipe['ingredients'], recipe['instructions'])
+
+        return JSONResponse({'recipes': saved_recipes})
+
+    except SpendLimited as e:
+        message, status = recommendation_error(e)
+        return JSONResponse({'error': message, 'retry_after': e.retry_after, 'limits': e.levels}, status,
+                            headers={'Retry-After': str(e.retry_after)})
+    except Exception as e:
+        recommendation_log.exception("Recommendation failed", extra={'user_id': user_id})
+        message, status = recommendation_error(e)
+        return JSONResponse({'error': message}, status)
+
+
+async def create_subscription(request):
+    """Create a subscription payment with IntaSend"""
+    user_id = flask_session(request).get('user_id')
+    if not user_id:
+        return JSONResponse({'error': 'Not authenticated'}, 401)
+
+    data = await json_body(request)
+    plan_id = data.get('plan_id')
+
+    if not plan_id:
+        return JSONResponse({'error': 'Plan ID required'}, 400)
+
+    try:
+        async with db_pool.acquire() as conn:
+            plan = await conn.fetchrow("SELECT name, price, duration_days FROM subscription_plans WHERE id = $1", int(plan_id))
+            if not plan:
+                return JSONResponse({'error': 'Plan not found'}, 404)
+
+            user = await conn.fetchrow("SELECT name, email FROM users WHERE id = $1", user_id)
+            if not user:
+                return JSONResponse({'error': 'User not found'}, 404)
+
+        api_ref = new_api_ref(user_id, plan_id)
+        is_test, base_url, public_key, secret_key = intasend_settings()
+        intasend_data = checkout_request(public_key, user_id, plan_id, plan['name'], plan['price'],
+                                         user['name'], user['email'], api_ref,
+                                         f"{request.base_url}payment_callback")
+
+        started = time.perf_counter()
+        response = await http.post(
+            f"{base_url}/api/v1/checkout/",
+            json=intasend_data,
+            headers={'Content-Type': 'application/json', 'Accept': 'application/json'},
+            auth=(public_key, secret_key),
+            timeout=httpx.Timeout(INTASEND_TIMEOUTS['checkout'][1], connect=INTASEND_TIMEOUTS['checkout'][0]),
+        )
+        observe_intasend('checkout', response.status_code, time.perf_counter() - started)
+
+        if not response.content:
+            return JSONResponse({'error': 'Empty response from payment provider'}, 500)
+
+        try:
+            payment_data = response.json()
+        except ValueError as e:
+            payment_log.warning("Invalid JSON from IntaSend checkout", extra={'error': str(e), 'api_ref': api_ref})
+            return JSONResponse({'error': 'Invalid JSON response from payment provider'}, 500)
+
+        if response.status_code in [200, 201]:
+            checkout_url = payment_data.get('url') or payment_data.get('checkout_url')
+
+            if checkout_url:
+                # Store pending payment in database for tracking
+                invoice_id = payment_data.get('id') or payment_data.get('invoice_id')
+                await db_pool.execute("""
+                    INSERT INTO payments (user_id, plan_id, subscription_id, amount, status, payment_method, transaction_id, checkout_id, created_at)
+                    VALUES ($1, $2, NULL, $3, 'pending', 'intasend', $4, $5, NOW())
+                """, user_id, int(plan_id), plan['price'], api_ref, invoice_id and str(invoice_id))
+
+                return JSONResponse({
+                    'success': True,
+                    'payment_url': checkout_url,
+                    'invoice_id': invoice_id,
+                    'api_ref': api_ref
+                })
+            else:
+                return JSONResponse({'error': 'No payment URL received from provider'}, 500)
+        else:
+            error_message = payment_data.get('detail', payment_data.get('message', 'Payment request failed'))
+            payment_log.warning("IntaSend rejected checkout", extra={'error': error_message, 'api_ref': api_ref})
+            return JSONResponse({'error': f'Payment service error: {error_message}'}, 500)
+
+    except Exception:
+        payment_log.exception("Error creating subscription", extra={'user_id': user_id, 'plan_id': plan_id})
+        return JSONResponse({'error': 'Failed to create subscription. Please try again.'}, 500)
+
+
+def instrumented(route, handler):
+    """Record route metrics for a native handler; Flask routes record their own"""
+    async def wrapper(request):
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status_code
+            return response
+        finally:
+            observe_request(route, request.method, status, time.perf_counter() - started)
+    return wrapper
+
+
+app = Starlette(
+    routes=[
+        Route('/get_recommendations', instrumented('/get_recommendations', get_recommendations), methods=['POST']),
+        Route('/create_subscription', instrumented('/create_subscription', create_subscription), methods=['POST']),
+        Mount('/', app=WSGIMiddleware(flask_app, workers=int(os.getenv('WSGI_THREADS', 10)))),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,230 @@
+"""Password hashing off the request thread, and login throttling
+
+bcrypt is deliberately slow CPU work. Hashes are computed on a small
+per-worker thread pool (bcrypt releases the GIL), so at most
+PASSWORD_HASH_THREADS hashes run at once in a worker and a login burst
+cannot take every core from recommendation traffic. At most
+PASSWORD_HASH_QUEUE more may wait, for up to PASSWORD_HASH_WAIT seconds;
+beyond that, callers get HashingBusy instead of piling up.
+
+The work factor is BCRYPT_ROUNDS. A stored hash with a different cost is
+re-hashed in the background after its next successful login.
+
+Failed logins are counted per email and per client address in
+login_failures. Once either count reaches its limit within
+LOGIN_FAILURE_WINDOW seconds, further attempts are rejected before any
+bcrypt work, until the window runs out. The count is read in the same
+statement that loads the user, so throttling adds no round trip.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from db import get_cursor
+from logs import get_logger
+
+log = get_logger('auth')
+
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+
+LOGIN_FAILURE_WINDOW = int(os.getenv('LOGIN_FAILURE_WINDOW', 900))
+LOGIN_MAX_FAILURES = int(os.getenv('LOGIN_MAX_FAILURES', 5))
+LOGIN_MAX_FAILURES_PER_ADDRESS = int(os.getenv('LOGIN_MAX_FAILURES_PER_ADDRESS', 50))
+
+LOGIN_SQL = """
+    WITH failures AS (
+        SELECT key, failures FROM login_failures
+        WHERE key IN (%(email_key)s, %(address_key)s)
+          AND first_failed_at > NOW() - make_interval(secs => %(window)s)
+    )
+    SELECT u.id, u.name, u.password,
+           COALESCE((SELECT failures FROM failures WHERE key = %(email_key)s), 0) AS email_failures,
+           COALESCE((SELECT failures FROM failures WHERE key = %(address_key)s), 0) AS address_failures
+    FROM (SELECT 1) AS one
+    LEFT JOIN users u ON u.email = %(email)s
+"""
+
+# A count whose window has run out starts over at 1
+RECORD_FAILURE_SQL = """
+    INSERT INTO login_failures (key, failures, first_failed_at)
+    SELECT key, 1, NOW() FROM unnest(%(keys)s::text[]) AS key
+    ON CONFLICT (key) DO UPDATE SET
+        failures = CASE WHEN login_failures.first_failed_at > NOW() - make_interval(secs => %(window)s)
+                        THEN login_failures.failures + 1 ELSE 1 END,
+        first_failed_at = CASE WHEN login_failures.first_failed_at > NOW() - make_interval(secs => %(window)s)
+                               THEN login_failures.first_failed_at ELSE NOW() END
+"""
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing pool stays full for PASSWORD_HASH_WAIT seconds"""
+
+
+class PasswordHasher:
+    """Bounded thread pool for bcrypt: `threads` running, `queue` waiting"""
+
+    def __init__(self, threads=2, queue=8, wait=2.0):
+        self.threads = threads
+        self.wait = wait
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(threads + queue)
+        self._lock = threading.Lock()
+        self._stats = {
+            'hashed': 0,
+            'checked': 0,
+            'rehashed': 0,
+            'rejected': 0,
+            'in_flight': 0,
+            'seconds_total': 0.0,
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _run(self, fn, *args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self._count('seconds_total', time.perf_counter() - started)
+
+    def _submit(self, fn, *args, wait=None):
+        if not self._slots.acquire(timeout=self.wait if wait is None else wait):
+            self._count('rejected')
+            raise HashingBusy(f'Password hashing pool busy for {self.wait}s')
+        self._count('in_flight')
+        try:
+            future = self._executor.submit(self._run, fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def _release(self):
+        self._count('in_flight', -1)
+        self._slots.release()
+
+    def hash(self, password, rounds=None):
+        """bcrypt hash of password at `rounds` (default BCRYPT_ROUNDS)"""
+        salt = bcrypt.gensalt(rounds or BCRYPT_ROUNDS)
+        hashed = self._submit(bcrypt.hashpw, password.encode('utf-8'), salt).result()
+        self._count('hashed')
+        return hashed.decode('utf-8')
+
+    def check(self, password, hashed):
+        ok = self._submit(bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8')).result()
+        self._count('checked')
+        return ok
+
+    def rehash_later(self, user_id, password, old_hash):
+        """Replace old_hash with one at BCRYPT_ROUNDS, without waiting for it
+
+        Skipped when the pool is full; the next login tries again.
+        """
+        try:
+            self._submit(self._rehash, user_id, password, old_hash, wait=0)
+        except HashingBusy:
+            pass
+
+    def _rehash(self, user_id, password, old_hash):
+        new_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS)).decode('utf-8')
+        try:
+            with get_cursor() as cursor:
+                # Only if nobody changed the password in the meantime
+                cursor.execute("UPDATE users SET password = %s WHERE id = %s AND password = %s",
+                               (new_hash, user_id, old_hash))
+        except Exception:
+            log.exception("Password rehash failed", extra={'user_id': user_id})
+            return
+        self._count('rehashed')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['threads'] = self.threads
+        return stats
+
+
+def hash_cost(hashed):
+    """Work factor of a bcrypt hash ('$2b$12$...' -> 12), or None if unparseable"""
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def needs_rehash(hashed):
+    return hash_cost(hashed) != BCRYPT_ROUNDS
+
+
+_hasher = None
+_hasher_pid = None
+_hasher_lock = threading.Lock()
+
+
+def get_hasher():
+    """This worker's hashing pool, created lazily so threads are never shared across fork"""
+    global _hasher, _hasher_pid
+    pid = os.getpid()
+    if _hasher is not None and _hasher_pid == pid:
+        return _hasher
+    with _hasher_lock:
+        if _hasher is None or _hasher_pid != pid:
+            _hasher = PasswordHasher(
+                threads=int(os.getenv('PASSWORD_HASH_THREADS', 2)),
+                queue=int(os.getenv('PASSWORD_HASH_QUEUE', 8)),
+                wait=float(os.getenv('PASSWORD_HASH_WAIT', 2.0)),
+            )
+            _hasher_pid = pid
+    return _hasher
+
+
+def hasher_stats():
+    """Hashing pool statistics for this worker, or None before first use"""
+    if _hasher is None or _hasher_pid != os.getpid():
+        return None
+    return _hasher.stats()
+
+
+def hash_password(password):
+    return get_hasher().hash(password)
+
+
+def _throttle_keys(email, address):
+    return f'email:{email.strip().lower()}', f'address:{address or "unknown"}'
+
+
+def authenticate(email, password, address):
+    """Check a login attempt; returns {'status': 'ok' | 'invalid' | 'throttled', 'user': ...}
+
+    Raises HashingBusy when the password cannot be checked in time.
+    """
+    email_key, address_key = _throttle_keys(email, address)
+    with get_cursor() as cursor:
+        cursor.execute(LOGIN_SQL, {'email': email, 'email_key': email_key, 'address_key': address_key,
+                                   'window': LOGIN_FAILURE_WINDOW})
+        row = cursor.fetchone()
+
+    if row['email_failures'] >= LOGIN_MAX_FAILURES or row['address_failures'] >= LOGIN_MAX_FAILURES_PER_ADDRESS:
+        log.info("Login throttled", extra={'email': email, 'email_failures': row['email_failures'],
+                                           'address_failures': row['address_failures']})
+        return {'status': 'throttled', 'user': None}
+
+    hasher = get_hasher()
+    if row['id'] is None or not hasher.check(password, row['password']):
+        with get_cursor() as cursor:
+            cursor.execute(RECORD_FAILURE_SQL, {'keys': [email_key, address_key], 'window': LOGIN_FAILURE_WINDOW})
+        return {'status': 'invalid', 'user': None}
+
+    if row['email_failures']:
+        with get_cursor() as cursor:
+            cursor.execute("DELETE FROM login_failures WHERE key = %s", (email_key,))
+    if needs_rehash(row['password']):
+        hasher.rehash_later(row['id'], password, row['password'])
+    return {'status': 'ok', 'user': {'id': row['id'], 'name': row['name']}}
+
@@ -0,0 +1,97 @@
+"""Compare the sync (gunicorn app:app) and async (asgi:app) deployments
+
+Needs a reachable Postgres (PG* environment variables) with the app schema.
+Starts benchmarks/fake_openrouter.py, then each deployment in turn, and
+fires concurrent /get_recommendations requests with distinct ingredients so
+neither the recommendation cache nor the recipe index can answer them.
+
+    python benchmarks/bench_async.py --requests 400 --concurrency 200 --llm-latency 2
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+import httpx
+
+from common import (ensure_bench_user, python_module, session_cookie, start_process,
+                    stop_process, summarize, wait_for)
+
+FAKE_LLM_PORT = 9100
+APP_PORT = 9200
+
+
+async def drive(base_url, cookie, total, concurrency):
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    run_id = uuid.uuid4().hex[:8]
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, cookies={'session': cookie},
+                                 timeout=300, limits=limits) as client:
+        async def one(i):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post('/get_recommendations',
+                                                 json={'ingredients': f'bench{run_id}x{i}, rice'})
+                    if response.status_code != 200:
+                        errors += 1
+                        return
+                except httpx.HTTPError:
+                    errors += 1
+                    return
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        return latencies, errors, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sync vs async deployment benchmark')
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--llm-latency', type=float, default=2.0)
+    parser.add_argument('--sync-workers', type=int, default=4)
+    args = parser.parse_args()
+
+    user_id = ensure_bench_user()
+    cookie = session_cookie(user_id)
+    app_env = {
+        'OPENROUTER_BASE_URL': f'http://127.0.0.1:{FAKE_LLM_PORT}/api/v1',
+        'OPENROUTER_API_KEY': 'benchmark',
+        # Coverage can never exceed 1.0, so the local index never answers
+        'RECIPE_INDEX_MIN_COVERAGE': '2',
+        # One benchmark user would exhaust its spend bucket in seconds
+        'LLM_SPEND_LIMITS': 'off',
+    }
+    bind = f'127.0.0.1:{APP_PORT}'
+    deployments = [
+        (f'sync gunicorn x{args.sync_workers}',
+         ['gunicorn', 'app:app', '-w', str(args.sync_workers), '-b', bind, '--timeout', '300']),
+        ('async uvicorn x1',
+         ['gunicorn', 'asgi:app', '-w', '1', '-k', 'uvicorn.workers.UvicornWorker', '-b', bind, '--timeout', '300']),
+    ]
+
+    fake_llm = start_process(python_module('benchmarks/fake_openrouter.py', '--port', str(FAKE_LLM_PORT),
+                                            '--latency', str(args.llm_latency)))
+    try:
+        wait_for(f'http://127.0.0.1:{FAKE_LLM_PORT}/')
+        for name, command in deployments:
+            server = start_process(command, env=app_env)
+            try:
+                wait_for(f'http://{bind}/health')
+                latencies, errors, elapsed = asyncio.run(drive(f'http://{bind}', cookie,
+                                                               args.requests, args.concurrency))
+                summarize(name, latencies, errors, elapsed)
+            finally:
+                stop_process(server)
+    finally:
+        stop_process(fake_llm)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Compare one-shot IntaSend calls with the pooled IntaSendClient
+
+Starts benchmarks/fake_intasend.py and times checkout-status lookups made
+the old way (a fresh requests.get per call) against intasend.IntaSendClient.
+No database is needed. Pass a certificate and key to serve the fake over TLS,
+where connection reuse matters most:
+
+    openssl req -x509 -newkey rsa:2048 -nodes -subj /CN=127.0.0.1 \\
+        -addext subjectAltName=IP:127.0.0.1 -keyout key.pem -out cert.pem
+    python benchmarks/bench_intasend.py --requests 500 --concurrency 8 --certfile cert.pem --keyfile key.pem
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from common import ROOT, python_module, start_process, stop_process, summarize
+
+sys.path.insert(0, ROOT)
+from intasend import IntaSendClient  # noqa: E402
+
+FAKE_INTASEND_PORT = 9300
+
+
+def run(name, call, total, concurrency):
+    latencies = []
+    errors = 0
+
+    def one(_):
+        started = time.perf_counter()
+        try:
+            ok = call().status_code == 200
+        except requests.RequestException:
+            ok = False
+        return ok, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for ok, latency in pool.map(one, range(total)):
+            if ok:
+                latencies.append(latency)
+            else:
+                errors += 1
+    summarize(name, latencies, errors, time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.02, help='fake IntaSend response latency')
+    parser.add_argument('--certfile')
+    parser.add_argument('--keyfile')
+    args = parser.parse_args()
+
+    tls = bool(args.certfile and args.keyfile)
+    scheme = 'https' if tls else 'http'
+    base_url = f'{scheme}://127.0.0.1:{FAKE_INTASEND_PORT}'
+    verify = os.path.abspath(args.certfile) if tls else True
+
+    fake_args = ['benchmarks/fake_intasend.py', '--port', str(FAKE_INTASEND_PORT), '--latency', str(args.latency)]
+    if tls:
+        fake_args += ['--ssl-certfile', os.path.abspath(args.certfile), '--ssl-keyfile', os.path.abspath(args.keyfile)]
+    fake = start_process(python_module(*fake_args))
+    try:
+        client = IntaSendClient(base_url, 'pk_bench', 'sk_bench', pool_size=args.concurrency, verify=verify)
+        for _ in range(50):
+            try:
+                checkout = client.create_checkout({'api_ref': 'sub_1_1_bench', 'amount': 100}).json()
+                break
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        else:
+            raise RuntimeError('fake IntaSend did not come up')
+        status_url = f"{base_url}/api/v1/checkout/{checkout['id']}/"
+
+        print(f"{args.requests} checkout-status calls, concurrency {args.concurrency}, "
+              f"{scheme.upper()}, {args.latency * 1000:.0f} ms server latency")
+        run('one-shot requests.get', lambda: requests.get(status_url, auth=('pk_bench', 'sk_bench'),
+                                                          timeout=10, verify=verify),
+            args.requests, args.concurrency)
+        run('pooled IntaSendClient', lambda: client.checkout_status(checkout['id']),
+            args.requests, args.concurrency)
+        print(f"client stats: {client.stats()}")
+        client.close()
+    finally:
+        stop_process(fake)
+
+
+if __name__ == '__main__':
+    main()
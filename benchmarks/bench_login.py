@@ -0,0 +1,129 @@
+"""Login throughput under mixed load, for several hashing pool sizes
+
+Needs a reachable Postgres (PG* environment variables) with the app schema.
+For each --hash-threads value, starts the sync app with that
+PASSWORD_HASH_THREADS and runs three groups of clients at once:
+
+    login      correct-password logins for the benchmark user
+    recommend  cached /get_recommendations calls, the traffic a login storm
+               should not starve
+    attack     wrong-password logins against a second account, which the
+               failed-attempt throttle should turn into cheap 429s
+
+A pool as large as the worker's thread count behaves like hashing inline on
+the request thread.
+
+    python benchmarks/bench_login.py --hash-threads 8,2,1 --duration 20
+"""
+import argparse
+import asyncio
+import time
+
+import bcrypt
+import httpx
+
+from common import (BENCH_EMAIL, BENCH_PASSWORD, connect, ensure_bench_user, python_module, session_cookie,
+                    start_process, stop_process, summarize, wait_for)
+
+FAKE_LLM_PORT = 9100
+APP_PORT = 9200
+VICTIM_EMAIL = 'victim@example.com'
+
+
+def ensure_victim(rounds):
+    conn = connect()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO users (name, email, password) VALUES ('Victim', %s, %s)
+        ON CONFLICT (email) DO UPDATE SET password = EXCLUDED.password
+    """, (VICTIM_EMAIL, bcrypt.hashpw(b'not-the-password', bcrypt.gensalt(rounds)).decode('utf-8')))
+    cursor.execute("DELETE FROM login_failures")
+    conn.commit()
+    conn.close()
+
+
+async def drive(base_url, cookie, duration, concurrency):
+    results = {name: {'latencies': [], 'errors': 0, 'statuses': {}} for name in concurrency}
+    deadline = time.monotonic() + duration
+
+    async def client_loop(name, client):
+        result = results[name]
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                if name == 'login':
+                    response = await client.post('/login', data={'email': BENCH_EMAIL, 'password': BENCH_PASSWORD})
+                    ok = response.status_code == 302
+                elif name == 'attack':
+                    response = await client.post('/login', data={'email': VICTIM_EMAIL, 'password': 'guess'})
+                    ok = response.status_code in (200, 429)
+                else:
+                    response = await client.post('/get_recommendations', json={'ingredients': 'chicken, rice'})
+                    ok = response.status_code == 200
+                status = response.status_code
+            except httpx.HTTPError:
+                ok, status = False, 'error'
+            result['statuses'][status] = result['statuses'].get(status, 0) + 1
+            if ok:
+                result['latencies'].append(time.perf_counter() - started)
+            else:
+                result['errors'] += 1
+
+    async with httpx.AsyncClient(base_url=base_url, cookies={'session': cookie}, timeout=120,
+                                 follow_redirects=False) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(name, client)
+                               for name, count in concurrency.items() for _ in range(count)))
+        return results, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Login throughput under mixed load')
+    parser.add_argument('--hash-threads', default='8,2,1', help='PASSWORD_HASH_THREADS values to compare')
+    parser.add_argument('--rounds', type=int, default=12, help='BCRYPT_ROUNDS')
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--logins', type=int, default=16, help='concurrent login clients')
+    parser.add_argument('--recommenders', type=int, default=8, help='concurrent recommendation clients')
+    parser.add_argument('--attackers', type=int, default=8, help='concurrent wrong-password clients')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    password_hash = bcrypt.hashpw(BENCH_PASSWORD.encode('utf-8'), bcrypt.gensalt(args.rounds)).decode('utf-8')
+    user_id = ensure_bench_user(password_hash)
+    cookie = session_cookie(user_id)
+    bind = f'127.0.0.1:{APP_PORT}'
+    concurrency = {'login': args.logins, 'recommend': args.recommenders, 'attack': args.attackers}
+
+    fake_llm = start_process(python_module('benchmarks/fake_openrouter.py', '--port', str(FAKE_LLM_PORT)))
+    try:
+        wait_for(f'http://127.0.0.1:{FAKE_LLM_PORT}/')
+        for hash_threads in args.hash_threads.split(','):
+            ensure_victim(args.rounds)
+            app_env = {
+                'OPENROUTER_BASE_URL': f'http://127.0.0.1:{FAKE_LLM_PORT}/api/v1',
+                'OPENROUTER_API_KEY': 'benchmark',
+                'BCRYPT_ROUNDS': str(args.rounds),
+                'PASSWORD_HASH_THREADS': hash_threads,
+                # Every client shares 127.0.0.1; only the per-account limit applies
+                'LOGIN_MAX_FAILURES_PER_ADDRESS': '1000000000',
+                'LOG_LEVEL': 'WARNING',
+            }
+            server = start_process(['gunicorn', 'app:app', '-w', str(args.workers), '--threads', str(args.threads),
+                                    '-b', bind, '--timeout', '300'], env=app_env)
+            try:
+                wait_for(f'http://{bind}/health')
+                results, elapsed = asyncio.run(drive(f'http://{bind}', cookie, args.duration, concurrency))
+            finally:
+                stop_process(server)
+
+            print(f"\nPASSWORD_HASH_THREADS={hash_threads} (x{args.workers} workers, {args.threads} threads each)")
+            for name, result in results.items():
+                summarize(name, result['latencies'], result['errors'], elapsed)
+                print(f"{'':<28} statuses {dict(sorted(result['statuses'].items(), key=str))}")
+    finally:
+        stop_process(fake_llm)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+"""Mixed-workload load test against local stand-ins for every dependency
+
+Starts benchmarks/fake_openrouter.py, benchmarks/fake_intasend.py (which
+answers checkouts and then sends the COMPLETE webhook), the webhook queue
+worker and the app, then runs --concurrency virtual users for --duration
+seconds. Each user picks operations by weight:
+
+    login          POST /login with the benchmark credentials
+    recommend      POST /get_recommendations from a small ingredient pool (cache hits)
+    recommend_new  POST /get_recommendations with unique ingredients (LLM calls)
+    history        GET  /get_user_recipes, following next_cursor for a page or two
+    checkout       POST /create_subscription
+    webhooks       a burst of --burst-size webhook posts, a fifth of them duplicates
+
+It reports throughput and p50/p95/p99 per operation, SQL statements and SQL
+time per request by route (from the app's /metrics), and how long the webhook
+queue takes to drain after the load stops.
+
+Postgres comes from the PG* environment variables, or --pg-tmp DIR starts a
+throwaway cluster (initdb/pg_ctl on PATH or in PG_BIN, as a non-root user).
+
+    python benchmarks/bench_mixed.py --duration 30 --concurrency 50
+    python benchmarks/bench_mixed.py --server async --weights recommend_new=5,checkout=3
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+import httpx
+
+from common import (BENCH_EMAIL, BENCH_PASSWORD, connect, ensure_bench_user, python_module, run_migrations,
+                    scrape_metrics, session_cookie, start_postgres, start_process, stop_postgres, stop_process,
+                    summarize, wait_for)
+
+FAKE_LLM_PORT = 9100
+FAKE_INTASEND_PORT = 9300
+APP_PORT = 9200
+WEBHOOK_DELAY = 1.0
+
+DEFAULT_WEIGHTS = {
+    'login': 5,
+    'recommend': 35,
+    'recommend_new': 10,
+    'history': 30,
+    'checkout': 10,
+    'webhooks': 10,
+}
+
+INGREDIENT_POOL = [
+    'chicken, rice, garlic', 'eggs, spinach, cheese', 'beef, onion, potato', 'tomato, pasta, basil',
+    'salmon, lemon, dill', 'beans, corn, tortilla', 'tofu, broccoli, soy sauce', 'lentils, carrot, cumin',
+]
+
+ROUTES = ['/login', '/get_recommendations', '/get_user_recipes', '/create_subscription', '/intasend-webhook']
+
+
+class Workload:
+    def __init__(self, client, user_id, plan_id, burst_size):
+        self.client = client
+        self.user_id = user_id
+        self.plan_id = plan_id
+        self.burst_size = burst_size
+        self.latencies = {name: [] for name in DEFAULT_WEIGHTS}
+        self.errors = {name: 0 for name in DEFAULT_WEIGHTS}
+        self.run_id = uuid.uuid4().hex[:8]
+        self.sequence = 0
+
+    def _next(self):
+        self.sequence += 1
+        return self.sequence
+
+    async def login(self):
+        response = await self.client.post('/login', data={'email': BENCH_EMAIL, 'password': BENCH_PASSWORD},
+                                          follow_redirects=False)
+        return response.status_code in (200, 302)
+
+    async def recommend(self):
+        response = await self.client.post('/get_recommendations',
+                                          json={'ingredients': random.choice(INGREDIENT_POOL)})
+        return response.status_code == 200
+
+    async def recommend_new(self):
+        response = await self.client.post('/get_recommendations',
+                                          json={'ingredients': f'bench{self.run_id}x{self._next()}, rice'})
+        return response.status_code == 200
+
+    async def history(self):
+        cursor = None
+        for _ in range(random.randint(1, 2)):
+            params = {'limit': 20}
+            if cursor:
+                params['cursor'] = cursor
+            response = await self.client.get('/get_user_recipes', params=params)
+            if response.status_code != 200:
+                return False
+            cursor = response.json().get('next_cursor')
+            if not cursor:
+                break
+        return True
+
+    async def checkout(self):
+        response = await self.client.post('/create_subscription', json={'plan_id': self.plan_id})
+        return response.status_code == 200
+
+    async def webhooks(self):
+        events = []
+        for _ in range(self.burst_size):
+            n = self._next()
+            events.append({'invoice_id': f'WH{self.run_id}{n}', 'state': 'COMPLETE', 'value': 10,
+                           'api_ref': f'sub_{self.user_id}_{self.plan_id}_wh{self.run_id}{n}'})
+        # Providers retry, so a share of every burst are duplicates
+        events += random.sample(events, max(1, self.burst_size // 5))
+        responses = await asyncio.gather(*(
+            self.client.post('/intasend-webhook', content=json.dumps(event),
+                             headers={'Content-Type': 'application/json'})
+            for event in events
+        ))
+        return all(response.status_code == 200 for response in responses)
+
+    async def run_one(self, name):
+        started = time.perf_counter()
+        try:
+            ok = await getattr(self, name)()
+        except httpx.HTTPError:
+            ok = False
+        if ok:
+            self.latencies[name].append(time.perf_counter() - started)
+        else:
+            self.errors[name] += 1
+
+
+async def drive(base_url, cookie, user_id, plan_id, weights, concurrency, duration, burst_size):
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+    async with httpx.AsyncClient(base_url=base_url, cookies={'session': cookie},
+                                 timeout=120, limits=limits) as client:
+        workload = Workload(client, user_id, plan_id, burst_size)
+        names = list(weights)
+        deadline = time.monotonic() + duration
+
+        async def user():
+            while time.monotonic() < deadline:
+                await workload.run_one(random.choices(names, [weights[n] for n in names])[0])
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        return workload, time.perf_counter() - started
+
+
+def scalar(sql):
+    conn = connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql)
+        return cursor.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def pending_webhooks():
+    return scalar("SELECT COUNT(*) FROM webhook_events WHERE status = 'pending'")
+
+
+def wait_for_drain(timeout=120.0):
+    started = time.monotonic()
+    # Checkouts from the last second still have their webhook in flight
+    time.sleep(WEBHOOK_DELAY + 0.5)
+    while time.monotonic() - started < timeout:
+        if pending_webhooks() == 0:
+            return time.monotonic() - started
+        time.sleep(0.25)
+    return None
+
+
+def metric_delta(before, after, name, route):
+    key = (name, (('route', route),))
+    return after.get(key, 0.0) - before.get(key, 0.0)
+
+
+def report(workload, elapsed, before, after, drain_seconds):
+    print()
+    for name, latencies in workload.latencies.items():
+        if latencies or workload.errors[name]:
+            summarize(name, latencies, workload.errors[name], elapsed)
+
+    print(f"\n{'route':<24} {'requests':>9} {'queries/req':>12} {'sql ms/req':>11}")
+    for route in ROUTES:
+        requests = metric_delta(before, after, 'db_queries_per_request_count', route)
+        if not requests:
+            continue
+        queries = metric_delta(before, after, 'db_queries_per_request_sum', route)
+        seconds = metric_delta(before, after, 'db_time_per_request_seconds_sum', route)
+        print(f"{route:<24} {requests:>9.0f} {queries / requests:>12.2f} {seconds * 1000 / requests:>11.2f}")
+
+    if drain_seconds is None:
+        print("\nwebhook queue did not drain within the timeout")
+    else:
+        print(f"\nwebhook queue drained {drain_seconds:.1f}s after load stopped")
+
+
+def parse_weights(value):
+    weights = dict(DEFAULT_WEIGHTS)
+    for item in (value or '').split(','):
+        if '=' in item:
+            name, weight = item.split('=', 1)
+            if name not in weights:
+                raise SystemExit(f'unknown operation {name!r}; choose from {", ".join(weights)}')
+            weights[name] = float(weight)
+    return {name: weight for name, weight in weights.items() if weight > 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mixed-workload load test')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--weights', help='override operation weights, e.g. "checkout=0,history=50"')
+    parser.add_argument('--burst-size', type=int, default=20)
+    parser.add_argument('--server', choices=['sync', 'async'], default='sync')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--llm-latency', type=float, default=1.0)
+    parser.add_argument('--intasend-latency', type=float, default=0.15)
+    parser.add_argument('--pg-tmp', metavar='DIR', help='start a throwaway Postgres in DIR')
+    args = parser.parse_args()
+    weights = parse_weights(args.weights)
+
+    if args.pg_tmp:
+        os.environ.update(start_postgres(os.path.abspath(args.pg_tmp)))
+    processes = []
+    try:
+        run_migrations()
+        user_id = ensure_bench_user()
+        cookie = session_cookie(user_id)
+        bind = f'127.0.0.1:{APP_PORT}'
+        base_url = f'http://{bind}'
+        app_env = {
+            'OPENROUTER_BASE_URL': f'http://127.0.0.1:{FAKE_LLM_PORT}/api/v1',
+            'OPENROUTER_API_KEY': 'benchmark',
+            'INTASEND_BASE_URL': f'http://127.0.0.1:{FAKE_INTASEND_PORT}',
+            'INTASEND_PUBLIC_KEY': 'ISPubKey_test_bench',
+            'INTASEND_SECRET_KEY': 'ISSecretKey_test_bench',
+            'LOG_LEVEL': 'WARNING',
+            # A handful of benchmark users would exhaust their spend buckets in seconds
+            'LLM_SPEND_LIMITS': 'off',
+        }
+
+        processes.append(start_process(python_module(
+            'benchmarks/fake_openrouter.py', '--port', str(FAKE_LLM_PORT), '--latency', str(args.llm_latency))))
+        processes.append(start_process(python_module(
+            'benchmarks/fake_intasend.py', '--port', str(FAKE_INTASEND_PORT),
+            '--latency', str(args.intasend_latency), '--webhook-url', f'{base_url}/intasend-webhook',
+            '--webhook-delay', str(WEBHOOK_DELAY))))
+        processes.append(start_process(python_module('webhook_queue.py', '--threads', '4'), env=app_env))
+        if args.server == 'sync':
+            command = ['gunicorn', 'app:app', '-w', str(args.workers), '--threads', '4',
+                       '-b', bind, '--timeout', '300']
+        else:
+            command = ['gunicorn', 'asgi:app', '-w', str(args.workers), '-k', 'uvicorn.workers.UvicornWorker',
+                       '-b', bind, '--timeout', '300']
+        processes.append(start_process(command, env=app_env))
+
+        wait_for(f'http://127.0.0.1:{FAKE_LLM_PORT}/')
+        wait_for(f'http://127.0.0.1:{FAKE_INTASEND_PORT}/')
+        wait_for(f'{base_url}/health')
+
+        plan_id = scalar("SELECT id FROM subscription_plans WHERE is_active ORDER BY price LIMIT 1")
+
+        print(f"{args.server} server x{args.workers}, {args.concurrency} users for {args.duration:.0f}s, "
+              f"weights {weights}")
+        before = scrape_metrics(base_url)
+        workload, elapsed = asyncio.run(drive(base_url, cookie, user_id, plan_id, weights,
+                                              args.concurrency, args.duration, args.burst_size))
+        after = scrape_metrics(base_url)
+        report(workload, elapsed, before, after, wait_for_drain())
+    finally:
+        for process in reversed(processes):
+            stop_process(process)
+        if args.pg_tmp:
+            stop_postgres(os.path.abspath(args.pg_tmp))
+
+
+if __name__ == '__main__':
+    main()
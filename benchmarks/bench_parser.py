@@ -0,0 +1,177 @@
+"""Fuzz and time the LLM response parser against a corpus of model outputs
+
+benchmarks/corpus/llm_outputs.jsonl holds real-world response shapes: code
+fences, prose with brackets, structured-output objects, truncated arrays,
+trailing commas, numbered markdown, refusals. Each line has the number of
+recipes a correct parse yields, and optionally their names in order. For
+every case this checks parse_recipes() and a chunked RecipeStreamParser
+against those, next to the old greedy
+regex parser, then fuzzes every truncation point and random corruptions
+(anything but RecipeParseError is a bug) and checks that pathological inputs
+scale linearly.
+
+    python benchmarks/bench_parser.py --mutations 2000
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+from common import ROOT
+
+sys.path.insert(0, ROOT)
+from recipe_parser import RecipeParseError, RecipeStreamParser, parse_recipes  # noqa: E402
+
+CORPUS = os.path.join(ROOT, 'benchmarks', 'corpus', 'llm_outputs.jsonl')
+
+
+def legacy_parse(text):
+    """The parser this replaced: greedy regex, then '1.'/'2.'/'3.' lines"""
+    match = re.search(r'\[.*\]', text.strip(), re.DOTALL)
+    if match:
+        return json.loads(match.group())[:3]
+    recipes, current = [], {}
+    for line in text.split('\n'):
+        line = line.strip()
+        if line.startswith(('1.', '2.', '3.')):
+            if current:
+                recipes.append(current)
+            current = {'name': line[2:].strip(), 'ingredients': '', 'instructions': ''}
+        elif 'ingredients' in line.lower() and current:
+            current['ingredients'] = line.split(':')[1].strip() if ':' in line else line
+        elif 'instructions' in line.lower() and current:
+            current['instructions'] = line.split(':')[1].strip() if ':' in line else line
+    if current:
+        recipes.append(current)
+    return recipes[:3]
+
+
+def count(parse, text):
+    try:
+        return len(parse(text))
+    except RecipeParseError:
+        return 0
+
+
+def names(parse, text):
+    try:
+        return [recipe['name'] for recipe in parse(text)]
+    except RecipeParseError:
+        return []
+
+
+def legacy_count(text):
+    try:
+        recipes = legacy_parse(text)
+    except Exception:
+        return 'crash'
+    # Only recipes with the three fields as text are usable downstream
+    return sum(1 for r in recipes if isinstance(r, dict) and isinstance(r.get('name'), str)
+               and r.get('ingredients') and r.get('instructions'))
+
+
+def streamed(text, rng):
+    parser = RecipeStreamParser()
+    recipes = []
+    position = 0
+    while position < len(text):
+        size = rng.randint(1, 24)
+        recipes += parser.feed(text[position:position + size])
+        position += size
+    return recipes[:3]
+
+
+def timed(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat
+
+
+def mutate(text, rng):
+    chars = list(text)
+    for _ in range(rng.randint(1, 8)):
+        op = rng.random()
+        position = rng.randrange(len(chars) + 1)
+        if op < 0.4 and chars:
+            del chars[min(position, len(chars) - 1)]
+        elif op < 0.8:
+            chars.insert(position, rng.choice('[]{}",:\\\n`*#1.-'))
+        elif chars:
+            chars[min(position, len(chars) - 1)] = rng.choice('abc "\'')
+    return ''.join(chars)
+
+
+def pathological(n):
+    return {
+        'open brackets': '[' * n,
+        'nested objects': '[{"a":' * (n // 6) + '1' + '}]' * (n // 6),
+        'unclosed string': '[{"name":"' + 'a' * n,
+        'quotes': '"' * n,
+        'many numbered lines': '\n'.join('1. x' for _ in range(n // 5)),
+        'long spaced line': '1.' + ' ' * n + 'x',
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LLM response parser corpus, fuzz and timing')
+    parser.add_argument('--mutations', type=int, default=1000, help='random corruptions per corpus case')
+    parser.add_argument('--repeat', type=int, default=200, help='timing repetitions per case')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    with open(CORPUS) as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+
+    failures = 0
+    print(f"{'case':<26} {'want':>4} {'new':>4} {'stream':>6} {'old':>6} {'new us':>8} {'old us':>8}")
+    for case in cases:
+        text, expected = case['text'], case['expected']
+        new = count(parse_recipes, text)
+        # The app falls back to the full-text parse when the stream yields nothing
+        stream = len(streamed(text, rng)) or new
+        old = legacy_count(text)
+        new_us = timed(lambda: count(parse_recipes, text), args.repeat) * 1e6
+        old_us = timed(lambda: legacy_count(text), args.repeat) * 1e6
+        ok = new == expected and stream == expected
+        if 'names' in case:
+            ok = ok and names(parse_recipes, text) == case['names'] and \
+                [recipe['name'] for recipe in streamed(text, rng)] == case['names']
+        failures += not ok
+        print(f"{case['case']:<26} {expected:>4} {new:>4} {stream:>6} {old!s:>6} {new_us:>8.1f} {old_us:>8.1f}"
+              f"{'' if ok else '   MISMATCH'}")
+
+    crashes = 0
+    fuzzed = 0
+    for case in cases:
+        text = case['text']
+        variants = [text[:i] for i in range(len(text))]
+        variants += [mutate(text, rng) for _ in range(args.mutations)]
+        for variant in variants:
+            fuzzed += 1
+            try:
+                parse_recipes(variant)
+            except RecipeParseError:
+                pass
+            except Exception as e:
+                crashes += 1
+                if crashes <= 5:
+                    print(f"crash on {variant[:80]!r}: {e!r}")
+    print(f"\nfuzzed {fuzzed} inputs: {crashes} crashes")
+
+    print(f"\n{'pathological input':<22} {'100k ms':>9} {'400k ms':>9} {'ratio':>6}")
+    small, large = pathological(100_000), pathological(400_000)
+    for name in small:
+        t_small = timed(lambda: count(parse_recipes, small[name]), 3) * 1000
+        t_large = timed(lambda: count(parse_recipes, large[name]), 3) * 1000
+        print(f"{name:<22} {t_small:>9.1f} {t_large:>9.1f} {t_large / max(t_small, 1e-6):>6.1f}")
+
+    sys.exit(1 if failures or crashes else 0)
+
+
+if __name__ == '__main__':
+    main()
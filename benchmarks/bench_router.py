@@ -0,0 +1,96 @@
+"""Tail latency of recipe completions with and without the model router's hedging
+
+Starts benchmarks/fake_openrouter.py with a primary model that is usually
+fast but now and then stalls or fails, and a slower but steady alternate,
+then sends the same completions through ModelRouter configured as:
+
+    single     the primary only, no hedging (the old behaviour, plus a timeout)
+    failover   primary, then the alternate on error
+    hedged     failover plus a hedged request after the primary's p95
+               time to first token
+
+No Postgres is needed; the router is driven directly with AsyncOpenAI.
+
+    python benchmarks/bench_router.py --requests 600 --concurrency 30 --stall-rate 0.05
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from openai import AsyncOpenAI
+
+from common import ROOT, python_module, start_process, stop_process, summarize, wait_for
+
+sys.path.insert(0, ROOT)
+# Each failed attempt logs a warning; the summary counts them instead
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+from model_router import ModelRouter  # noqa: E402
+
+FAKE_LLM_PORT = 9101
+PRIMARY = 'bench/primary'
+ALTERNATE = 'bench/alternate'
+
+
+async def drive(router, total, concurrency):
+    client = AsyncOpenAI(base_url=f'http://127.0.0.1:{FAKE_LLM_PORT}/api/v1', api_key='benchmark')
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    messages = [{'role': 'user', 'content': 'Suggest 3 recipes using these ingredients: chicken, rice. Return'}]
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await router.acomplete(client, messages, mode='complete', max_tokens=800)
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Model router tail latency')
+    parser.add_argument('--requests', type=int, default=600)
+    parser.add_argument('--concurrency', type=int, default=30)
+    parser.add_argument('--primary-latency', type=float, default=0.3)
+    parser.add_argument('--alternate-latency', type=float, default=0.8)
+    parser.add_argument('--stall-rate', type=float, default=0.05, help='share of primary requests that stall')
+    parser.add_argument('--error-rate', type=float, default=0.02, help='share of primary requests that 503')
+    parser.add_argument('--stall-latency', type=float, default=12.0)
+    parser.add_argument('--timeout', type=float, default=25.0, help='OPENROUTER_TIMEOUT')
+    args = parser.parse_args()
+
+    fake_llm = start_process(python_module(
+        'benchmarks/fake_openrouter.py', '--port', str(FAKE_LLM_PORT), '--tokens-per-second', '2000',
+        '--slow-latency', str(args.stall_latency),
+        '--model', f'{PRIMARY}={args.primary_latency},{args.stall_rate},{args.error_rate}',
+        '--model', f'{ALTERNATE}={args.alternate_latency}'))
+    configs = {
+        'single': ModelRouter([PRIMARY], timeout=args.timeout),
+        'failover': ModelRouter([PRIMARY, ALTERNATE], timeout=args.timeout, hedge_max_rate=0),
+        'hedged': ModelRouter([PRIMARY, ALTERNATE], timeout=args.timeout),
+    }
+    try:
+        wait_for(f'http://127.0.0.1:{FAKE_LLM_PORT}/')
+        print(f"primary {args.primary_latency}s first token, {args.stall_rate:.0%} stall {args.stall_latency}s, "
+              f"{args.error_rate:.0%} 503; alternate {args.alternate_latency}s")
+        for name, router in configs.items():
+            latencies, errors, elapsed = asyncio.run(drive(router, args.requests, args.concurrency))
+            summarize(name, latencies, errors, elapsed)
+            stats = router.stats()
+            print(f"{'':<28} hedged {stats['hedged']}  hedge wins {stats['hedge_wins']}  "
+                  f"failovers {stats['failovers']}  timeouts {stats['timeouts']}  rejected {stats['rejected']}")
+    finally:
+        stop_process(fake_llm)
+
+
+if __name__ == '__main__':
+    main()
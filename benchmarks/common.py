@@ -0,0 +1,140 @@
+"""Helpers shared by the benchmark scripts"""
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+import bcrypt
+import httpx
+import psycopg2
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET_KEY = os.getenv('SECRET_KEY', 'benchmark-secret-key')
+BENCH_EMAIL = 'bench@example.com'
+BENCH_PASSWORD = 'bench-password'
+
+
+def start_process(args, env=None, cwd=ROOT):
+    """Start a server subprocess with the benchmark environment layered on os.environ"""
+    full_env = dict(os.environ, SECRET_KEY=SECRET_KEY, PYTHONUNBUFFERED='1')
+    full_env.update(env or {})
+    return subprocess.Popen(args, cwd=cwd, env=full_env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def stop_process(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def wait_for(url, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f'{url} did not come up within {timeout}s')
+
+
+def python_module(*args):
+    return [sys.executable, *args]
+
+
+def start_postgres(datadir, port=54329):
+    """Throwaway Postgres cluster in datadir; returns the PG* environment for it
+
+    Needs initdb and pg_ctl on PATH (or in PG_BIN), run as a non-root user.
+    """
+    bindir = os.getenv('PG_BIN', '')
+    initdb, pg_ctl = (os.path.join(bindir, name) if bindir else name for name in ('initdb', 'pg_ctl'))
+    subprocess.run([initdb, '-D', datadir, '-U', 'postgres', '-A', 'trust'],
+                   check=True, stdout=subprocess.DEVNULL)
+    subprocess.run([pg_ctl, '-D', datadir, '-w', '-l', os.path.join(datadir, 'server.log'),
+                    '-o', f"-p {port} -k {datadir} -c listen_addresses='' -c max_connections=200", 'start'],
+                   check=True, stdout=subprocess.DEVNULL)
+    return {'PGHOST': datadir, 'PGPORT': str(port), 'PGUSER': 'postgres', 'PGPASSWORD': '', 'PGDATABASE': 'postgres'}
+
+
+def stop_postgres(datadir):
+    bindir = os.getenv('PG_BIN', '')
+    pg_ctl = os.path.join(bindir, 'pg_ctl') if bindir else 'pg_ctl'
+    subprocess.run([pg_ctl, '-D', datadir, '-m', 'fast', 'stop'], stdout=subprocess.DEVNULL)
+
+
+def run_migrations():
+    subprocess.run(python_module('migrate.py'), cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+
+
+def scrape_metrics(base_url):
+    """{(name, labels): value} from a /metrics endpoint; labels as a sorted tuple of pairs"""
+    samples = {}
+    for line in httpx.get(f'{base_url}/metrics', timeout=10).text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        series, value = line.rsplit(' ', 1)
+        name, _, labels = series.partition('{')
+        pairs = tuple(sorted(tuple(pair.split('=', 1)) for pair in labels.rstrip('}').split(',') if pair))
+        samples[(name, tuple((k, v.strip('"')) for k, v in pairs))] = float(value)
+    return samples
+
+
+def connect():
+    return psycopg2.connect(
+        host=os.getenv('PGHOST'),
+        user=os.getenv('PGUSER'),
+        password=os.getenv('PGPASSWORD'),
+        database=os.getenv('PGDATABASE'),
+        port=os.getenv('PGPORT', 5432),
+    )
+
+
+def ensure_bench_user(password_hash=None):
+    """Create (or refresh) a benchmark user with an active trial; returns its id"""
+    password_hash = password_hash or bcrypt.hashpw(BENCH_PASSWORD.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    conn = connect()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO users (name, email, password, trial_end_date)
+        VALUES ('Bench User', %s, %s, %s)
+        ON CONFLICT (email) DO UPDATE SET trial_end_date = EXCLUDED.trial_end_date, password = EXCLUDED.password
+        RETURNING id
+    """, (BENCH_EMAIL, password_hash, datetime.now() + timedelta(days=14)))
+    user_id = cursor.fetchone()[0]
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return user_id
+
+
+def session_cookie(user_id):
+    """A Flask session cookie value logged in as user_id"""
+    app = Flask('bench')
+    app.secret_key = SECRET_KEY
+    serializer = SecureCookieSessionInterface().get_signing_serializer(app)
+    return serializer.dumps({'user_id': user_id, 'user_name': 'Bench User'})
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+def summarize(name, latencies, errors, elapsed):
+    count = len(latencies) + errors
+    print(f"{name:<28} {count:>6} req  {errors:>4} err  {count / elapsed:>8.1f} req/s  "
+          f"p50 {percentile(latencies, 50) * 1000:>8.1f} ms  "
+          f"p95 {percentile(latencies, 95) * 1000:>8.1f} ms  "
+          f"p99 {percentile(latencies, 99) * 1000:>8.1f} ms")
@@ -0,0 +1,109 @@
+"""Local stand-in for the IntaSend checkout API
+
+    python benchmarks/fake_intasend.py --port 9300 --latency 0.15
+    python benchmarks/fake_intasend.py --port 9300 --ssl-certfile cert.pem --ssl-keyfile key.pem
+
+Point the app at it with INTASEND_BASE_URL=http://127.0.0.1:9300 (or https://
+with INTASEND_CA_BUNDLE=cert.pem). Serving over TLS makes the handshake cost
+that connection reuse saves show up in measurements. --error-rate makes a
+share of responses 503 to exercise client retries. With --webhook-url, every
+checkout is followed --webhook-delay seconds later by a COMPLETE webhook,
+signed with --webhook-secret when one is given.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import random
+import uuid
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+settings = {'latency': 0.15, 'error_rate': 0.0, 'paid': True,
+            'webhook_url': None, 'webhook_delay': 1.0, 'webhook_secret': None}
+checkouts = {}
+_background = set()
+
+
+async def respond(payload, status=200):
+    await asyncio.sleep(settings['latency'])
+    if random.random() < settings['error_rate']:
+        return JSONResponse({'detail': 'Service temporarily unavailable'}, 503)
+    return JSONResponse(payload, status)
+
+
+async def send_webhook(checkout):
+    await asyncio.sleep(settings['webhook_delay'])
+    body = json.dumps({
+        'invoice_id': checkout['id'],
+        'state': 'COMPLETE',
+        'api_ref': checkout['api_ref'],
+        'value': checkout['amount'],
+        'currency': checkout['currency'],
+    }).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    if settings['webhook_secret']:
+        headers['X-IntaSend-Signature'] = hmac.new(settings['webhook_secret'].encode(), body,
+                                                   hashlib.sha256).hexdigest()
+    try:
+        async with httpx.AsyncClient(timeout=10) as client:
+            await client.post(settings['webhook_url'], content=body, headers=headers)
+    except httpx.HTTPError:
+        pass
+
+
+async def create_checkout(request):
+    body = await request.json()
+    checkout_id = uuid.uuid4().hex[:12].upper()
+    checkouts[checkout_id] = {
+        'id': checkout_id,
+        'api_ref': body.get('api_ref'),
+        'amount': body.get('amount'),
+        'currency': body.get('currency', 'KES'),
+        'paid': settings['paid'],
+    }
+    if settings['webhook_url'] and settings['paid']:
+        task = asyncio.create_task(send_webhook(checkouts[checkout_id]))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+    base = str(request.base_url).rstrip('/')
+    return await respond({'id': checkout_id, 'url': f'{base}/checkout/{checkout_id}/',
+                          'api_ref': body.get('api_ref')}, 201)
+
+
+async def checkout_status(request):
+    checkout = checkouts.get(request.path_params['checkout_id'])
+    if checkout is None:
+        return await respond({'detail': 'Not found.'}, 404)
+    return await respond(checkout)
+
+
+app = Starlette(routes=[
+    Route('/api/v1/checkout/', create_checkout, methods=['POST']),
+    Route('/api/v1/checkout/{checkout_id}/', checkout_status, methods=['GET']),
+])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9300)
+    parser.add_argument('--latency', type=float, default=0.15, help='seconds per response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of 503 responses')
+    parser.add_argument('--unpaid', action='store_true', help='report checkouts as not paid')
+    parser.add_argument('--webhook-url', help='send a COMPLETE webhook here after each checkout')
+    parser.add_argument('--webhook-delay', type=float, default=1.0)
+    parser.add_argument('--webhook-secret')
+    parser.add_argument('--ssl-certfile')
+    parser.add_argument('--ssl-keyfile')
+    args = parser.parse_args()
+    settings.update(latency=args.latency, error_rate=args.error_rate, paid=not args.unpaid,
+                    webhook_url=args.webhook_url, webhook_delay=args.webhook_delay,
+                    webhook_secret=args.webhook_secret)
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning',
+                ssl_certfile=args.ssl_certfile, ssl_keyfile=args.ssl_keyfile)
@@ -0,0 +1,141 @@
+"""Local stand-in for the OpenRouter chat completions API
+
+    python benchmarks/fake_openrouter.py --port 9100 --latency 2.0 --tokens-per-second 50
+
+Point the app at it with OPENROUTER_BASE_URL=http://127.0.0.1:9100/api/v1.
+Supports plain and stream=True completions and response_format, and reports
+token usage.
+
+Providers can be made to misbehave per model, to exercise the model router:
+
+    --model fast/model=0.2 --model flaky/model=0.5,0.05,0.1 --slow-latency 15
+
+gives fast/model a 0.2s first token, and flaky/model a 0.5s first token
+that 5% of the time takes --slow-latency seconds instead and 10% of the time
+answers 503. Models without a --model entry use --latency.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+settings = {'latency': 2.0, 'tokens_per_second': 50.0, 'slow_latency': 15.0, 'models': {}}
+
+
+def recipes_for(prompt, response_format=None):
+    ingredients = prompt.split('ingredients:', 1)[-1].split('. Return', 1)[0].strip() or 'pantry'
+    recipes = [
+        {
+            'name': f'Recipe {n} with {ingredients}',
+            'ingredients': [*ingredients.split(', '), 'salt', 'olive oil'],
+            'instructions': 'Prepare the ingredients. Cook over medium heat until done. Season and serve.',
+        }
+        for n in range(1, 4)
+    ]
+    # Structured-output mode answers with the schema's wrapper object
+    if response_format:
+        return json.dumps({'recipes': recipes}, indent=2)
+    return json.dumps(recipes, indent=2)
+
+
+def usage(prompt, content):
+    prompt_tokens = max(1, len(prompt) // 4)
+    completion_tokens = max(1, len(content) // 4)
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens,
+    }
+
+
+def first_token_delay(model):
+    """(seconds before output, whether to fail) for one request to model"""
+    latency, slow_rate, error_rate = settings['models'].get(model, (settings['latency'], 0.0, 0.0))
+    if random.random() < error_rate:
+        return latency, True
+    if random.random() < slow_rate:
+        return settings['slow_latency'], False
+    return latency, False
+
+
+async def chat_completions(request):
+    body = await request.json()
+    delay, fail = first_token_delay(body['model'])
+    if fail:
+        await asyncio.sleep(delay)
+        return JSONResponse({'error': {'message': 'Provider returned error', 'code': 503}}, 503)
+    prompt = body['messages'][-1]['content']
+    content = recipes_for(prompt, body.get('response_format'))
+    completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+    created = int(time.time())
+    tokens = len(content) // 4
+    rate = settings['tokens_per_second']
+
+    if not body.get('stream'):
+        await asyncio.sleep(delay + tokens / rate)
+        return JSONResponse({
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': created,
+            'model': body['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': content}}],
+            'usage': usage(prompt, content),
+        })
+
+    async def events():
+        await asyncio.sleep(delay)
+        for start in range(0, len(content), 16):
+            piece = content[start:start + 16]
+            chunk = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': created,
+                'model': body['model'],
+                'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}],
+            }
+            yield f'data: {json.dumps(chunk)}\n\n'
+            await asyncio.sleep(4 / rate)
+        final = {
+            'id': completion_id,
+            'object': 'chat.completion.chunk',
+            'created': created,
+            'model': body['model'],
+            'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}],
+            'usage': usage(prompt, content),
+        }
+        yield f'data: {json.dumps(final)}\n\n'
+        yield 'data: [DONE]\n\n'
+
+    return StreamingResponse(events(), media_type='text/event-stream')
+
+
+app = Starlette(routes=[
+    Route('/api/v1/chat/completions', chat_completions, methods=['POST']),
+    Route('/v1/chat/completions', chat_completions, methods=['POST']),
+])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--latency', type=float, default=2.0, help='seconds before the first token')
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--model', action='append', default=[], metavar='NAME=LATENCY[,SLOW_RATE[,ERROR_RATE]]',
+                        help='per-model first-token latency, share of slow requests and share of 503s')
+    parser.add_argument('--slow-latency', type=float, default=15.0, help='first-token seconds of a slow request')
+    args = parser.parse_args()
+    settings.update(latency=args.latency, tokens_per_second=args.tokens_per_second, slow_latency=args.slow_latency)
+    for spec in args.model:
+        name, _, values = spec.partition('=')
+        latency, slow_rate, error_rate = [*map(float, values.split(',')), 0.0, 0.0][:3]
+        settings['models'][name] = (latency, slow_rate, error_rate)
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
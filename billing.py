@@ -0,0 +1,106 @@
+"""Subscription activation for completed payments"""
+from account import forget_account_state
+from db import get_cursor
+from entitlements import entitlement_cache
+
+# One statement, one round trip. The payment row is the idempotency claim:
+# either the checkout's row flips to completed (its row lock
+# serializes concurrent activations, and a loser re-checks status and
+# matches nothing), or a completed row is inserted, where the unique index
+# on transaction_id turns a concurrent duplicate into a no-op. Subscriptions
+# are only cancelled and created when this statement won the claim. The new
+# subscription id is drawn up front so the claimed payment can point at it.
+# Rows the reconciler marked expired or failed are claimed too: a late
+# success from the provider is still a payment.
+ACTIVATE_SQL = """
+    WITH plan AS (
+        SELECT id, price, duration_days FROM subscription_plans WHERE id = %(plan_id)s
+    ),
+    ids AS (
+        SELECT nextval(pg_get_serial_sequence('subscriptions', 'id')) AS subscription_id
+    ),
+    claimed AS (
+        UPDATE payments p
+        SET status = 'completed', subscription_id = ids.subscription_id,
+            checkout_id = COALESCE(p.checkout_id, %(checkout_id)s), updated_at = NOW()
+        FROM ids, plan
+        WHERE p.transaction_id = %(ref)s AND p.user_id = %(user_id)s AND p.status IS DISTINCT FROM 'completed'
+        RETURNING p.id
+    ),
+    inserted AS (
+        INSERT INTO payments (user_id, subscription_id, plan_id, amount, status, payment_method,
+                              transaction_id, checkout_id, created_at, updated_at)
+        SELECT %(user_id)s, ids.subscription_id, plan.id, COALESCE(NULLIF(%(amount)s::numeric, 0), plan.price),
+               'completed', 'intasend', %(ref)s, %(checkout_id)s, NOW(), NOW()
+        FROM ids, plan
+        WHERE NOT EXISTS (SELECT 1 FROM payments WHERE transaction_id = %(ref)s)
+        ON CONFLICT (transaction_id) DO NOTHING
+        RETURNING id
+    ),
+    payment AS (
+        SELECT id FROM claimed UNION ALL SELECT id FROM inserted
+    ),
+    cancelled AS (
+        UPDATE subscriptions
+        SET status = 'cancelled', updated_at = NOW()
+        WHERE user_id = %(user_id)s AND status IN ('active', 'trial')
+          AND EXISTS (SELECT 1 FROM payment)
+        RETURNING id
+    ),
+    subscription AS (
+        INSERT INTO subscriptions (id, user_id, plan_id, status, start_date, end_date, created_at, updated_at)
+        SELECT ids.subscription_id, %(user_id)s, plan.id, 'active', NOW(),
+               NOW() + plan.duration_days * INTERVAL '1 day', NOW(), NOW()
+        FROM ids, plan
+        WHERE EXISTS (SELECT 1 FROM payment)
+        RETURNING id, end_date
+    )
+    SELECT EXISTS (SELECT 1 FROM plan) AS plan_found,
+           (SELECT id FROM payment) AS payment_id,
+           (SELECT id FROM subscription) AS subscription_id,
+           (SELECT end_date FROM subscription) AS end_date,
+           (SELECT COUNT(*) FROM cancelled) AS cancelled
+"""
+
+
+def activate_subscription(user_id, plan_id, amount, reference, checkout_id=None):
+    """Complete the payment for `reference` and activate plan_id for the user
+
+    `reference` is the checkout's api_ref (the transaction_id of its pending
+    payment). Safe to call any number of times, concurrently, from every
+    entry point: exactly one call activates. Returns a dict whose 'status'
+    is 'activated', 'duplicate' (already completed), 'plan_not_found' or
+    'unclaimed' (the reference's payment row is another user's).
+    """
+    with get_cursor() as cursor:
+        cursor.execute(ACTIVATE_SQL, {
+            'user_id': user_id,
+            'plan_id': plan_id,
+            'amount': amount or 0,
+            'ref': reference,
+            'checkout_id': checkout_id,
+        })
+        row = cursor.fetchone()
+        completed = False
+        if row['plan_found'] and row['subscription_id'] is None:
+            # A new statement sees a concurrent activation that just won the claim
+            cursor.execute("""
+                SELECT EXISTS (SELECT 1 FROM payments WHERE transaction_id = %s AND status = 'completed')
+                    AS completed
+            """, (reference,))
+            completed = cursor.fetchone()['completed']
+
+    if not row['plan_found']:
+        return {'status': 'plan_not_found'}
+    if row['subscription_id'] is None:
+        return {'status': 'duplicate' if completed else 'unclaimed'}
+
+    entitlement_cache.invalidate(user_id)
+    forget_account_state(user_id)
+    return {
+        'status': 'activated',
+        'payment_id': row['payment_id'],
+        'subscription_id': row['subscription_id'],
+        'end_date': row['end_date'],
+        'cancelled': row['cancelled'],
+    }
@@ -0,0 +1,58 @@
+-- Tables previously created by app.setup_database()
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    email VARCHAR(255) UNIQUE NOT NULL,
+    password VARCHAR(255) NOT NULL,
+    trial_end_date TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS subscription_plans (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    price DECIMAL(10,2) NOT NULL,
+    duration_days INTEGER NOT NULL,
+    is_active BOOLEAN DEFAULT TRUE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS subscriptions (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id),
+    plan_id INTEGER REFERENCES subscription_plans(id),
+    status VARCHAR(50) NOT NULL,
+    start_date TIMESTAMP,
+    end_date TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS payments (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id),
+    subscription_id INTEGER REFERENCES subscriptions(id),
+    plan_id INTEGER REFERENCES subscription_plans(id),
+    amount DECIMAL(10,2),
+    status VARCHAR(50),
+    payment_method VARCHAR(50),
+    transaction_id VARCHAR(255),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS recipes (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id),
+    recipe_name VARCHAR(255) NOT NULL,
+    ingredients TEXT,
+    instructions TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Default subscription plans (subscription_plans has no unique key, so
+-- ON CONFLICT cannot be used to keep this idempotent)
+INSERT INTO subscription_plans (name, price, duration_days)
+SELECT name, price, duration_days
+FROM (VALUES ('Monthly', 999.00, 30), ('Yearly', 9999.00, 365)) AS p(name, price, duration_days)
+WHERE NOT EXISTS (SELECT 1 FROM subscription_plans);
@@ -0,0 +1,19 @@
+-- Persistent tier of recipe_cache.RecommendationCache
+CREATE TABLE IF NOT EXISTS recommendation_cache (
+    cache_key CHAR(64) PRIMARY KEY,
+    model VARCHAR(255) NOT NULL,
+    ingredients TEXT NOT NULL,
+    recipes JSONB NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
+
+-- Cross-worker claims and results for singleflight.SingleFlight
+CREATE TABLE IF NOT EXISTS inflight_recommendations (
+    cache_key CHAR(64) PRIMARY KEY,
+    owner VARCHAR(255) NOT NULL,
+    started_at TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP,
+    result JSONB,
+    error TEXT
+);
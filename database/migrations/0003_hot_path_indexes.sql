@@ -0,0 +1,29 @@
+-- migrate: no-transaction
+-- Indexes for the per-request queries. Built CONCURRENTLY so deploying
+-- them does not block writes on live tables.
+
+-- recipe_store.recipe_history: keyset pagination, newest first
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_recipes_user_created_id
+    ON recipes (user_id, created_at DESC, id DESC);
+
+-- Entitlement check: active subscriptions that have not ended yet
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_subscriptions_user_active_end
+    ON subscriptions (user_id, end_date)
+    WHERE status = 'active';
+
+-- Latest subscription for index/profile/subscription pages
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_subscriptions_user_created
+    ON subscriptions (user_id, created_at DESC);
+
+-- Idempotency checks and webhook lookups by checkout reference
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_payments_transaction_id
+    ON payments (transaction_id);
+
+-- payment_callback: the user's latest pending checkout
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_payments_user_pending
+    ON payments (user_id, created_at DESC)
+    WHERE status = 'pending';
+
+-- RecommendationCache.purge_expired
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_recommendation_cache_expires
+    ON recommendation_cache (expires_at);
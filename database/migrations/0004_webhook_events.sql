@@ -0,0 +1,20 @@
+-- Append-only inbox for provider webhooks, drained by webhook_queue.py.
+-- status: pending -> processed | ignored | dead
+CREATE TABLE IF NOT EXISTS webhook_events (
+    id BIGSERIAL PRIMARY KEY,
+    provider VARCHAR(50) NOT NULL,
+    event_id VARCHAR(255) NOT NULL,
+    payload JSONB NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    processed_at TIMESTAMP,
+    UNIQUE (provider, event_id)
+);
+
+-- Worker claim query: due pending events, oldest first
+CREATE INDEX IF NOT EXISTS idx_webhook_events_due
+    ON webhook_events (next_attempt_at, id)
+    WHERE status = 'pending';
@@ -0,0 +1,9 @@
+-- migrate: no-transaction
+-- IntaSend checkout id of each payment, so reconcile.py can look up the
+-- status of pending payments without waiting for a callback or webhook.
+ALTER TABLE payments ADD COLUMN IF NOT EXISTS checkout_id VARCHAR(255);
+
+-- reconcile.py: keyset scan over pending payments
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_payments_pending_id
+    ON payments (id)
+    WHERE status = 'pending';
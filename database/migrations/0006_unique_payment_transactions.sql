@@ -0,0 +1,20 @@
+-- migrate: no-transaction
+-- One payment row per checkout reference: the idempotency key for
+-- billing.activate_subscription. Existing duplicates keep their rows, but all
+-- except the completed (else newest) one get a suffixed reference so the
+-- unique index can be built. A NULL status counts as not completed, so the
+-- comparison is never NULL and every duplicate but one is renamed.
+UPDATE payments p
+SET transaction_id = p.transaction_id || '#' || p.id
+WHERE p.transaction_id IS NOT NULL
+  AND EXISTS (
+      SELECT 1 FROM payments q
+      WHERE q.transaction_id = p.transaction_id
+        AND (COALESCE(q.status, '') = 'completed', q.id) > (COALESCE(p.status, '') = 'completed', p.id)
+  );
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_payments_transaction_id
+    ON payments (transaction_id);
+
+-- Superseded by the unique index
+DROP INDEX CONCURRENTLY IF EXISTS idx_payments_transaction_id;
@@ -0,0 +1,8 @@
+-- Failed-login counts for auth.py's throttle, one row per key:
+-- 'email:<address>' or 'address:<client ip>'. A row whose window has
+-- passed is reset by the next failure, or deleted on successful login.
+CREATE TABLE IF NOT EXISTS login_failures (
+    key VARCHAR(320) PRIMARY KEY,
+    failures INTEGER NOT NULL DEFAULT 0,
+    first_failed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,10 @@
+-- Token buckets for spend_limiter.py, shared by every worker: one row per
+-- 'user:<id>' plus 'global'. Levels are stored as of updated_at; the refill
+-- since then is added when a request takes from the bucket. tokens goes
+-- negative when a request used more than was reserved for it.
+CREATE TABLE IF NOT EXISTS llm_spend_buckets (
+    key VARCHAR(64) PRIMARY KEY,
+    requests DOUBLE PRECISION NOT NULL,
+    tokens DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
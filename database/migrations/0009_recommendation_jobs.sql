@@ -0,0 +1,19 @@
+-- Background recommendation jobs (recommendation_jobs.py).
+-- status: queued -> running -> done | failed
+-- Queue time is started_at - submitted_at, run time finished_at - started_at.
+CREATE TABLE IF NOT EXISTS recommendation_jobs (
+    id UUID PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    ingredients TEXT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    result JSONB,
+    error TEXT,
+    error_status INTEGER,
+    submitted_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+-- Retention purge
+CREATE INDEX IF NOT EXISTS idx_recommendation_jobs_submitted
+    ON recommendation_jobs (submitted_at);
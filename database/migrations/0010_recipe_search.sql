@@ -0,0 +1,24 @@
+-- migrate: no-transaction
+-- Search over saved recipes (recipe_store.search_recipes). btree_gin lets
+-- user_id share a GIN index with the tsvector and trigram columns, so a
+-- search only visits the user's own rows.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+-- Name weighs most, then ingredients, then instructions. Adding a stored
+-- generated column rewrites the table once, under an exclusive lock: run
+-- this migration in a quiet period on large deployments.
+ALTER TABLE recipes ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(recipe_name, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(ingredients, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(instructions, '')), 'C')
+    ) STORED;
+
+-- Ranked full-text matches within one user's recipes
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_recipes_user_search
+    ON recipes USING GIN (user_id, search_vector);
+
+-- Typo-tolerant name lookup within one user's recipes
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_recipes_user_name_trgm
+    ON recipes USING GIN (user_id, recipe_name gin_trgm_ops);
@@ -0,0 +1,3 @@
+-- HTTP status of a failed single-flight leader, so waiters in other
+-- workers report the same error the leader's own request did
+ALTER TABLE inflight_recommendations ADD COLUMN IF NOT EXISTS error_status INTEGER;
@@ -1,52 +0,0 @@
--- Add subscription plans table
-CREATE TABLE subscription_plans IF NOT EXISTS(
-    id INT AUTO_INCREMENT PRIMARY KEY,
-    name VARCHAR(100) NOT NULL,
-    price DECIMAL(10, 2) NOT NULL,
-    duration_days INT NOT NULL,
-    is_active BOOLEAN DEFAULT TRUE,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
-
--- Add subscriptions table
-CREATE TABLE subscriptions IF NOT EXISTS(
-    id INT AUTO_INCREMENT PRIMARY KEY,
-    user_id INT NOT NULL,
-    plan_id INT NOT NULL,
-    status ENUM('active', 'canceled', 'expired', 'trial') DEFAULT 'trial',
-    start_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    end_date TIMESTAMP NULL,
-    stripe_subscription_id VARCHAR(255) NULL,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
-    FOREIGN KEY (plan_id) REFERENCES subscription_plans(id)
-);
-
--- Add payments table
-CREATE TABLE payments IF NOT EXISTS(
-    id INT AUTO_INCREMENT PRIMARY KEY,
-    user_id INT NOT NULL,
-    subscription_id INT NOT NULL,
-    amount DECIMAL(10, 2) NOT NULL,
-    status ENUM('pending', 'completed', 'failed') DEFAULT 'pending',
-    payment_method VARCHAR(100) NULL,
-    transaction_id VARCHAR(255) NULL,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
-    FOREIGN KEY (subscription_id) REFERENCES subscriptions(id)
-);
-
--- Insert default subscription plans
-INSERT INTO subscription_plans (name, price, duration_days) VALUES
-('Monthly', 4.99, 30),
-('Annual', 49.99, 365);
-
--- Add trial_end_date to users table
-ALTER TABLE users ADD COLUMN trial_end_date TIMESTAMP NULL AFTER password;
-
--- Update subscription_plans table
-ALTER TABLE subscription_plans ADD COLUMN IF NOT EXISTS is_active BOOLEAN DEFAULT TRUE;
-
--- Update payments table  
-ALTER TABLE payments ADD COLUMN IF NOT EXISTS transaction_id VARCHAR(255);
\ No newline at end of file
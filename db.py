@@ -0,0 +1,215 @@
+"""Pooled PostgreSQL connections shared by every route in a worker process"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection frees up within PG_POOL_TIMEOUT seconds"""
+
+
+def connection_params():
+    """Connection settings read from the standard libpq environment variables"""
+    return {
+        'host': os.getenv('PGHOST'),
+        'user': os.getenv('PGUSER'),
+        'password': os.getenv('PGPASSWORD'),
+        'database': os.getenv('PGDATABASE'),
+        'port': os.getenv('PGPORT', 5432),
+    }
+
+
+_query_observers = []
+
+
+def observe_queries(fn):
+    """Call fn(seconds) after every statement run on a pooled connection"""
+    _query_observers.append(fn)
+
+
+class TimedCursor(RealDictCursor):
+    """RealDictCursor that reports each statement's duration to the query observers"""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            elapsed = time.perf_counter() - started
+            for fn in _query_observers:
+                fn(elapsed)
+
+
+class ConnectionPool:
+    """Bounded, thread-safe psycopg2 pool with health checks on checkout"""
+
+    def __init__(self, minconn, maxconn, timeout=10.0, idle_check_after=30.0):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.idle_check_after = idle_check_after
+        self._pool = ThreadedConnectionPool(minconn, maxconn,
+                                            cursor_factory=TimedCursor,
+                                            **connection_params())
+        # ThreadedConnectionPool raises as soon as it is exhausted; the
+        # semaphore makes callers queue for a free slot instead.
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._stats = {
+            'checkouts': 0,
+            'in_use': 0,
+            'timeouts': 0,
+            'discarded': 0,
+            'wait_seconds_total': 0.0,
+        }
+
+    def getconn(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise PoolTimeout(f'No database connection available after {self.timeout}s')
+
+        try:
+            conn = self._pool.getconn()
+            discarded = 0
+            # After a server restart every idle connection is dead; keep
+            # checking replacements until one answers
+            while not self._is_healthy(conn):
+                with self._lock:
+                    self._stats['discarded'] += 1
+                    self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+                discarded += 1
+                if discarded > self.maxconn:
+                    # Even a freshly opened connection failed
+                    raise psycopg2.OperationalError('No healthy database connection')
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+            self._stats['wait_seconds_total'] += time.monotonic() - started
+        return conn
+
+    def putconn(self, conn):
+        close = bool(conn.closed)
+        if not close and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close = True
+
+        with self._lock:
+            self._stats['in_use'] -= 1
+            if close:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+        self._pool.putconn(conn, close=close)
+        self._slots.release()
+
+    def _is_healthy(self, conn):
+        """Cheap liveness check; only round-trips for connections idle a while"""
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.idle_check_after:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        checkouts = stats['checkouts']
+        stats.update({
+            'pid': os.getpid(),
+            'min': self.minconn,
+            'max': self.maxconn,
+            'idle': len(self._pool._pool),
+            'open': len(self._pool._pool) + len(self._pool._used),
+            'avg_wait_ms': round(stats.pop('wait_seconds_total') * 1000 / checkouts, 3) if checkouts else 0.0,
+        })
+        return stats
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return this worker's pool, creating it lazily after gunicorn forks"""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            # A pool inherited across fork shares sockets with the parent, so
+            # it is dropped rather than closed.
+            _pool = ConnectionPool(
+                minconn=int(os.getenv('PG_POOL_MIN', 1)),
+                maxconn=int(os.getenv('PG_POOL_MAX', 10)),
+                timeout=float(os.getenv('PG_POOL_TIMEOUT', 10)),
+                idle_check_after=float(os.getenv('PG_POOL_IDLE_CHECK', 30)),
+            )
+            _pool_pid = pid
+    return _pool
+
+
+@contextmanager
+def get_db():
+    """Borrow a pooled connection; commits on success and rolls back on error"""
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        raise
+    finally:
+        pool.putconn(conn)
+
+
+@contextmanager
+def get_cursor():
+    """Shortcut for a RealDictCursor on a pooled connection"""
+    with get_db() as conn:
+        cursor = conn.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
+
+def pool_stats():
+    """Pool statistics for this worker, or None before first use"""
+    if _pool is None or _pool_pid != os.getpid():
+        return None
+    return _pool.stats()
@@ -0,0 +1,156 @@
+"""Two-tier cache of per-user entitlement (trial / paid subscription) state"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # the shared tier is optional
+    redis = None
+
+
+def build_entitlement(trial_end_date, paid_until, now=None):
+    """Compute entitlement from the trial end and latest active subscription end
+
+    Returns a dict with 'active', 'source' ('trial', 'subscription' or None)
+    and 'expires_at' (epoch seconds the entitlement lapses, or None).
+    """
+    now = time.time() if now is None else now
+    candidates = []
+    if trial_end_date and trial_end_date.timestamp() > now:
+        candidates.append(('trial', trial_end_date.timestamp()))
+    if paid_until and paid_until.timestamp() > now:
+        candidates.append(('subscription', paid_until.timestamp()))
+
+    if not candidates:
+        return {'active': False, 'source': None, 'expires_at': None}
+    source, expires_at = max(candidates, key=lambda c: c[1])
+    return {'active': True, 'source': source, 'expires_at': expires_at}
+
+
+class EntitlementCache:
+    """In-process LRU with TTL in front of an optional shared Redis tier
+
+    Entries are never served past their entitlement expiry, so a cached
+    'active' flips to a miss the moment the trial or subscription lapses.
+
+    Inactive entitlements are kept only in the shared tier. Payments are
+    activated in whichever process handles the webhook (usually the
+    webhook_queue worker), and invalidate() can only clear that process's
+    own LRU and the shared tier. Keeping 'inactive' out of every local LRU
+    means no web worker turns away a user who has just paid.
+    """
+
+    def __init__(self, maxsize=10000, ttl=30.0, shared_url=None, shared_ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared_ttl = shared_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._shared = redis.Redis.from_url(shared_url) if (redis and shared_url) else None
+        self._stats = {
+            'local_hits': 0,
+            'shared_hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'invalidations': 0,
+            'shared_errors': 0,
+        }
+
+    def _key(self, user_id):
+        return f'entitlement:{user_id}'
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _usable(self, entitlement, now):
+        expires_at = entitlement.get('expires_at')
+        return not (entitlement['active'] and expires_at is not None and now >= expires_at)
+
+    def get(self, user_id):
+        now = time.time()
+        with self._lock:
+            item = self._entries.get(user_id)
+            if item is not None:
+                entitlement, stored_until = item
+                if now < stored_until and self._usable(entitlement, now):
+                    self._entries.move_to_end(user_id)
+                    self._stats['local_hits'] += 1
+                    return entitlement
+                del self._entries[user_id]
+                self._stats['expired'] += 1
+
+        if self._shared is not None:
+            try:
+                raw = self._shared.get(self._key(user_id))
+            except redis.RedisError:
+                raw = None
+                self._count('shared_errors')
+            if raw is not None:
+                entitlement = json.loads(raw)
+                if self._usable(entitlement, now):
+                    self._store_local(user_id, entitlement, now)
+                    self._count('shared_hits')
+                    return entitlement
+
+        self._count('misses')
+        return None
+
+    def set(self, user_id, entitlement):
+        now = time.time()
+        self._store_local(user_id, entitlement, now)
+        if self._shared is not None:
+            ttl = self._ttl_for(entitlement, now, self.shared_ttl)
+            if ttl > 0:
+                try:
+                    self._shared.set(self._key(user_id), json.dumps(entitlement), px=int(ttl * 1000))
+                except redis.RedisError:
+                    self._count('shared_errors')
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._stats['invalidations'] += 1
+        if self._shared is not None:
+            try:
+                self._shared.delete(self._key(user_id))
+            except redis.RedisError:
+                self._count('shared_errors')
+
+    def _ttl_for(self, entitlement, now, ttl):
+        expires_at = entitlement.get('expires_at')
+        if entitlement['active'] and expires_at is not None:
+            return min(ttl, expires_at - now)
+        return ttl
+
+    def _store_local(self, user_id, entitlement, now):
+        if not entitlement['active']:
+            return
+        ttl = self._ttl_for(entitlement, now, self.ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (entitlement, now + ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['local_hits'] + stats['shared_hits']) / lookups, 4) if lookups else 0.0
+        stats['shared_tier'] = self._shared is not None
+        return stats
+
+
+entitlement_cache = EntitlementCache(
+    maxsize=int(os.getenv('ENTITLEMENT_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('ENTITLEMENT_CACHE_TTL', 30)),
+    shared_url=os.getenv('ENTITLEMENT_REDIS_URL', os.getenv('REDIS_URL')),
+    shared_ttl=float(os.getenv('ENTITLEMENT_SHARED_TTL', 300)),
+)
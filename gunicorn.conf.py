@@ -0,0 +1,26 @@
+"""gunicorn settings, picked up automatically from the working directory"""
+import os
+import shutil
+import tempfile
+
+# Workers write their metrics samples here so /metrics can merge them
+# (see metrics.py). Set before any worker imports prometheus_client.
+metrics_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                                    os.path.join(tempfile.gettempdir(), 'plateful-metrics'))
+
+# Threaded workers, so a job long-poll (up to JOB_MAX_WAIT seconds) or a
+# slow generation holds a thread rather than the whole worker. asgi.py's
+# `-k uvicorn.workers.UvicornWorker` on the command line overrides this.
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+
+def on_starting(server):
+    # Samples from a previous run would be merged into this one's
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
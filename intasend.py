@@ -0,0 +1,151 @@
+"""IntaSend API client with a pooled keep-alive session
+
+One client per worker process reuses TLS connections to IntaSend instead of
+handshaking on every call. Test/live mode, keys and base URL are resolved
+once, when this module is imported.
+"""
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import observe_intasend
+
+SANDBOX_URL = "https://sandbox.intasend.com"
+LIVE_URL = "https://payment.intasend.com"
+
+# (connect, read) seconds per endpoint
+TIMEOUTS = {
+    'checkout': (float(os.getenv('INTASEND_CONNECT_TIMEOUT', 5)), float(os.getenv('INTASEND_CHECKOUT_TIMEOUT', 30))),
+    'checkout_status': (float(os.getenv('INTASEND_CONNECT_TIMEOUT', 5)), float(os.getenv('INTASEND_STATUS_TIMEOUT', 10))),
+}
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def resolve_settings():
+    """(is_test, base_url, public_key, secret_key) for the configured IntaSend mode"""
+    is_test = os.getenv('INTASEND_TEST_MODE', 'true').lower() == 'true'
+
+    # Set the correct base URL and keys
+    if is_test:
+        base_url = SANDBOX_URL
+        public_key = os.getenv('INTASEND_PUBLIC_KEY_TEST', os.getenv('INTASEND_PUBLIC_KEY'))
+        secret_key = os.getenv('INTASEND_SECRET_KEY_TEST', os.getenv('INTASEND_SECRET_KEY'))
+    else:
+        base_url = LIVE_URL
+        public_key = os.getenv('INTASEND_PUBLIC_KEY_LIVE', os.getenv('INTASEND_PUBLIC_KEY'))
+        secret_key = os.getenv('INTASEND_SECRET_KEY_LIVE', os.getenv('INTASEND_SECRET_KEY'))
+
+    # A local fake (benchmarks/fake_intasend.py) can stand in for either mode
+    base_url = os.getenv('INTASEND_BASE_URL', base_url).rstrip('/')
+
+    return is_test, base_url, public_key, secret_key
+
+
+SETTINGS = resolve_settings()
+
+
+class IntaSendClient:
+    """Checkout calls over one keep-alive session
+
+    Only idempotent calls (GETs) are retried, on connection errors and
+    429/5xx responses, with full-jitter exponential backoff. Creating a
+    checkout is never retried, since a lost response may still have created it.
+    """
+
+    def __init__(self, base_url, public_key, secret_key, is_test=True,
+                 pool_size=10, retries=2, backoff=0.25, max_backoff=2.0, verify=True):
+        self.base_url = base_url
+        self.public_key = public_key
+        self.is_test = is_test
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        self.session.auth = (public_key, secret_key)
+        self.session.headers.update({'Content-Type': 'application/json', 'Accept': 'application/json'})
+        # Passed per request: REQUESTS_CA_BUNDLE would override session.verify
+        self.verify = verify
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'retries': 0, 'errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _sleep(self, attempt):
+        time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def _request(self, method, path, endpoint, idempotent, **kwargs):
+        url = f"{self.base_url}{path}"
+        attempts = self.retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            self._count('requests')
+            last = attempt == attempts - 1
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=TIMEOUTS[endpoint], verify=self.verify, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                observe_intasend(endpoint, 'error', time.perf_counter() - started)
+                self._count('errors')
+                if last:
+                    raise
+            else:
+                observe_intasend(endpoint, response.status_code, time.perf_counter() - started)
+                if response.status_code not in RETRY_STATUSES or last:
+                    return response
+            self._count('retries')
+            self._sleep(attempt)
+
+    def create_checkout(self, body):
+        """POST a checkout; returns the raw response"""
+        return self._request('POST', '/api/v1/checkout/', 'checkout', idempotent=False, json=body)
+
+    def checkout_status(self, checkout_id):
+        """GET the state of a checkout; returns the raw response"""
+        return self._request('GET', f'/api/v1/checkout/{checkout_id}/', 'checkout_status', idempotent=True)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """This worker's client, created lazily so sessions are never shared across fork"""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            is_test, base_url, public_key, secret_key = SETTINGS
+            _client = IntaSendClient(
+                base_url, public_key, secret_key, is_test=is_test,
+                pool_size=int(os.getenv('INTASEND_POOL_SIZE', 10)),
+                retries=int(os.getenv('INTASEND_RETRIES', 2)),
+                verify=os.getenv('INTASEND_CA_BUNDLE', True),
+            )
+            _client_pid = pid
+    return _client
+
+
+def client_stats():
+    """Client statistics for this worker, or None before first use"""
+    if _client is None or _client_pid != os.getpid():
+        return None
+    return _client.stats()
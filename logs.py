@@ -0,0 +1,220 @@
+"""Structured JSON logging that never blocks the request thread
+
+    from logs import get_logger
+    log = get_logger('payments')
+    log.info("Payment activated", extra={'user_id': user_id, 'subscription_id': sid})
+
+Records go onto a bounded in-memory queue and a background thread formats
+them as one JSON object per line on stdout. When the queue is full, records
+are dropped and counted rather than waited on. Fields passed with `extra`
+become keys of the JSON object; secrets are replaced and emails masked on
+the way out, in both fields and messages.
+
+Configuration, read once at import:
+
+    LOG_LEVEL      default level for every category (INFO)
+    LOG_LEVELS     per-category overrides, e.g. "webhooks=DEBUG,cache=WARNING"
+    LOG_SAMPLE     share of DEBUG/INFO records kept per category, e.g.
+                   "recommendations=0.1"; warnings and errors are never sampled
+    LOG_QUEUE_SIZE queue capacity (10000)
+"""
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import traceback
+from logging.handlers import QueueHandler, QueueListener
+
+ROOT_LOGGER = 'plateful'
+
+# Whole words of a key ('access_token', 'X-Api-Key', 'clientSecret'), so
+# counters such as 'prompt_tokens' are not mistaken for credentials
+SECRET_KEYS = re.compile(r'(^|[_\-. ])(pass(word|wd)?|secret|token|api[_\-]?key|authorization|cookie|signature|'
+                         r'credentials?)($|[_\-. ])', re.IGNORECASE)
+_CAMEL_RE = re.compile(r'(?<=[a-z0-9])(?=[A-Z])')
+PII_KEYS = re.compile(r'^(email|user_email|user_name|phone(_number)?|first_name|last_name|address)$', re.IGNORECASE)
+EMAIL_RE = re.compile(r'([A-Za-z0-9._%+-])[A-Za-z0-9._%+-]*@([A-Za-z0-9.-]+\.[A-Za-z]{2,})')
+SECRET_VALUE_RE = re.compile(r'\b(ISSecretKey_\w+|ISPubKey_\w+|sk-[A-Za-z0-9_-]{8,}|Bearer\s+[A-Za-z0-9._~+/=-]+)')
+
+# Attributes every LogRecord has; anything else came in through `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+REDACTED = '[redacted]'
+
+
+def _parse_pairs(value):
+    pairs = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            key, val = item.split('=', 1)
+            pairs[key.strip()] = val.strip()
+    return pairs
+
+
+def mask_email(match):
+    return f"{match.group(1)}***@{match.group(2)}"
+
+
+def redact_text(text):
+    text = SECRET_VALUE_RE.sub(REDACTED, text)
+    return EMAIL_RE.sub(mask_email, text)
+
+
+def redact(value, key=None):
+    """Copy of a field value with secrets removed and PII masked"""
+    if key is not None:
+        if SECRET_KEYS.search(_CAMEL_RE.sub('_', key)):
+            return REDACTED
+        if PII_KEYS.match(key):
+            return redact_text(str(value)) if '@' in str(value) else REDACTED
+    if isinstance(value, dict):
+        return {k: redact(v, str(k)) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    if isinstance(value, str):
+        return redact_text(value)
+    return value
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record: ts, level, category, msg, fields, exc"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'category': record.name.split('.', 1)[-1],
+            'msg': redact_text(record.getMessage()),
+            'pid': record.process,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key not in entry:
+                entry[key] = redact(value, key)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = ''.join(traceback.format_exception(*record.exc_info))
+        if record.exc_text:
+            entry['exc'] = redact_text(record.exc_text)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a share of DEBUG/INFO records for sampled categories"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.sampled_out = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.name.split('.', 1)[-1])
+        if rate is None or random.random() < rate:
+            return True
+        self.sampled_out += 1
+        return False
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Enqueues without waiting; one listener thread per process
+
+    The listener is (re)started lazily in the emitting process, since a
+    thread started before gunicorn forks does not exist in the workers.
+    """
+
+    def __init__(self, stream, maxsize):
+        super().__init__(queue.Queue(maxsize))
+        self.stream = stream
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._start_lock:
+            if self._pid == pid:
+                return
+            # Anything queued before a fork belongs to the parent
+            self.queue = queue.Queue(self.maxsize)
+            output = logging.StreamHandler(self.stream)
+            output.setFormatter(JSONFormatter())
+            self._listener = QueueListener(self.queue, output)
+            self._listener.start()
+            self._pid = pid
+
+    def prepare(self, record):
+        # JSON encoding and redaction happen on the listener thread. Only
+        # what may change after the call returns is resolved here: the
+        # message arguments and the live traceback.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = ''.join(traceback.format_exception(*record.exc_info))
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def emit(self, record):
+        self._ensure_listener()
+        super().emit(record)
+
+    def stop(self):
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._pid = None
+
+
+_handler = None
+_sampler = None
+
+
+def configure():
+    """Install the queue handler on the application's root logger (idempotent)"""
+    global _handler, _sampler
+    if _handler is not None:
+        return
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    root.propagate = False
+
+    for category, level in _parse_pairs(os.getenv('LOG_LEVELS')).items():
+        logging.getLogger(f'{ROOT_LOGGER}.{category}').setLevel(level.upper())
+
+    rates = {category: float(rate) for category, rate in _parse_pairs(os.getenv('LOG_SAMPLE')).items()}
+    _sampler = SamplingFilter(rates)
+    _handler = NonBlockingQueueHandler(sys.stdout, int(os.getenv('LOG_QUEUE_SIZE', 10000)))
+    _handler.addFilter(_sampler)
+    root.addHandler(_handler)
+    atexit.register(_handler.stop)
+
+
+def get_logger(category):
+    """Logger for one category, e.g. 'payments' or 'webhooks'"""
+    configure()
+    return logging.getLogger(f'{ROOT_LOGGER}.{category}')
+
+
+def logging_stats():
+    """Queue depth and records lost to a full queue or to sampling"""
+    if _handler is None:
+        return None
+    return {
+        'queued': _handler.queue.qsize(),
+        'dropped': _handler.dropped,
+        'sampled_out': _sampler.sampled_out,
+    }
@@ -0,0 +1,164 @@
+"""Prometheus metrics, aggregated across gunicorn workers
+
+When PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py sets it for the web
+workers), every process writes its samples to that directory and /metrics
+merges them, so a scrape sees the whole server rather than one worker.
+Without it, metrics are per process.
+"""
+import os
+import time
+
+from flask import g, has_request_context, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+from db import observe_queries, pool_stats
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LLM_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+
+REQUESTS = Counter('http_requests_total', 'HTTP requests by route and status', ['route', 'method', 'status'])
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Time to produce a response',
+                            ['route', 'method'], buckets=LATENCY_BUCKETS)
+
+DB_QUERY_LATENCY = Histogram('db_query_duration_seconds', 'Duration of one SQL statement', buckets=LATENCY_BUCKETS)
+DB_QUERIES_PER_REQUEST = Histogram('db_queries_per_request', 'SQL statements run while handling a request',
+                                   ['route'], buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32))
+DB_TIME_PER_REQUEST = Histogram('db_time_per_request_seconds', 'Total SQL time while handling a request',
+                                ['route'], buckets=LATENCY_BUCKETS)
+POOL_IN_USE = Gauge('db_pool_connections_in_use', 'Pooled connections checked out', multiprocess_mode='livesum')
+POOL_OPEN = Gauge('db_pool_connections_open', 'Pooled connections open', multiprocess_mode='livesum')
+POOL_MAX = Gauge('db_pool_connections_max', 'Pool capacity', multiprocess_mode='livesum')
+POOL_TIMEOUTS = Gauge('db_pool_checkout_timeouts', 'Checkouts that gave up waiting, since worker start',
+                      multiprocess_mode='livesum')
+
+LLM_LATENCY = Histogram('openrouter_request_duration_seconds', 'OpenRouter completion time',
+                        ['model', 'mode', 'outcome'], buckets=LLM_BUCKETS)
+LLM_FIRST_TOKEN = Histogram('openrouter_time_to_first_token_seconds', 'Time to the first streamed token',
+                            ['model'], buckets=LLM_BUCKETS)
+LLM_TOKENS = Counter('openrouter_tokens_total', 'Tokens reported in response.usage', ['model', 'kind'])
+LLM_ROUTING = Counter('openrouter_routing_total', 'Hedged requests, failovers and circuit-breaker rejections',
+                      ['model', 'event'])
+LLM_BREAKER_OPEN = Gauge('openrouter_breaker_open', 'Workers whose circuit breaker for the model is open',
+                         ['model'], multiprocess_mode='livesum')
+LLM_SPEND_DECISIONS = Counter('llm_spend_decisions_total', 'Spend limiter outcomes: admitted or limited_<bucket>',
+                              ['outcome'])
+LLM_GLOBAL_BUDGET = Gauge('llm_spend_global_remaining', 'Global LLM bucket level at the latest decision', ['unit'],
+                          multiprocess_mode='mostrecent')
+
+JOBS = Counter('recommendation_jobs_total', 'Recommendation jobs by outcome: done, failed or rejected', ['outcome'])
+JOB_QUEUE_TIME = Histogram('recommendation_job_queue_seconds', 'Time a job waited for a pool thread',
+                           buckets=LATENCY_BUCKETS)
+JOB_RUN_TIME = Histogram('recommendation_job_run_seconds', 'Time a job ran', buckets=LLM_BUCKETS)
+
+INTASEND_LATENCY = Histogram('intasend_request_duration_seconds', 'IntaSend API call time',
+                             ['endpoint', 'status'], buckets=LATENCY_BUCKETS)
+
+WEBHOOK_EVENTS = Counter('webhook_events_total', 'Queued webhook events handled, by outcome', ['provider', 'outcome'])
+WEBHOOK_LAG = Histogram('webhook_processing_lag_seconds', 'Time from receiving a webhook to finishing it',
+                        ['provider'], buckets=(0.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600, 14400))
+
+
+def registry():
+    """Registry to export: merged across processes in multiprocess mode"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        merged = CollectorRegistry()
+        multiprocess.MultiProcessCollector(merged)
+        return merged
+    return REGISTRY
+
+
+def metrics_response():
+    """(body, content_type) of the Prometheus text exposition"""
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+
+def _observe_query(seconds):
+    DB_QUERY_LATENCY.observe(seconds)
+    if has_request_context() and 'metrics_started' in g:
+        g.db_queries += 1
+        g.db_seconds += seconds
+
+
+observe_queries(_observe_query)
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+    g.db_queries = 0
+    g.db_seconds = 0.0
+
+
+def _after_request(response):
+    if 'metrics_started' in g:
+        route = _route()
+        REQUESTS.labels(route, request.method, response.status_code).inc()
+        REQUEST_LATENCY.labels(route, request.method).observe(time.perf_counter() - g.metrics_started)
+        DB_QUERIES_PER_REQUEST.labels(route).observe(g.db_queries)
+        DB_TIME_PER_REQUEST.labels(route).observe(g.db_seconds)
+
+    stats = pool_stats()
+    if stats:
+        POOL_IN_USE.set(stats['in_use'])
+        POOL_OPEN.set(stats['open'])
+        POOL_MAX.set(stats['max'])
+        POOL_TIMEOUTS.set(stats['timeouts'])
+    return response
+
+
+def instrument_flask(app):
+    """Record latency, status and DB usage for every Flask request
+
+    Streamed responses are timed to their first byte; the body is produced
+    after the request hooks have run.
+    """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+
+def observe_request(route, method, status, seconds):
+    """Route metrics for requests served outside Flask (asgi.py)"""
+    REQUESTS.labels(route, method, status).inc()
+    REQUEST_LATENCY.labels(route, method).observe(seconds)
+
+
+def observe_llm(model, mode, outcome, seconds, first_token=None):
+    """One OpenRouter attempt: outcome is 'ok', 'error' or 'cancelled' (lost a hedge or abandoned)"""
+    LLM_LATENCY.labels(model, mode, outcome).observe(seconds)
+    if first_token is not None:
+        LLM_FIRST_TOKEN.labels(model).observe(first_token)
+
+
+def record_llm_usage(model, usage):
+    if usage is None:
+        return
+    LLM_TOKENS.labels(model, 'prompt').inc(getattr(usage, 'prompt_tokens', 0) or 0)
+    LLM_TOKENS.labels(model, 'completion').inc(getattr(usage, 'completion_tokens', 0) or 0)
+
+
+def observe_spend(outcome, global_levels):
+    LLM_SPEND_DECISIONS.labels(outcome).inc()
+    LLM_GLOBAL_BUDGET.labels('requests').set(global_levels['requests'])
+    LLM_GLOBAL_BUDGET.labels('tokens').set(global_levels['tokens'])
+
+
+def observe_job(outcome, queued=None, ran=None):
+    JOBS.labels(outcome).inc()
+    if queued is not None:
+        JOB_QUEUE_TIME.observe(queued)
+    if ran is not None:
+        JOB_RUN_TIME.observe(ran)
+
+
+def observe_intasend(endpoint, status, seconds):
+    INTASEND_LATENCY.labels(endpoint, status).observe(seconds)
+
+
+def observe_webhook(provider, outcome, lag_seconds):
+    WEBHOOK_EVENTS.labels(provider, outcome).inc()
+    if outcome != 'retried':
+        WEBHOOK_LAG.labels(provider).observe(max(lag_seconds, 0))
@@ -0,0 +1,146 @@
+"""Versioned, idempotent schema migrations
+
+    python migrate.py            # apply pending migrations
+    python migrate.py --status   # list applied and pending migrations
+
+Migrations are the numbered .sql files in database/migrations, applied in
+order and recorded in schema_migrations. A file whose first line is
+"-- migrate: no-transaction" runs statement by statement in autocommit mode,
+which CREATE INDEX CONCURRENTLY requires. The whole run holds an advisory
+lock, so concurrent deploys apply each migration once. The Procfile runs this
+in the release phase, before any web worker boots.
+"""
+import argparse
+import hashlib
+import os
+import re
+
+import psycopg2
+
+from db import connection_params
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database', 'migrations')
+MIGRATION_LOCK_ID = 7270010
+NO_TRANSACTION = '-- migrate: no-transaction'
+
+_FILENAME_RE = re.compile(r'^(\d+)_(\w+)\.sql$')
+_CONCURRENT_INDEX_RE = re.compile(r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)', re.IGNORECASE)
+
+
+def discover():
+    """Migration files in version order"""
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = _FILENAME_RE.match(filename)
+        if not match:
+            continue
+        with open(os.path.join(MIGRATIONS_DIR, filename), encoding='utf-8') as f:
+            sql = f.read()
+        migrations.append({
+            'version': match.group(1),
+            'name': match.group(2),
+            'sql': sql,
+            'checksum': hashlib.sha256(sql.encode('utf-8')).hexdigest(),
+        })
+    return migrations
+
+
+def split_statements(sql):
+    """Statements of a migration file; files are plain DDL without function bodies"""
+    lines = [line for line in sql.splitlines() if not line.strip().startswith('--')]
+    return [statement.strip() for statement in '\n'.join(lines).split(';') if statement.strip()]
+
+
+def drop_invalid_indexes(cursor, sql):
+    """Drop indexes of this migration left INVALID by an interrupted concurrent build"""
+    names = _CONCURRENT_INDEX_RE.findall(sql)
+    if not names:
+        return
+    cursor.execute("""
+        SELECT c.relname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE NOT i.indisvalid AND n.nspname = current_schema() AND c.relname = ANY(%s)
+    """, (names,))
+    for (name,) in cursor.fetchall():
+        print(f"Dropping invalid index {name} from an earlier failed build")
+        cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+
+
+def applied_migrations(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version VARCHAR(32) PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            checksum CHAR(64) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("SELECT version, checksum FROM schema_migrations")
+    return dict(cursor.fetchall())
+
+
+def apply(conn, cursor, migration):
+    record = ("INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+              (migration['version'], migration['name'], migration['checksum']))
+
+    if migration['sql'].startswith(NO_TRANSACTION):
+        # Every statement is idempotent, so a partial run is safe to repeat
+        drop_invalid_indexes(cursor, migration['sql'])
+        for statement in split_statements(migration['sql']):
+            cursor.execute(statement)
+        cursor.execute(*record)
+        return
+
+    conn.autocommit = False
+    try:
+        cursor.execute(migration['sql'])
+        cursor.execute(*record)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = True
+
+
+def migrate(status_only=False):
+    """Apply pending migrations; returns the versions applied"""
+    conn = psycopg2.connect(**connection_params())
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+    applied_now = []
+    try:
+        applied = applied_migrations(cursor)
+        for migration in discover():
+            label = f"{migration['version']}_{migration['name']}"
+            if migration['version'] in applied:
+                if applied[migration['version']] != migration['checksum']:
+                    print(f"Warning: {label} changed after it was applied")
+                if status_only:
+                    print(f"applied  {label}")
+                continue
+            if status_only:
+                print(f"pending  {label}")
+                continue
+
+            print(f"Applying {label}")
+            apply(conn, cursor, migration)
+            applied_now.append(migration['version'])
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        cursor.close()
+        conn.close()
+
+    if not status_only:
+        print(f"Database up to date ({len(applied_now)} migration(s) applied)")
+    return applied_now
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply database migrations')
+    parser.add_argument('--status', action='store_true', help='list migrations without applying them')
+    args = parser.parse_args()
+    migrate(status_only=args.status)
@@ -0,0 +1,533 @@
+"""Latency-aware routing of recipe completions across OpenRouter models
+
+    for delta in model_router.stream(client, messages, mode='complete', max_tokens=800):
+        ...
+    text = await model_router.acomplete(aclient, messages, max_tokens=800)
+
+Every request is streamed, so "no output yet" is observable and a losing
+request can be closed rather than left running. For each request:
+
+- The primary model (OPENROUTER_MODEL) is tried first, then the
+  OPENROUTER_FALLBACK_MODELS by observed time to first token.
+- If the attempt has produced no output by the model's
+  OPENROUTER_HEDGE_PERCENTILE time to first token, one hedged request goes
+  to the best alternate. Whichever produces output first wins and the
+  other is cancelled. Hedges are capped at OPENROUTER_HEDGE_MAX_RATE of
+  recent requests so a slow provider cannot double the load.
+- An attempt that fails before producing output fails over to the next
+  model straight away.
+- Nothing runs past OPENROUTER_TIMEOUT seconds, which bounds the tail.
+
+Each model has a circuit breaker. OPENROUTER_BREAKER_FAILURES consecutive
+failures, or half of the last calls failing, open it for
+OPENROUTER_BREAKER_COOLDOWN seconds. Meanwhile the model is skipped, and
+when every model is open, requests fail fast with ModelsUnavailable.
+After the cooldown one probe request decides whether it closes again.
+Statistics are per worker process.
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import openai
+
+from logs import get_logger
+from metrics import LLM_BREAKER_OPEN, LLM_ROUTING, observe_llm, record_llm_usage
+
+log = get_logger('router')
+
+
+class RouterError(Exception):
+    """Base class for routing failures that are not a provider's own error"""
+
+
+class ModelsUnavailable(RouterError):
+    """Raised when every model's circuit breaker is open"""
+
+
+class RouterTimeout(RouterError):
+    """Raised when no model finished within OPENROUTER_TIMEOUT seconds"""
+
+
+def is_model_failure(exc):
+    """Errors that say something about the model's provider, counted by its breaker"""
+    if isinstance(exc, (RouterTimeout, openai.APIConnectionError, openai.RateLimitError, openai.NotFoundError)):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code >= 500
+
+
+def is_account_error(exc):
+    """Errors no other model can fix: bad key, no credits"""
+    return (isinstance(exc, (openai.AuthenticationError, openai.PermissionDeniedError))
+            or getattr(exc, 'status_code', None) == 402)
+
+
+class ModelHealth:
+    """Rolling time to first token and outcomes for one model, plus its breaker
+
+    Breaker states: 'closed' (in use), 'open' (skipped until the cooldown
+    ends), 'half_open' (one probe request in flight).
+    """
+
+    def __init__(self, model, failures=5, cooldown=30.0, window=20, samples=200):
+        self.model = model
+        self.failure_threshold = failures
+        self.cooldown = cooldown
+        self._outcomes = deque(maxlen=window)
+        self._first_token = deque(maxlen=samples)
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._stats = {'successes': 0, 'failures': 0, 'cancelled': 0, 'opened': 0}
+
+    def allow(self):
+        """Whether a request may go to this model now; may take the half-open probe"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = 'half_open'
+                return True
+            return False
+
+    def success(self, first_token):
+        with self._lock:
+            self._outcomes.append(True)
+            self._first_token.append(first_token)
+            self._consecutive = 0
+            self._stats['successes'] += 1
+            if self.state != 'closed':
+                log.info("Circuit closed", extra={'model': self.model})
+                LLM_BREAKER_OPEN.labels(self.model).set(0)
+            self.state = 'closed'
+
+    def failure(self):
+        with self._lock:
+            self._outcomes.append(False)
+            self._consecutive += 1
+            self._stats['failures'] += 1
+            failed = self._outcomes.count(False)
+            if self.state == 'half_open' or (self.state == 'closed' and (
+                    self._consecutive >= self.failure_threshold
+                    or len(self._outcomes) >= self._outcomes.maxlen // 2 and failed * 2 >= len(self._outcomes))):
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+                self._stats['opened'] += 1
+                LLM_BREAKER_OPEN.labels(self.model).set(1)
+                log.warning("Circuit opened", extra={'model': self.model, 'consecutive_failures': self._consecutive,
+                                                     'recent_failures': failed})
+
+    def cancelled(self, elapsed):
+        """A request that lost a hedge or was abandoned
+
+        If it had no output yet, its time to first token is at least
+        `elapsed`; recording that lower bound keeps slow attempts from
+        vanishing out of the percentiles.
+        """
+        with self._lock:
+            self._stats['cancelled'] += 1
+            if elapsed is not None:
+                self._first_token.append(elapsed)
+        self.inconclusive()
+
+    def inconclusive(self):
+        """A request that says nothing about the provider's health (cancelled, bad request)"""
+        with self._lock:
+            if self.state == 'half_open':
+                # Let the next request probe instead
+                self.state = 'open'
+                self._opened_at = time.monotonic() - self.cooldown
+
+    def first_token_percentile(self, pct, min_samples=20):
+        with self._lock:
+            if len(self._first_token) < min_samples:
+                return None
+            ordered = sorted(self._first_token)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['state'] = self.state
+            stats['recent_error_rate'] = (round(self._outcomes.count(False) / len(self._outcomes), 3)
+                                          if self._outcomes else None)
+        stats['first_token_p50'] = self.first_token_percentile(50)
+        stats['first_token_p95'] = self.first_token_percentile(95)
+        return stats
+
+
+class _Attempt:
+    def __init__(self, model, hedge):
+        self.model = model
+        self.hedge = hedge
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.cancelled = False
+        self.stream = None
+        self.task = None
+
+    def cancel(self):
+        self.cancelled = True
+        if self.task is not None:
+            self.task.cancel()
+        elif self.stream is not None:
+            try:
+                # Closing the response aborts a read blocked in another thread
+                self.stream.close()
+            except Exception:
+                pass
+
+
+class ModelRouter:
+    """Routes each completion to the healthiest model, hedging slow starts
+
+    models[0] is the primary; the rest are alternates. Requests are made
+    with the SDK's retries off: failover here replaces them.
+    """
+
+    def __init__(self, models, timeout=25.0, hedge_percentile=95, hedge_delay=4.0, hedge_min_delay=0.5,
+                 hedge_max_rate=0.1, breaker_failures=5, breaker_cooldown=30.0):
+        self.models = list(dict.fromkeys(models))
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay_default = hedge_delay
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_rate = hedge_max_rate
+        self.health = {model: ModelHealth(model, breaker_failures, breaker_cooldown) for model in self.models}
+        self._recent_hedges = deque(maxlen=200)
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'failovers': 0, 'rejected': 0, 'timeouts': 0}
+
+    @classmethod
+    def from_env(cls):
+        primary = os.getenv('OPENROUTER_MODEL', 'openai/gpt-3.5-turbo')
+        fallbacks = [m.strip() for m in os.getenv('OPENROUTER_FALLBACK_MODELS', '').split(',') if m.strip()]
+        return cls(
+            [primary, *fallbacks],
+            timeout=float(os.getenv('OPENROUTER_TIMEOUT', 25)),
+            hedge_percentile=float(os.getenv('OPENROUTER_HEDGE_PERCENTILE', 95)),
+            hedge_delay=float(os.getenv('OPENROUTER_HEDGE_DELAY', 4.0)),
+            hedge_min_delay=float(os.getenv('OPENROUTER_HEDGE_MIN_DELAY', 0.5)),
+            hedge_max_rate=float(os.getenv('OPENROUTER_HEDGE_MAX_RATE', 0.1)),
+            breaker_failures=int(os.getenv('OPENROUTER_BREAKER_FAILURES', 5)),
+            breaker_cooldown=float(os.getenv('OPENROUTER_BREAKER_COOLDOWN', 30)),
+        )
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _next_model(self, tried):
+        """Primary first, then alternates by median time to first token; None if all are tried or open"""
+        primary = self.models[0]
+        alternates = [m for m in self.models[1:] if m not in tried]
+        p50 = {m: self.health[m].first_token_percentile(50) for m in alternates}
+        # sorted() is stable: unmeasured alternates keep their configured order, after measured ones
+        candidates = [primary] if primary not in tried else []
+        candidates += sorted(alternates, key=lambda m: (p50[m] is None, p50[m] or 0))
+        for model in candidates:
+            if self.health[model].allow():
+                return model
+        return None
+
+    def _hedge_after(self, model):
+        """Seconds without output before hedging, or None when hedging is off or over budget"""
+        if len(self.models) < 2 or self.hedge_max_rate <= 0:
+            return None
+        with self._lock:
+            recent = len(self._recent_hedges)
+            if recent >= 20 and sum(self._recent_hedges) >= self.hedge_max_rate * recent:
+                return None
+        delay = self.health[model].first_token_percentile(self.hedge_percentile) or self.hedge_delay_default
+        return max(self.hedge_min_delay, delay)
+
+    def _begin(self):
+        self._count('requests')
+        with self._lock:
+            self._recent_hedges.append(False)
+
+    def _note_hedge(self, model):
+        with self._lock:
+            self._stats['hedged'] += 1
+            self._recent_hedges[-1] = True
+        LLM_ROUTING.labels(model, 'hedge').inc()
+
+    def _settle(self, attempt, kind, payload, mode):
+        """Account for an attempt's end: 'end', 'error' or 'cancelled'"""
+        health = self.health[attempt.model]
+        elapsed = time.perf_counter() - attempt.started
+        if kind == 'end':
+            health.success(attempt.first_token if attempt.first_token is not None else elapsed)
+            observe_llm(attempt.model, mode, 'ok', elapsed, attempt.first_token)
+        elif kind == 'error':
+            if is_model_failure(payload):
+                health.failure()
+            else:
+                health.inconclusive()
+            observe_llm(attempt.model, mode, 'error', elapsed, attempt.first_token)
+            log.warning("Model attempt failed", extra={'model': attempt.model, 'hedge': attempt.hedge,
+                                                        'error': repr(payload)[:300]})
+        else:
+            health.cancelled(elapsed if attempt.first_token is None else None)
+            observe_llm(attempt.model, mode, 'cancelled', elapsed, attempt.first_token)
+
+    def _abandon(self, live, winner, ending, mode):
+        """Cancel and settle the attempts still running when a request ends
+
+        ending is 'stopped' when the consumer had what it needed (the
+        winner counts as a success), 'timeout' (still running at the
+        deadline counts as a failure) or None (an error or a cancelled
+        caller).
+        """
+        for attempt in list(live):
+            attempt.cancel()
+            if ending == 'stopped' and attempt is winner:
+                self._settle(attempt, 'end', None, mode)
+            elif ending == 'timeout':
+                self._settle(attempt, 'error', RouterTimeout(f'Still running after {self.timeout}s'), mode)
+            else:
+                self._settle(attempt, 'cancelled', None, mode)
+
+    def _usage(self, attempt, chunk, on_usage):
+        usage = getattr(chunk, 'usage', None)
+        record_llm_usage(attempt.model, usage)
+        if usage is not None and on_usage is not None:
+            on_usage(attempt.model, usage)
+
+    def _request(self, client, attempt, messages, kwargs, deadline):
+        """Start the streamed completion for an attempt, without the SDK's own retries"""
+        remaining = max(1.0, deadline - time.monotonic())
+        return client.with_options(max_retries=0, timeout=remaining).chat.completions.create(
+            model=attempt.model, messages=messages, stream=True, stream_options={'include_usage': True}, **kwargs)
+
+    # -- threads ---------------------------------------------------------
+
+    def _run(self, attempt, client, messages, kwargs, deadline, events, on_usage):
+        try:
+            stream = self._request(client, attempt, messages, kwargs, deadline)
+            attempt.stream = stream
+            if attempt.cancelled:
+                stream.close()
+                return
+            for chunk in stream:
+                self._usage(attempt, chunk, on_usage)
+                if attempt.cancelled:
+                    return
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    events.put((attempt, 'delta', delta))
+            events.put((attempt, 'end', None))
+        except Exception as e:
+            if not attempt.cancelled:
+                events.put((attempt, 'error', e))
+
+    def stream(self, client, messages, mode='complete', on_usage=None, **kwargs):
+        """Yield the completion text of whichever model answers first (sync OpenAI client)
+
+        on_usage(model, usage) is called with the usage each attempt
+        reports, hedged losers included: they are billed too. Raises
+        ModelsUnavailable, RouterTimeout, or the provider's error when
+        every model failed.
+        """
+        self._begin()
+        deadline = time.monotonic() + self.timeout
+        events = queue.Queue()
+        attempts, tried, errors = [], set(), []
+        live = set()
+
+        def launch(hedge=False):
+            model = self._next_model(tried)
+            if model is None:
+                return None
+            tried.add(model)
+            attempt = _Attempt(model, hedge)
+            attempts.append(attempt)
+            live.add(attempt)
+            threading.Thread(target=self._run, args=(attempt, client, messages, kwargs, deadline, events, on_usage),
+                             name=f'llm-{model}', daemon=True).start()
+            return attempt
+
+        winner = None
+        ending = None
+        try:
+            first = launch()
+            if first is None:
+                self._count('rejected')
+                LLM_ROUTING.labels(self.models[0], 'rejected').inc()
+                raise ModelsUnavailable('Every model is failing; circuit breakers are open')
+            hedge_after = self._hedge_after(first.model)
+            hedge_at = time.monotonic() + hedge_after if hedge_after is not None else None
+
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    self._count('timeouts')
+                    ending = 'timeout'
+                    raise RouterTimeout(f'No complete answer within {self.timeout}s')
+                wait_until = min(deadline, hedge_at) if (winner is None and hedge_at) else deadline
+                try:
+                    attempt, kind, payload = events.get(timeout=max(0.0, wait_until - now))
+                except queue.Empty:
+                    if winner is None and hedge_at is not None and time.monotonic() >= hedge_at:
+                        hedge_at = None
+                        hedge = launch(hedge=True)
+                        if hedge is not None:
+                            self._note_hedge(hedge.model)
+                    continue
+
+                if winner is not None and attempt is not winner:
+                    continue
+                if kind == 'delta':
+                    if winner is None:
+                        winner = attempt
+                        if attempt.hedge:
+                            self._count('hedge_wins')
+                        for other in attempts:
+                            if other is not winner and other in live:
+                                other.cancel()
+                                live.discard(other)
+                                self._settle(other, 'cancelled', None, mode)
+                    if attempt.first_token is None:
+                        attempt.first_token = time.perf_counter() - attempt.started
+                    yield payload
+                    continue
+
+                live.discard(attempt)
+                self._settle(attempt, kind, payload, mode)
+                if kind == 'end':
+                    if winner is None:
+                        winner = attempt
+                    return
+                if winner is not None or is_account_error(payload):
+                    raise payload
+                errors.append(payload)
+                if not live:
+                    # Everything in flight failed before any output: fail over
+                    nxt = launch()
+                    if nxt is None:
+                        raise errors[-1]
+                    self._count('failovers')
+                    LLM_ROUTING.labels(nxt.model, 'failover').inc()
+        except GeneratorExit:
+            # The consumer stopped reading, e.g. once it had three recipes
+            ending = 'stopped'
+            raise
+        finally:
+            self._abandon(live, winner, ending, mode)
+
+    def complete(self, client, messages, mode='complete', on_usage=None, **kwargs):
+        return ''.join(self.stream(client, messages, mode, on_usage, **kwargs))
+
+    # -- asyncio ---------------------------------------------------------
+
+    async def _arun(self, attempt, client, messages, kwargs, deadline, events, on_usage):
+        try:
+            stream = await self._request(client, attempt, messages, kwargs, deadline)
+            attempt.stream = stream
+            try:
+                async for chunk in stream:
+                    self._usage(attempt, chunk, on_usage)
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        events.put_nowait((attempt, 'delta', delta))
+            finally:
+                await stream.close()
+            events.put_nowait((attempt, 'end', None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            events.put_nowait((attempt, 'error', e))
+
+    async def acomplete(self, client, messages, mode='complete', on_usage=None, **kwargs):
+        """Completion text from whichever model answers first (AsyncOpenAI client)"""
+        self._begin()
+        deadline = time.monotonic() + self.timeout
+        events = asyncio.Queue()
+        attempts, tried, errors, parts = [], set(), [], []
+        live = set()
+
+        def launch(hedge=False):
+            model = self._next_model(tried)
+            if model is None:
+                return None
+            tried.add(model)
+            attempt = _Attempt(model, hedge)
+            attempts.append(attempt)
+            live.add(attempt)
+            attempt.task = asyncio.ensure_future(self._arun(attempt, client, messages, kwargs, deadline, events,
+                                                            on_usage))
+            return attempt
+
+        winner = None
+        ending = None
+        try:
+            first = launch()
+            if first is None:
+                self._count('rejected')
+                LLM_ROUTING.labels(self.models[0], 'rejected').inc()
+                raise ModelsUnavailable('Every model is failing; circuit breakers are open')
+            hedge_after = self._hedge_after(first.model)
+            hedge_at = time.monotonic() + hedge_after if hedge_after is not None else None
+
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    self._count('timeouts')
+                    ending = 'timeout'
+                    raise RouterTimeout(f'No complete answer within {self.timeout}s')
+                wait_until = min(deadline, hedge_at) if (winner is None and hedge_at) else deadline
+                try:
+                    attempt, kind, payload = await asyncio.wait_for(events.get(), max(0.0, wait_until - now))
+                except asyncio.TimeoutError:
+                    if winner is None and hedge_at is not None and time.monotonic() >= hedge_at:
+                        hedge_at = None
+                        hedge = launch(hedge=True)
+                        if hedge is not None:
+                            self._note_hedge(hedge.model)
+                    continue
+
+                if winner is not None and attempt is not winner:
+                    continue
+                if kind == 'delta':
+                    if winner is None:
+                        winner = attempt
+                        if attempt.hedge:
+                            self._count('hedge_wins')
+                        for other in attempts:
+                            if other is not winner and other in live:
+                                other.cancel()
+                                live.discard(other)
+                                self._settle(other, 'cancelled', None, mode)
+                    if attempt.first_token is None:
+                        attempt.first_token = time.perf_counter() - attempt.started
+                    parts.append(payload)
+                    continue
+
+                live.discard(attempt)
+                self._settle(attempt, kind, payload, mode)
+                if kind == 'end':
+                    return ''.join(parts)
+                if winner is not None or is_account_error(payload):
+                    raise payload
+                errors.append(payload)
+                if not live:
+                    nxt = launch()
+                    if nxt is None:
+                        raise errors[-1]
+                    self._count('failovers')
+                    LLM_ROUTING.labels(nxt.model, 'failover').inc()
+        finally:
+            self._abandon(live, winner, ending, mode)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['models'] = {model: health.stats() for model, health in self.health.items()}
+        return stats
+
+
+model_router = ModelRouter.from_env()
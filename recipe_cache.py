@@ -0,0 +1,271 @@
+"""Recommendation cache keyed on a canonical ingredient set and model name"""
+import copy
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import asyncpg
+import psycopg2
+from psycopg2.extras import Json
+
+from db import get_cursor
+from logs import get_logger
+
+log = get_logger('cache')
+
+# Shared by the psycopg2 and asyncpg paths; placeholders are filled per driver
+GET_SQL = """
+    SELECT recipes, EXTRACT(EPOCH FROM expires_at - NOW()) AS ttl_left
+    FROM recommendation_cache
+    WHERE cache_key = {key} AND expires_at > NOW()
+"""
+
+SET_SQL = """
+    INSERT INTO recommendation_cache (cache_key, model, ingredients, recipes, created_at, expires_at)
+    VALUES ({key}, {model}, {ingredients}, {recipes}, NOW(), NOW() + {ttl} * INTERVAL '1 second')
+    ON CONFLICT (cache_key) DO UPDATE
+    SET recipes = EXCLUDED.recipes, created_at = EXCLUDED.created_at, expires_at = EXCLUDED.expires_at
+"""
+
+ASYNC_DB_ERRORS = (asyncpg.PostgresError, asyncpg.InterfaceError, OSError)
+
+# Folded after singularizing, so keys are singular
+SYNONYMS = {
+    'scallion': 'green onion',
+    'spring onion': 'green onion',
+    'cilantro': 'coriander',
+    'garbanzo': 'chickpea',
+    'garbanzo bean': 'chickpea',
+    'aubergine': 'eggplant',
+    'courgette': 'zucchini',
+    'capsicum': 'bell pepper',
+    'prawn': 'shrimp',
+    'minced beef': 'ground beef',
+    'beef mince': 'ground beef',
+    'chilli': 'chili',
+    'chile': 'chili',
+    'yoghurt': 'yogurt',
+    'maize': 'corn',
+    'rocket': 'arugula',
+}
+
+IRREGULAR_PLURALS = {
+    'leaves': 'leaf',
+    'loaves': 'loaf',
+    'halves': 'half',
+    'knives': 'knife',
+    'teeth': 'tooth',
+}
+
+# Words ending in "s" that are already singular
+NON_PLURALS = {'asparagus', 'couscous', 'hummus', 'molasses', 'swiss', 'citrus'}
+
+_SPLIT_RE = re.compile(r'[,;\n]+|\band\b')
+_CLEAN_RE = re.compile(r"[^a-z0-9\s'-]")
+
+
+def singularize(word):
+    if word in IRREGULAR_PLURALS:
+        return IRREGULAR_PLURALS[word]
+    if word in NON_PLURALS or len(word) <= 3:
+        return word
+    if word.endswith('ies'):
+        return word[:-3] + 'y'
+    if word.endswith('oes') or word.endswith(('ches', 'shes', 'sses', 'xes')):
+        return word[:-2]
+    if word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return word[:-1]
+    return word
+
+
+def canonical_ingredient(text):
+    """Lowercase, strip punctuation, singularize and fold synonyms"""
+    words = _CLEAN_RE.sub(' ', text.lower()).split()
+    if not words:
+        return ''
+    words[-1] = singularize(words[-1])
+    phrase = ' '.join(words)
+    return SYNONYMS.get(phrase, phrase)
+
+
+def normalize_ingredients(ingredients):
+    """Canonical, deduplicated, sorted tuple from free text or a list"""
+    if isinstance(ingredients, str):
+        parts = _SPLIT_RE.split(ingredients.lower())
+    else:
+        parts = [str(item) for item in ingredients]
+    return tuple(sorted({c for c in (canonical_ingredient(p) for p in parts) if c}))
+
+
+def cache_key(ingredients, model):
+    items = normalize_ingredients(ingredients)
+    return hashlib.sha256(f"{model}\n{','.join(items)}".encode('utf-8')).hexdigest()
+
+
+class RecommendationCache:
+    """In-memory LRU backed by the recommendation_cache table, both with TTL"""
+
+    def __init__(self, maxsize=5000, ttl=7 * 24 * 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_purge = time.monotonic()
+        self._stats = {
+            'memory_hits': 0,
+            'memory_misses': 0,
+            'db_hits': 0,
+            'db_misses': 0,
+            'stores': 0,
+            'db_errors': 0,
+            'purged': 0,
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _get_memory(self, key, now):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and item[1] > now:
+                self._entries.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return copy.deepcopy(item[0])
+            if item is not None:
+                del self._entries[key]
+            self._stats['memory_misses'] += 1
+        return None
+
+    def _db_row(self, key, row, now):
+        if not row:
+            self._count('db_misses')
+            return None
+        self._count('db_hits')
+        recipes = row['recipes']
+        if isinstance(recipes, str):
+            # asyncpg returns jsonb as text
+            recipes = json.loads(recipes)
+        self._store_memory(key, recipes, now + float(row['ttl_left']))
+        return copy.deepcopy(recipes)
+
+    def get(self, ingredients, model):
+        """Cached recipes for this ingredient set and model, or None"""
+        key = cache_key(ingredients, model)
+        now = time.time()
+        recipes = self._get_memory(key, now)
+        if recipes is not None:
+            return recipes
+
+        try:
+            with get_cursor() as cursor:
+                cursor.execute(GET_SQL.format(key='%s'), (key,))
+                row = cursor.fetchone()
+        except psycopg2.Error as e:
+            log.warning("Recommendation cache read failed", extra={'error': str(e)})
+            self._count('db_errors')
+            return None
+        return self._db_row(key, row, now)
+
+    async def get_async(self, db, ingredients, model):
+        """asyncpg twin of get(); db is a pool or connection"""
+        key = cache_key(ingredients, model)
+        now = time.time()
+        recipes = self._get_memory(key, now)
+        if recipes is not None:
+            return recipes
+
+        try:
+            row = await db.fetchrow(GET_SQL.format(key='$1'), key)
+        except ASYNC_DB_ERRORS as e:
+            log.warning("Recommendation cache read failed", extra={'error': str(e)})
+            self._count('db_errors')
+            return None
+        return self._db_row(key, row, now)
+
+    def _prepare(self, ingredients, model, recipes):
+        """(key, ingredient text, recipes to store), kept in memory at once"""
+        items = normalize_ingredients(ingredients)
+        key = cache_key(items, model)
+        recipes = [{'name': r.get('name'), 'ingredients': r.get('ingredients'),
+                    'instructions': r.get('instructions')} for r in recipes]
+        self._store_memory(key, recipes, time.time() + self.ttl)
+        self._count('stores')
+        return key, ', '.join(items), recipes
+
+    def set(self, ingredients, model, recipes):
+        if not recipes:
+            return
+        key, items, recipes = self._prepare(ingredients, model, recipes)
+        try:
+            with get_cursor() as cursor:
+                cursor.execute(SET_SQL.format(key='%s', model='%s', ingredients='%s', recipes='%s', ttl='%s'),
+                               (key, model, items, Json(recipes), self.ttl))
+        except psycopg2.Error as e:
+            log.warning("Recommendation cache write failed", extra={'error': str(e)})
+            self._count('db_errors')
+        self._maybe_purge()
+
+    async def set_async(self, db, ingredients, model, recipes):
+        """asyncpg twin of set(); the periodic purge is left to the sync path"""
+        if not recipes:
+            return
+        key, items, recipes = self._prepare(ingredients, model, recipes)
+        try:
+            await db.execute(SET_SQL.format(key='$1', model='$2', ingredients='$3', recipes='$4::jsonb',
+                                            ttl='$5::float8'),
+                             key, model, items, json.dumps(recipes), self.ttl)
+        except ASYNC_DB_ERRORS as e:
+            log.warning("Recommendation cache write failed", extra={'error': str(e)})
+            self._count('db_errors')
+
+    def _maybe_purge(self, every=600.0):
+        # Writes are the only thing that grows the table, so they pay for trimming it
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_purge < every:
+                return
+            self._last_purge = now
+        try:
+            purged = self.purge_expired()
+        except psycopg2.Error as e:
+            log.warning("Recommendation cache purge failed", extra={'error': str(e)})
+            self._count('db_errors')
+            return
+        with self._lock:
+            self._stats['purged'] += purged
+
+    def purge_expired(self):
+        """Delete expired rows from the persistent tier; returns the count
+
+        Runs at most every 10 minutes per worker from set(), on the expires_at index.
+        """
+        with get_cursor() as cursor:
+            cursor.execute("DELETE FROM recommendation_cache WHERE expires_at <= NOW()")
+            return cursor.rowcount
+
+    def _store_memory(self, key, recipes, expires_at):
+        with self._lock:
+            self._entries[key] = (copy.deepcopy(recipes), expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_size'] = len(self._entries)
+        for tier in ('memory', 'db'):
+            lookups = stats[f'{tier}_hits'] + stats[f'{tier}_misses']
+            stats[f'{tier}_hit_rate'] = round(stats[f'{tier}_hits'] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+recommendation_cache = RecommendationCache(
+    maxsize=int(os.getenv('RECOMMENDATION_CACHE_SIZE', 5000)),
+    ttl=int(os.getenv('RECOMMENDATION_CACHE_TTL', 7 * 24 * 3600)),
+)
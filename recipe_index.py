@@ -0,0 +1,267 @@
+"""In-memory inverted index of saved recipes' ingredients for LLM-free recommendations"""
+import os
+import re
+import threading
+import time
+
+from db import get_cursor, get_db
+from logs import get_logger
+from recipe_cache import canonical_ingredient, normalize_ingredients
+
+log = get_logger('recipe_index')
+
+# Assumed to be in every kitchen, so they never count against coverage
+STAPLES = {'salt', 'pepper', 'black pepper', 'water', 'oil', 'olive oil', 'vegetable oil', 'cooking oil', 'sugar'}
+
+UNITS = {
+    'cup', 'cups', 'tbsp', 'tsp', 'tablespoon', 'tablespoons', 'teaspoon', 'teaspoons',
+    'g', 'kg', 'gram', 'grams', 'lb', 'lbs', 'pound', 'pounds', 'oz', 'ounce', 'ounces',
+    'ml', 'l', 'liter', 'litre', 'clove', 'cloves', 'pinch', 'dash', 'can', 'cans',
+    'slice', 'slices', 'piece', 'pieces', 'handful', 'bunch', 'large', 'small', 'medium',
+    'of', 'a', 'an',
+}
+
+DESCRIPTORS = {
+    'chopped', 'diced', 'minced', 'sliced', 'grated', 'shredded', 'fresh', 'freshly',
+    'ground', 'crushed', 'cooked', 'boneless', 'skinless', 'optional', 'finely', 'roughly',
+}
+
+# The winning recipes of a lookup, read by id
+LOAD_SQL = """
+    SELECT id, recipe_name, ingredients, instructions
+    FROM recipes
+    WHERE id = ANY({ids})
+"""
+
+_PAREN_RE = re.compile(r'\([^)]*\)')
+_QUANTITY_RE = re.compile(r'[\d¼-¾⅐-⅞/.\-]+')
+
+
+def recipe_ingredient(text):
+    """Canonical ingredient from a stored line such as '2 cups chopped tomatoes'"""
+    text = _PAREN_RE.sub(' ', text.lower()).split(' to taste')[0]
+    words = [w for w in _QUANTITY_RE.sub(' ', text).split() if w not in UNITS]
+    # "ground" is part of the ingredient in "ground beef", a descriptor elsewhere
+    words = [w for i, w in enumerate(words) if w not in DESCRIPTORS or (w == 'ground' and i + 1 < len(words))]
+    return canonical_ingredient(' '.join(words))
+
+
+def parse_recipe_ingredients(ingredients):
+    if isinstance(ingredients, list):
+        parts = ingredients
+    else:
+        parts = (ingredients or '').split(',')
+    return frozenset(c for c in (recipe_ingredient(p) for p in parts) if c)
+
+
+class RecipeIndex:
+    """Maps ingredient words to recipe ids and scores recipes by pantry coverage
+
+    Holds only ids and ingredient phrases; the winning recipes are read from
+    the recipes table by id. A background thread per worker builds the index
+    from the table and catches up on rows from other workers every
+    refresh_interval seconds; add() indexes rows this worker writes at once.
+    Until the first load finishes, recommend() finds nothing.
+
+    Ids are drawn when a row is inserted but the row only becomes visible
+    when its transaction commits, so a lower id can show up after a higher
+    one was read. Each refresh re-reads the last rescan_window ids below the
+    high-water mark, and every reconcile_interval seconds the whole table.
+    """
+
+    def __init__(self, min_coverage=0.75, refresh_interval=60.0, batch_size=2000,
+                 rescan_window=1000, reconcile_interval=3600.0):
+        self.min_coverage = min_coverage
+        self.refresh_interval = refresh_interval
+        self.batch_size = batch_size
+        self.rescan_window = rescan_window
+        self.reconcile_interval = reconcile_interval
+        self._postings = {}
+        self._phrases = {}
+        self._by_name = {}
+        self._max_id = 0
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._refresher_pid = None
+        self._start_lock = threading.Lock()
+
+    def _entry(self, recipe_id, name, ingredients):
+        """(id, name hash, phrases) for a row, or None if it can't be indexed"""
+        phrases = parse_recipe_ingredients(ingredients)
+        key = (name or '').strip().lower()
+        if not key or not phrases:
+            return None
+        # A hash is enough to keep one row per name; a rare collision only drops a duplicate
+        return recipe_id, hash(key), phrases
+
+    def add(self, recipe_id, name, ingredients, instructions=None):
+        entry = self._entry(recipe_id, name, ingredients)
+        if entry is not None:
+            with self._lock:
+                self._apply([entry])
+
+    def _apply(self, entries):
+        for recipe_id, name_hash, phrases in entries:
+            # Rescans read rows again; they are already indexed or superseded
+            if recipe_id in self._phrases:
+                continue
+            # LLM output repeats itself; keep only the newest row per name
+            previous = self._by_name.get(name_hash)
+            if previous is not None:
+                if previous > recipe_id:
+                    continue
+                self._remove(previous)
+            self._by_name[name_hash] = recipe_id
+            self._phrases[recipe_id] = phrases
+            for word in self._words(phrases):
+                self._postings.setdefault(word, set()).add(recipe_id)
+
+    def _remove(self, recipe_id):
+        phrases = self._phrases.pop(recipe_id, None)
+        if phrases is None:
+            return
+        for word in self._words(phrases):
+            ids = self._postings.get(word)
+            if ids is not None:
+                ids.discard(recipe_id)
+                if not ids:
+                    del self._postings[word]
+
+    def _words(self, phrases):
+        return {word for phrase in phrases if phrase not in STAPLES for word in phrase.split()}
+
+    def refresh(self, full=False):
+        """Index rows near or above the high-water mark, or every row if full
+
+        Rows are read and parsed without the lock; each batch is swapped in
+        under it, so lookups never wait on the database.
+        """
+        start = 0 if full else max(self._max_id - self.rescan_window, 0)
+        with get_db() as conn:
+            cursor = conn.cursor(name='recipe_index_refresh')
+            cursor.itersize = self.batch_size
+            cursor.execute("""
+                SELECT id, recipe_name, ingredients
+                FROM recipes
+                WHERE id > %s
+                ORDER BY id
+            """, (start,))
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                entries = [self._entry(row['id'], row['recipe_name'], row['ingredients']) for row in rows]
+                with self._lock:
+                    self._apply([entry for entry in entries if entry is not None])
+                    self._max_id = max(self._max_id, rows[-1]['id'])
+            cursor.close()
+        self._loaded_at = time.monotonic()
+
+    def _refresh_loop(self):
+        last_reconcile = time.monotonic()
+        while True:
+            full = time.monotonic() - last_reconcile >= self.reconcile_interval
+            try:
+                self.refresh(full=full)
+                if full:
+                    last_reconcile = time.monotonic()
+            except Exception as e:
+                # Serve what is indexed and retry on the next interval
+                log.warning("Recipe index refresh failed", extra={'error': str(e)})
+            time.sleep(self.refresh_interval)
+
+    def _ensure_refresher(self):
+        pid = os.getpid()
+        if self._refresher_pid == pid:
+            return
+        with self._start_lock:
+            if self._refresher_pid == pid:
+                return
+            # Threads do not survive fork: each worker starts its own
+            threading.Thread(target=self._refresh_loop, name='recipe-index', daemon=True).start()
+            self._refresher_pid = pid
+
+    def _covered(self, phrase, pantry, pantry_words):
+        if phrase in STAPLES or phrase in pantry:
+            return True
+        # A pantry "chicken" covers a recipe's "chicken breast"
+        words = set(phrase.split())
+        return any(p <= words for p in pantry_words)
+
+    def search(self, ingredients, limit=3):
+        """Best recipes for a pantry as (coverage, overlap, recipe_id) tuples"""
+        pantry = set(normalize_ingredients(ingredients))
+        pantry_words = [set(p.split()) for p in pantry if p not in STAPLES]
+        if not pantry_words:
+            return []
+
+        with self._lock:
+            candidates = set()
+            for words in pantry_words:
+                for word in words:
+                    candidates |= self._postings.get(word, set())
+            phrases_by_id = {recipe_id: self._phrases[recipe_id] for recipe_id in candidates}
+
+        scored = []
+        for recipe_id, phrases in phrases_by_id.items():
+            covered = [p for p in phrases if self._covered(p, pantry, pantry_words)]
+            coverage = len(covered) / len(phrases)
+            used = sum(1 for words in pantry_words if any(words <= set(p.split()) for p in covered))
+            overlap = used / len(pantry_words)
+            scored.append((coverage, overlap, recipe_id))
+
+        scored.sort(reverse=True)
+        return scored[:limit]
+
+    def _ordered(self, recipe_ids, rows):
+        """{'name', 'ingredients', 'instructions'} for each id in order, or None if any was deleted"""
+        rows = {row['id']: row for row in rows}
+        missing = [recipe_id for recipe_id in recipe_ids if recipe_id not in rows]
+        if missing:
+            # Deleted since they were indexed (an account was removed)
+            with self._lock:
+                for recipe_id in missing:
+                    self._remove(recipe_id)
+            return None
+        return [{'name': rows[i]['recipe_name'], 'ingredients': rows[i]['ingredients'],
+                 'instructions': rows[i]['instructions']} for i in recipe_ids]
+
+    def _winners(self, ingredients, limit):
+        """Ids of the best `limit` recipes, or None when coverage is too low"""
+        self._ensure_refresher()
+        results = self.search(ingredients, limit)
+        if len(results) < limit or any(coverage < self.min_coverage or overlap == 0
+                                       for coverage, overlap, _ in results):
+            return None
+        return [recipe_id for _, _, recipe_id in results]
+
+    def recommend(self, ingredients, limit=3):
+        """Recipes served from local data, or None when coverage is too low"""
+        recipe_ids = self._winners(ingredients, limit)
+        if recipe_ids is None:
+            return None
+        with get_cursor() as cursor:
+            cursor.execute(LOAD_SQL.format(ids='%s'), (recipe_ids,))
+            return self._ordered(recipe_ids, cursor.fetchall())
+
+    async def recommend_async(self, db, ingredients, limit=3):
+        """asyncpg twin of recommend(); db is a pool or connection"""
+        recipe_ids = self._winners(ingredients, limit)
+        if recipe_ids is None:
+            return None
+        return self._ordered(recipe_ids, await db.fetch(LOAD_SQL.format(ids='$1::integer[]'), recipe_ids))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'recipes': len(self._phrases),
+                'terms': len(self._postings),
+                'max_id': self._max_id,
+                'loaded': self._loaded_at is not None,
+            }
+
+
+recipe_index = RecipeIndex(
+    min_coverage=float(os.getenv('RECIPE_INDEX_MIN_COVERAGE', 0.75)),
+    refresh_interval=float(os.getenv('RECIPE_INDEX_REFRESH', 60)),
+)
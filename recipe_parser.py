@@ -0,0 +1,289 @@
+"""Parsing of recipe lists out of LLM responses
+
+Models wrap the JSON we ask for in code fences and prose, return an object
+instead of an array, cut the array off at max_tokens, or answer in numbered
+markdown. parse_recipes() copes with all of these in time linear in the
+response length:
+
+1. A single scan finds every JSON object that is an element of an array (or
+   stands alone), tracking strings so brackets inside values don't count.
+   Objects nested inside such an element (a recipe's step objects) are part
+   of it, not recipes of their own. Objects that are cut off are skipped;
+   the complete ones before them are kept.
+2. If no object validates as a recipe, numbered-markdown recipes are read
+   line by line.
+
+Every recipe is normalized to {'name', 'ingredients', 'instructions'} with
+string values, the shape stored in the recipes table.
+"""
+import ast
+import json
+import re
+
+MAX_NAME = 200
+MAX_INGREDIENTS = 2000
+MAX_INSTRUCTIONS = 5000
+MAX_RECIPE_DEPTH = 3
+
+NAME_KEYS = ('name', 'title', 'recipe_name', 'recipe', 'dish')
+INGREDIENT_KEYS = ('ingredients', 'ingredient_list')
+QUANTITY_KEYS = ('quantity', 'amount', 'qty', 'unit')
+INSTRUCTION_KEYS = ('instructions', 'steps', 'directions', 'method', 'preparation')
+
+# The shape requested in structured-output mode (see recipe_response_format)
+RECIPE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'recipes': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'name': {'type': 'string'},
+                    'ingredients': {'type': 'array', 'items': {'type': 'string'}},
+                    'instructions': {'type': 'string'},
+                },
+                'required': ['name', 'ingredients', 'instructions'],
+                'additionalProperties': False,
+            },
+        },
+    },
+    'required': ['recipes'],
+    'additionalProperties': False,
+}
+
+_TRAILING_COMMA_RE = re.compile(r',(\s*[}\]])')
+_LIST_MARKER_RE = re.compile(r'^(?:[-*+•]|\d{1,2}[.)])\s+')
+_EMPHASIS_RE = re.compile(r'[*_`#]+')
+
+
+class RecipeParseError(ValueError):
+    """Raised when a response contains no usable recipe"""
+
+
+def _clean(text):
+    return ' '.join(_EMPHASIS_RE.sub('', str(text)).split())
+
+
+def _text_item(item):
+    """One ingredient or step as text; dict items read quantity first ('2 cups flour')"""
+    if isinstance(item, dict):
+        values = sorted(item.items(), key=lambda kv: QUANTITY_KEYS.index(kv[0]) - len(QUANTITY_KEYS)
+                        if kv[0] in QUANTITY_KEYS else 0)
+        return ' '.join(_clean(v) for _, v in values if isinstance(v, (str, int, float)) and str(v).strip())
+    if isinstance(item, (str, int, float)):
+        return _LIST_MARKER_RE.sub('', _clean(item))
+    return ''
+
+
+def _field(obj, keys):
+    for key in keys:
+        for candidate in (key, key.capitalize(), key.upper()):
+            if candidate in obj:
+                return obj[candidate]
+    return None
+
+
+def _joined(value, sep, limit):
+    if isinstance(value, (list, tuple)):
+        text = sep.join(item for item in map(_text_item, value) if item)
+    elif isinstance(value, (str, int, float)):
+        text = _clean(value)
+    else:
+        text = ''
+    return text[:limit]
+
+
+def normalize_recipe(obj):
+    """{'name', 'ingredients', 'instructions'} as strings, or None if obj is not a recipe
+
+    A recipe needs a name and at least one of ingredients or instructions.
+    Common aliases (title, steps, directions...) and list or object values
+    are accepted.
+    """
+    if not isinstance(obj, dict):
+        return None
+    name = _field(obj, NAME_KEYS)
+    if not isinstance(name, (str, int, float)):
+        return None
+    name = _LIST_MARKER_RE.sub('', _clean(name))[:MAX_NAME]
+    ingredients = _joined(_field(obj, INGREDIENT_KEYS), ', ', MAX_INGREDIENTS)
+    instructions = _joined(_field(obj, INSTRUCTION_KEYS), ' ', MAX_INSTRUCTIONS)
+    if not name or not (ingredients or instructions):
+        return None
+    return {'name': name, 'ingredients': ingredients, 'instructions': instructions}
+
+
+def _load_object(text):
+    """Decode one JSON object, forgiving trailing commas and Python-style quoting"""
+    try:
+        return json.loads(text)
+    except (ValueError, RecursionError):
+        pass
+    repaired = _TRAILING_COMMA_RE.sub(r'\1', text)
+    try:
+        return json.loads(repaired)
+    except (ValueError, RecursionError):
+        pass
+    try:
+        return ast.literal_eval(repaired)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+
+class RecipeStreamParser:
+    """Incremental parser that yields each recipe of a streamed response
+
+    Feed it completion deltas as they arrive; feed() returns the normalized
+    recipes that became complete with that chunk. Objects are picked up
+    wherever they are array elements, so a bare array, an array in a code
+    fence after some prose, and {"recipes": [...]} all stream recipe by
+    recipe. Objects inside another array element, such as a recipe's
+    {"name": ..., "instructions": ...} steps, are never recipes themselves.
+    Brackets and quotes in prose outside any JSON are ignored.
+    """
+
+    def __init__(self):
+        self.count = 0
+        # [(opener, start offset in _chars, is an array element, inside one)]
+        self._stack = []
+        self._chars = []     # text since the outermost open bracket
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, chunk):
+        completed = []
+        stack = self._stack
+        chars = self._chars
+        for ch in chunk:
+            if not stack:
+                # Outside JSON: only an opening bracket matters
+                if ch == '{' or ch == '[':
+                    chars.clear()
+                    chars.append(ch)
+                    stack.append((ch, 0, False, False))
+                continue
+
+            chars.append(ch)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == '\\':
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == '{' or ch == '[':
+                parent = stack[-1]
+                stack.append((ch, len(chars) - 1, parent[0] == '[', parent[2] or parent[3]))
+            elif ch == '}' or ch == ']':
+                opener = '{' if ch == '}' else '['
+                # Tolerate a stray closer by unwinding to its opener, if any
+                depth = len(stack) - 1
+                while depth >= 0 and stack[depth][0] != opener:
+                    depth -= 1
+                if depth < 0:
+                    continue
+                _, start, element, enclosed = stack[depth]
+                del stack[depth:]
+                # Recipes sit at most at {"recipes": [{...}]} depth; decoding
+                # only shallow objects keeps deeply nested input linear
+                if opener == '{' and depth <= MAX_RECIPE_DEPTH and (element or not depth) and not enclosed:
+                    recipe = normalize_recipe(_load_object(''.join(chars[start:])))
+                    if recipe is not None:
+                        completed.append(recipe)
+                        self.count += 1
+                if not stack:
+                    chars.clear()
+        return completed
+
+
+# Patterns are anchored and unambiguous so each line is matched in linear time
+_HEADING_RE = re.compile(r'^[#*\s]*((?:recipe|option)\s*)?(\d{1,2})\s*[.):\-]\s*(.+)$', re.IGNORECASE)
+_SECTION_RE = re.compile(r'^[-*#\s]*(ingredients|instructions|steps|directions|method|preparation)\b[*\s]*:?[*\s]*(.*)$',
+                         re.IGNORECASE)
+
+
+def _starts_recipe(raw, match, section, next_number):
+    """Whether a numbered line is a recipe heading rather than an ingredient or step"""
+    line = raw.strip()
+    if section is None or match.group(1) or line.startswith(('#', '**')):
+        return True
+    # Steps are numbered too: only the next recipe's number, unindented and
+    # short and unpunctuated like a name, starts a new recipe
+    name = _clean(match.group(3))
+    return (section == 'instructions' and match.group(2) == str(next_number)
+            and not raw.startswith((' ', '\t')) and len(name) <= 60 and not name.endswith(('.', '!', ':')))
+
+
+def parse_text_recipes(text):
+    """Recipes from a numbered markdown answer (the fallback for non-JSON responses)
+
+    Understands headings such as "1. Name", "2) Name", "**3. Name**",
+    "### Recipe 1: Name", and Ingredients/Instructions sections given
+    inline ("Ingredients: a, b") or as the bulleted or numbered lines that
+    follow the section label.
+    """
+    recipes = []
+    current = None
+    section = None
+
+    for raw in text.splitlines():
+        line = raw.strip()
+        if not line or line.startswith('```'):
+            continue
+
+        match = _SECTION_RE.match(line)
+        if match and current is not None:
+            section = 'ingredients' if match.group(1).lower() == 'ingredients' else 'instructions'
+            if match.group(2).strip():
+                current[section].append(match.group(2))
+            continue
+
+        match = _HEADING_RE.match(line)
+        if match and _starts_recipe(raw, match, section, len(recipes) + 2):
+            if current is not None:
+                recipes.append(current)
+            current = {'name': match.group(3), 'ingredients': [], 'instructions': []}
+            section = None
+            continue
+
+        if current is not None and section is not None:
+            current[section].append(line)
+
+    if current is not None:
+        recipes.append(current)
+
+    normalized = (normalize_recipe(recipe) for recipe in recipes)
+    return [recipe for recipe in normalized if recipe is not None]
+
+
+def parse_recipes(text, limit=3):
+    """Up to `limit` normalized recipes from an LLM response
+
+    Raises RecipeParseError when neither JSON nor numbered markdown yields
+    a recipe.
+    """
+    text = text or ''
+    parser = RecipeStreamParser()
+    recipes = parser.feed(text)
+    if not recipes:
+        recipes = parse_text_recipes(text)
+    if not recipes:
+        raise RecipeParseError(f'No recipes found in a {len(text)}-character response')
+    return recipes[:limit]
+
+
+def recipe_response_format(mode):
+    """OpenAI-style response_format for structured output, or None
+
+    mode is 'json_schema' (strict schema, for models that support it),
+    'json_object' (any valid JSON) or 'none'.
+    """
+    if mode == 'json_schema':
+        return {'type': 'json_schema',
+                'json_schema': {'name': 'recipes', 'strict': True, 'schema': RECIPE_SCHEMA}}
+    if mode == 'json_object':
+        return {'type': 'json_object'}
+    return None
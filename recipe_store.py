@@ -0,0 +1,195 @@
+"""Bulk persistence and paginated reads of saved recipes"""
+import base64
+from datetime import datetime
+
+# Full-text rank plus name similarity, as real so a cursor can carry it exactly.
+# Both conditions are answered by the per-user GIN indexes from 0010_recipe_search.
+SEARCH_RECIPES_SQL = """
+    WITH matches AS (
+        SELECT id, recipe_name, ingredients, instructions, created_at,
+               (ts_rank_cd(search_vector, query) + word_similarity(%s, recipe_name))::real AS score
+        FROM recipes, websearch_to_tsquery('english', %s) AS query
+        WHERE user_id = %s
+          AND (search_vector @@ query OR %s <%% recipe_name)
+    )
+    SELECT id, recipe_name, ingredients, instructions, created_at, score
+    FROM matches
+    WHERE {after}
+    ORDER BY score DESC, id DESC
+    LIMIT %s
+"""
+
+# RETURNING order is not guaranteed, so ids are drawn up front next to each
+# input's position and the rows are returned in input order
+INSERT_RECIPES_SQL = """
+    WITH input AS (
+        SELECT nextval(pg_get_serial_sequence('recipes', 'id')) AS id, r.*
+        FROM unnest({names}::text[], {ingredients}::text[], {instructions}::text[])
+             WITH ORDINALITY AS r(recipe_name, ingredients, instructions, position)
+    ),
+    inserted AS (
+        INSERT INTO recipes (id, recipe_name, ingredients, instructions, user_id)
+        SELECT id, recipe_name, ingredients, instructions, {user_id}
+        FROM input
+        RETURNING id, created_at
+    )
+    SELECT inserted.id, inserted.created_at
+    FROM input JOIN inserted ON inserted.id = input.id
+    ORDER BY input.position
+"""
+
+
+def recipe_row(recipe):
+    """(name, ingredients, instructions) as stored in the recipes table"""
+    # Convert ingredients and instructions to strings if they are lists
+    ingredients_str = recipe['ingredients']
+    if isinstance(ingredients_str, list):
+        ingredients_str = ', '.join(ingredients_str)
+
+    instructions_str = recipe['instructions']
+    if isinstance(instructions_str, list):
+        instructions_str = ' '.join(instructions_str)
+
+    return recipe['name'], ingredients_str, instructions_str
+
+
+def _columns(recipes):
+    rows = [recipe_row(recipe) for recipe in recipes]
+    return [list(column) for column in zip(*rows)] if rows else [[], [], []]
+
+
+def _apply(recipes, returned):
+    for recipe, row in zip(recipes, returned):
+        recipe['id'] = row['id']
+        recipe['created_at'] = row['created_at'].strftime('%Y-%m-%d %H:%M')
+    return recipes
+
+
+def insert_recipes(cursor, user_id, recipes):
+    """Insert recipes for a user with one statement; sets 'id' and 'created_at' on each
+
+    Rows come back in the order of the input arrays.
+    """
+    if not recipes:
+        return recipes
+    names, ingredients, instructions = _columns(recipes)
+    cursor.execute(
+        INSERT_RECIPES_SQL.format(user_id='%s', names='%s', ingredients='%s', instructions='%s'),
+        (names, ingredients, instructions, user_id)
+    )
+    return _apply(recipes, cursor.fetchall())
+
+
+async def insert_recipes_async(conn, user_id, recipes):
+    """asyncpg twin of insert_recipes"""
+    if not recipes:
+        return recipes
+    names, ingredients, instructions = _columns(recipes)
+    returned = await conn.fetch(
+        INSERT_RECIPES_SQL.format(user_id='$1::integer', names='$2', ingredients='$3', instructions='$4'),
+        user_id, names, ingredients, instructions
+    )
+    return _apply(recipes, returned)
+
+
+class InvalidCursor(ValueError):
+    """Raised for a page cursor that was not produced by encode_cursor() or encode_search_cursor()"""
+
+
+def encode_cursor(created_at, recipe_id):
+    raw = f"{created_at.isoformat()}|{recipe_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        created_at, recipe_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(recipe_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(str(e))
+
+
+def encode_search_cursor(score, recipe_id):
+    # repr() round-trips the float exactly, so the next page starts right after this row
+    raw = f"{score!r}|{recipe_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_search_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        score, recipe_id = raw.rsplit('|', 1)
+        return float(score), int(recipe_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(str(e))
+
+
+def recipe_history(cursor, user_id, limit, after=None, since=None, until=None, name=None):
+    """One page of a user's recipes, newest first, as (rows, next_cursor)
+
+    Keyset pagination on (created_at, id) against
+    idx_recipes_user_created_id, so every page costs the same however deep
+    it is. `after` is a cursor from a previous page; `since`/`until` bound
+    created_at (until is exclusive); `name` is a case-insensitive substring.
+    """
+    conditions = ["user_id = %s"]
+    params = [user_id]
+    if after:
+        created_at, recipe_id = decode_cursor(after)
+        conditions.append("(created_at, id) < (%s, %s)")
+        params += [created_at, recipe_id]
+    if since:
+        conditions.append("created_at >= %s")
+        params.append(since)
+    if until:
+        conditions.append("created_at < %s")
+        params.append(until)
+    if name:
+        escaped = name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conditions.append("recipe_name ILIKE %s")
+        params.append(f"%{escaped}%")
+
+    # One extra row tells us whether another page exists
+    cursor.execute(f"""
+        SELECT id, recipe_name, ingredients, instructions, created_at
+        FROM recipes
+        WHERE {' AND '.join(conditions)}
+        ORDER BY created_at DESC, id DESC
+        LIMIT %s
+    """, (*params, limit + 1))
+    rows = cursor.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id'])
+    return rows, next_cursor
+
+
+def search_recipes(cursor, user_id, query, limit, after=None, name_similarity=0.5):
+    """One page of a user's recipes matching `query`, best first, as (rows, next_cursor)
+
+    Full-text matches over name, ingredients and instructions (websearch
+    syntax: quoted phrases, OR, -word), plus names within `name_similarity`
+    trigram word similarity of the query, so "chiken" still finds "Chicken
+    Curry". Pages are keyed on (score, id); `after` is a cursor from a
+    previous page.
+    """
+    condition, params = "TRUE", []
+    if after:
+        score, recipe_id = decode_search_cursor(after)
+        condition = "(score, id) < (%s::real, %s)"
+        params = [score, recipe_id]
+
+    # The <% operator's threshold, for this transaction only
+    cursor.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)", (str(name_similarity),))
+    cursor.execute(SEARCH_RECIPES_SQL.format(after=condition),
+                   (query, query, user_id, query, *params, limit + 1))
+    rows = cursor.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_search_cursor(rows[-1]['score'], rows[-1]['id'])
+    return rows, next_cursor
@@ -0,0 +1,252 @@
+"""Background recommendation jobs: submit now, collect the result later
+
+A completion takes 3-15s, too long to hold a sync worker's request open.
+POST /recommendation_jobs records a job and returns its id at once. A small
+per-worker thread pool runs the completion, parsing and persistence. The
+client then polls GET /recommendation_jobs/<id>, optionally with ?wait=N
+to long-poll until the job finishes.
+
+At most JOB_THREADS jobs run at once in a worker and JOB_QUEUE more may
+wait. Beyond that, submit raises JobQueueFull rather than building a
+backlog nobody will wait for. Jobs live in recommendation_jobs, so any
+worker can answer a poll. Long polls for a job running in this worker wake
+as soon as it finishes; polls for other workers' jobs re-read the row with
+backoff. A job still queued JOB_TIMEOUT seconds after submission, or still
+running JOB_TIMEOUT seconds after it started (its worker died), is
+reported as failed; a queued job past that point is never started.
+"""
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2.extras import Json
+
+from db import get_cursor
+from logs import get_logger
+from metrics import observe_job
+
+log = get_logger('jobs')
+
+FINISHED = ('done', 'failed')
+
+JOB_SQL = """
+    SELECT id, status, result, error, error_status,
+           EXTRACT(EPOCH FROM COALESCE(started_at, LOCALTIMESTAMP) - submitted_at) AS queue_seconds,
+           EXTRACT(EPOCH FROM finished_at - started_at) AS run_seconds,
+           CASE status
+               WHEN 'queued' THEN submitted_at < LOCALTIMESTAMP - make_interval(secs => %(timeout)s)
+               WHEN 'running' THEN started_at < LOCALTIMESTAMP - make_interval(secs => %(timeout)s)
+               ELSE FALSE
+           END AS abandoned
+    FROM recommendation_jobs
+    WHERE id = %(job_id)s::uuid AND user_id = %(user_id)s
+"""
+
+
+class JobQueueFull(Exception):
+    """Raised when JOB_THREADS jobs are running and JOB_QUEUE more are waiting"""
+
+
+class JobFailed(Exception):
+    """Raised by a job function with the message and HTTP status to report for it"""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class JobRunner:
+    """Bounded thread pool that runs jobs and records their progress in recommendation_jobs"""
+
+    def __init__(self, threads=4, queue=32, timeout=120.0, retention=86400.0, poll_interval=0.1,
+                 max_poll_interval=1.0):
+        self.threads = threads
+        self.timeout = timeout
+        self.retention = retention
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='job')
+        self._slots = threading.BoundedSemaphore(threads + queue)
+        self._events = {}
+        self._lock = threading.Lock()
+        self._last_purge = time.monotonic()
+        self._stats = {'submitted': 0, 'done': 0, 'failed': 0, 'rejected': 0, 'queued': 0, 'running': 0}
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def submit(self, user_id, ingredients, fn):
+        """Record a job and queue fn() to run it; returns the job id
+
+        fn() returns the job's JSON result, or raises JobFailed. Raises
+        JobQueueFull when the pool has no room.
+        """
+        if not self._slots.acquire(blocking=False):
+            self._count('rejected')
+            observe_job('rejected')
+            raise JobQueueFull(f'{self.threads} jobs running and the queue is full')
+        job_id = str(uuid.uuid4())
+        try:
+            with get_cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO recommendation_jobs (id, user_id, ingredients, submitted_at)
+                    VALUES (%s::uuid, %s, %s, LOCALTIMESTAMP)
+                """, (job_id, user_id, ingredients))
+            with self._lock:
+                self._events[job_id] = threading.Event()
+                self._stats['submitted'] += 1
+                self._stats['queued'] += 1
+            self._executor.submit(self._execute, job_id, fn)
+        except BaseException:
+            with self._lock:
+                self._events.pop(job_id, None)
+            self._slots.release()
+            raise
+        return job_id
+
+    def _execute(self, job_id, fn):
+        try:
+            self._count('queued', -1)
+            self._count('running')
+            with get_cursor() as cursor:
+                # A job polls already report as lost is not worth the LLM spend
+                cursor.execute("""
+                    UPDATE recommendation_jobs SET status = 'running', started_at = LOCALTIMESTAMP
+                    WHERE id = %s::uuid AND status = 'queued'
+                      AND submitted_at >= LOCALTIMESTAMP - make_interval(secs => %s)
+                    RETURNING EXTRACT(EPOCH FROM started_at - submitted_at) AS queue_seconds
+                """, (job_id, self.timeout))
+                row = cursor.fetchone()
+            if row is None:
+                log.warning("Job expired in the queue", extra={'job_id': job_id})
+                self._count('failed')
+                observe_job('failed')
+                return
+            queued = float(row['queue_seconds'])
+
+            started = time.perf_counter()
+            result, error = None, None
+            try:
+                result = fn()
+            except JobFailed as e:
+                error = e
+            except Exception as e:
+                log.exception("Job failed", extra={'job_id': job_id})
+                error = JobFailed('The job failed. Please try again.')
+            ran = time.perf_counter() - started
+
+            with get_cursor() as cursor:
+                cursor.execute("""
+                    UPDATE recommendation_jobs
+                    SET status = %s, result = %s, error = %s, error_status = %s, finished_at = LOCALTIMESTAMP
+                    WHERE id = %s::uuid
+                """, ('failed' if error else 'done', Json(result) if error is None else None,
+                      error.message if error else None, error.status if error else None, job_id))
+            outcome = 'failed' if error else 'done'
+            self._count(outcome)
+            observe_job(outcome, queued, ran)
+        except Exception:
+            # The row stays unfinished and is reported as failed after the timeout
+            log.exception("Job bookkeeping failed", extra={'job_id': job_id})
+        finally:
+            self._count('running', -1)
+            self._slots.release()
+            with self._lock:
+                event = self._events.pop(job_id, None)
+            if event is not None:
+                event.set()
+            self._maybe_purge()
+
+    def _describe(self, row):
+        job = {'id': str(row['id']), 'status': row['status'],
+               'queue_seconds': round(float(row['queue_seconds']), 3) if row['queue_seconds'] is not None else None,
+               'run_seconds': round(float(row['run_seconds']), 3) if row['run_seconds'] is not None else None}
+        if row['abandoned']:
+            job.update(status='failed', error='The job was lost. Please try again.', error_status=500)
+        elif row['status'] == 'done':
+            job.update(row['result'] or {})
+        elif row['status'] == 'failed':
+            job.update(error=row['error'], error_status=row['error_status'])
+        return job
+
+    def get(self, job_id, user_id, wait=0.0):
+        """The job as a dict, waiting up to `wait` seconds for it to finish; None if not the user's job"""
+        deadline = time.monotonic() + wait
+        interval = self.poll_interval
+        while True:
+            with get_cursor() as cursor:
+                cursor.execute(JOB_SQL, {'timeout': self.timeout, 'job_id': job_id, 'user_id': user_id})
+                row = cursor.fetchone()
+            if row is None:
+                return None
+            job = self._describe(row)
+            remaining = deadline - time.monotonic()
+            if job['status'] in FINISHED or remaining <= 0:
+                return job
+            with self._lock:
+                event = self._events.get(job_id)
+            if event is not None:
+                # Running here: wake as soon as it finishes
+                event.wait(remaining)
+            else:
+                time.sleep(min(interval, remaining))
+                interval = min(interval * 1.5, self.max_poll_interval)
+
+    def _maybe_purge(self, every=600.0):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_purge < every:
+                return
+            self._last_purge = now
+        try:
+            with get_cursor() as cursor:
+                # Ages by the job's last activity like JOB_SQL; submitted_at
+                # is never later, so its index still narrows the scan
+                cursor.execute("""
+                    DELETE FROM recommendation_jobs
+                    WHERE submitted_at < LOCALTIMESTAMP - make_interval(secs => %(retention)s)
+                      AND COALESCE(finished_at, started_at, submitted_at)
+                          < LOCALTIMESTAMP - make_interval(secs => %(retention)s)
+                """, {'retention': self.retention})
+        except Exception:
+            log.exception("Job purge failed")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['threads'] = self.threads
+        return stats
+
+
+_runner = None
+_runner_pid = None
+_runner_lock = threading.Lock()
+
+
+def get_job_runner():
+    """This worker's job pool, created lazily so threads are never shared across fork"""
+    global _runner, _runner_pid
+    pid = os.getpid()
+    if _runner is not None and _runner_pid == pid:
+        return _runner
+    with _runner_lock:
+        if _runner is None or _runner_pid != pid:
+            _runner = JobRunner(
+                threads=int(os.getenv('JOB_THREADS', 4)),
+                queue=int(os.getenv('JOB_QUEUE', 32)),
+                timeout=float(os.getenv('JOB_TIMEOUT', 120)),
+                retention=float(os.getenv('JOB_RETENTION', 86400)),
+            )
+            _runner_pid = pid
+    return _runner
+
+
+def job_stats():
+    """Job pool statistics for this worker, or None before first use"""
+    if _runner is None or _runner_pid != os.getpid():
+        return None
+    return _runner.stats()
@@ -0,0 +1,146 @@
+"""Resolve pending payments against IntaSend
+
+    python reconcile.py                  # one pass
+    python reconcile.py --every 900      # keep reconciling every 15 minutes
+
+Pending payments older than --min-age are scanned in batches (keyset on id)
+and their checkout status is fetched concurrently, at most --workers calls
+at a time. Paid checkouts are activated through process_successful_payment,
+failed ones are marked 'failed', and payments still unpaid after
+--expire-after hours (or that never got a checkout id) are marked 'expired'.
+"""
+import argparse
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from db import get_cursor
+from intasend import get_client
+from logs import get_logger
+
+log = get_logger('reconcile')
+
+FAILED_STATES = {'FAILED', 'CANCELED', 'CANCELLED'}
+
+
+class Reconciler:
+    """One reconciliation pass per run(); outcome counters accumulate across runs"""
+
+    def __init__(self, activate, batch_size=100, workers=8, min_age=600, expire_after=24 * 3600):
+        self.activate = activate
+        self.batch_size = batch_size
+        self.workers = workers
+        self.min_age = min_age
+        self.expire_after = expire_after
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def pending_batch(self, after_id):
+        with get_cursor() as cursor:
+            cursor.execute("""
+                SELECT id, user_id, plan_id, amount, transaction_id, checkout_id,
+                       created_at < NOW() - %s * INTERVAL '1 second' AS stale
+                FROM payments
+                WHERE status = 'pending' AND id > %s
+                  AND created_at < NOW() - %s * INTERVAL '1 second'
+                ORDER BY id
+                LIMIT %s
+            """, (self.expire_after, after_id, self.min_age, self.batch_size))
+            return cursor.fetchall()
+
+    def check(self, payment):
+        """Outcome for one payment: activated, failed, expire, pending or error"""
+        if not payment['checkout_id']:
+            return 'expire' if payment['stale'] else 'pending'
+
+        try:
+            response = get_client().checkout_status(payment['checkout_id'])
+        except Exception as e:
+            log.warning("Status lookup failed", extra={'payment_id': payment['id'], 'error': str(e)})
+            return 'error'
+
+        if response.status_code == 200:
+            checkout = response.json()
+            if checkout.get('paid'):
+                activated = self.activate(payment['user_id'], payment['plan_id'], payment['amount'],
+                                          payment['checkout_id'], payment['transaction_id'])
+                return 'activated' if activated else 'error'
+            if str(checkout.get('state', '')).upper() in FAILED_STATES:
+                return 'failed'
+        elif response.status_code != 404:
+            return 'error'
+
+        return 'expire' if payment['stale'] else 'pending'
+
+    def _close(self, ids, status):
+        if not ids:
+            return
+        with get_cursor() as cursor:
+            cursor.execute("""
+                UPDATE payments
+                SET status = %s, updated_at = NOW()
+                WHERE id = ANY(%s) AND status = 'pending'
+            """, (status, ids))
+
+    def run(self):
+        """Reconcile every due pending payment once; returns this pass's counters"""
+        before = Counter(self.counters)
+        started = time.monotonic()
+        after_id = 0
+        with ThreadPoolExecutor(self.workers) as pool:
+            while True:
+                batch = self.pending_batch(after_id)
+                if not batch:
+                    break
+                after_id = batch[-1]['id']
+
+                outcomes = list(pool.map(self.check, batch))
+                for outcome in outcomes:
+                    self._count('expired' if outcome == 'expire' else outcome)
+                self._count('batches')
+
+                self._close([p['id'] for p, o in zip(batch, outcomes) if o == 'expire'], 'expired')
+                self._close([p['id'] for p, o in zip(batch, outcomes) if o == 'failed'], 'failed')
+
+        elapsed = time.monotonic() - started
+        result = self.counters - before
+        checked = sum(v for k, v in result.items() if k != 'batches')
+        log.info("Reconciliation pass finished", extra={'checked': checked, 'seconds': round(elapsed, 2),
+                                                        'per_second': round(checked / elapsed, 1) if elapsed else 0,
+                                                        **result})
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reconcile pending IntaSend payments')
+    parser.add_argument('--batch-size', type=int, default=int(os.getenv('RECONCILE_BATCH_SIZE', 100)))
+    parser.add_argument('--workers', type=int, default=int(os.getenv('RECONCILE_WORKERS', 8)))
+    parser.add_argument('--min-age', type=float, default=600, help='seconds before a pending payment is checked')
+    parser.add_argument('--expire-after', type=float, default=24, help='hours before an unpaid payment expires')
+    parser.add_argument('--every', type=float, help='repeat every N seconds instead of running once')
+    args = parser.parse_args()
+
+    from app import process_successful_payment
+
+    reconciler = Reconciler(process_successful_payment, batch_size=args.batch_size, workers=args.workers,
+                            min_age=args.min_age, expire_after=args.expire_after * 3600)
+    while True:
+        try:
+            reconciler.run()
+        except Exception:
+            if not args.every:
+                raise
+            log.exception("Reconciliation pass failed")
+        if not args.every:
+            break
+        time.sleep(args.every)
+
+
+if __name__ == '__main__':
+    main()
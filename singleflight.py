@@ -0,0 +1,353 @@
+"""Coalesce concurrent identical recommendation requests into one LLM call"""
+import asyncio
+import copy
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from psycopg2.extras import Json
+
+from db import get_cursor
+from logs import get_logger
+
+log = get_logger('singleflight')
+
+# Shared by the psycopg2 and asyncpg paths; placeholders are filled per driver
+CLAIM_SQL = """
+    INSERT INTO inflight_recommendations (cache_key, owner, started_at)
+    VALUES ({key}, {owner}, NOW())
+    ON CONFLICT (cache_key) DO UPDATE
+    SET owner = EXCLUDED.owner, started_at = NOW(), finished_at = NULL, result = NULL, error = NULL,
+        error_status = NULL
+    WHERE inflight_recommendations.finished_at IS NOT NULL
+       OR inflight_recommendations.started_at < NOW() - {lease} * INTERVAL '1 second'
+    RETURNING owner
+"""
+
+FINISH_SQL = """
+    UPDATE inflight_recommendations
+    SET result = {result}, error = {error}, error_status = {status}, finished_at = NOW()
+    WHERE cache_key = {key} AND owner = {owner}
+"""
+
+POLL_SQL = """
+    SELECT result, error, error_status, finished_at
+    FROM inflight_recommendations
+    WHERE cache_key = {key}
+"""
+
+PURGE_SQL = """
+    DELETE FROM inflight_recommendations
+    WHERE started_at < NOW() - {older_than} * INTERVAL '1 second'
+"""
+
+_PG = {'key': '%s', 'owner': '%s', 'lease': '%s', 'result': '%s', 'error': '%s', 'status': '%s',
+       'older_than': '%s'}
+
+
+class LeaderFailed(Exception):
+    """Raised to waiters in other workers when the leader's call failed
+
+    Carries the message and HTTP status describe_error gave the leader's
+    exception, since the exception itself can't cross processes.
+    """
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs fn once per key while duplicates wait for its result
+
+    Threads in this worker wait on the leader directly. Across workers the
+    leader claims a row in inflight_recommendations and publishes the result
+    (or error) there, and other workers poll that row. A claim older than
+    `lease` seconds is treated as abandoned and can be taken over.
+
+    do_async() is the same for coroutines on an asyncpg pool, so async
+    serving mode coalesces with itself and with sync workers.
+    """
+
+    def __init__(self, lease=60.0, poll_interval=0.05, max_poll_interval=0.5):
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+        self._last_purge = time.monotonic()
+        self._stats = {
+            'leaders': 0,
+            'local_waits': 0,
+            'shared_waits': 0,
+            'fallbacks': 0,
+            'purged': 0,
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def do(self, key, fn, describe_error=None):
+        """Result of fn(), shared with every concurrent caller using the same key
+
+        Callers in this worker get fn()'s own exception. Waiters in other
+        workers get LeaderFailed with the (message, HTTP status) that
+        describe_error(e) gives it, or (str(e), 500) by default.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            self._count('local_waits')
+            if call.event.wait(self.lease):
+                if call.error is not None:
+                    raise call.error
+                return copy.deepcopy(call.result)
+            # The leader is stuck; do the work rather than wait forever
+            self._count('fallbacks')
+            return fn()
+
+        try:
+            call.result = self._do_shared(key, fn, describe_error)
+            return copy.deepcopy(call.result)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def _do_shared(self, key, fn, describe_error):
+        owner = self._owner()
+        try:
+            claimed = self._claim(key, owner)
+        except Exception as e:
+            log.warning("Single-flight claim failed, calling directly", extra={'error': str(e)})
+            self._count('fallbacks')
+            return fn()
+
+        if claimed:
+            self._count('leaders')
+            try:
+                result = fn()
+            except Exception as e:
+                self._finish(key, owner, error=self._describe(e, describe_error))
+                raise
+            self._finish(key, owner, result=result)
+            self._maybe_purge()
+            return result
+
+        self._count('shared_waits')
+        result = self._wait_shared(key)
+        if result is None:
+            self._count('fallbacks')
+            return fn()
+        return result
+
+    async def do_async(self, db, key, fn, describe_error=None):
+        """asyncio twin of do(): awaits fn() once per key; db is an asyncpg pool
+
+        Coroutines in this worker await the leader's future; other workers,
+        sync or async, go through inflight_recommendations as with do().
+        """
+        call = self._async_calls.get(key)
+        if call is not None:
+            self._count('local_waits')
+            done, _ = await asyncio.wait({call}, timeout=self.lease)
+            if done and not call.cancelled():
+                if call.exception() is not None:
+                    raise call.exception()
+                return copy.deepcopy(call.result())
+            # The leader is stuck or was cancelled; do the work rather than wait forever
+            self._count('fallbacks')
+            return await fn()
+
+        call = self._async_calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self._do_shared_async(db, key, fn, describe_error)
+            call.set_result(result)
+            return copy.deepcopy(result)
+        except Exception as e:
+            call.set_exception(e)
+            # Retrieved here so a leader without waiters logs nothing extra
+            call.exception()
+            raise
+        finally:
+            self._async_calls.pop(key, None)
+            if not call.done():
+                call.cancel()
+
+    async def _do_shared_async(self, db, key, fn, describe_error):
+        owner = self._owner()
+        try:
+            claimed = await db.fetchrow(
+                CLAIM_SQL.format(key='$1', owner='$2', lease='$3::float8'), key, owner, self.lease
+            ) is not None
+        except Exception as e:
+            log.warning("Single-flight claim failed, calling directly", extra={'error': str(e)})
+            self._count('fallbacks')
+            return await fn()
+
+        if claimed:
+            self._count('leaders')
+            try:
+                result = await fn()
+            except Exception as e:
+                await self._finish_async(db, key, owner, error=self._describe(e, describe_error))
+                raise
+            await self._finish_async(db, key, owner, result=result)
+            await self._maybe_purge_async(db)
+            return result
+
+        self._count('shared_waits')
+        result = await self._wait_shared_async(db, key)
+        if result is None:
+            self._count('fallbacks')
+            return await fn()
+        return result
+
+    def _owner(self):
+        return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def _claim(self, key, owner):
+        with get_cursor() as cursor:
+            cursor.execute(CLAIM_SQL.format(**_PG), (key, owner, self.lease))
+            return cursor.fetchone() is not None
+
+    def _describe(self, e, describe_error):
+        if describe_error is not None:
+            try:
+                return describe_error(e)
+            except Exception:
+                log.exception("Single-flight error description failed")
+        return str(e), 500
+
+    def _finish(self, key, owner, result=None, error=None):
+        message, status = error or (None, None)
+        try:
+            with get_cursor() as cursor:
+                cursor.execute(FINISH_SQL.format(**_PG),
+                               (Json(result) if result is not None else None, message, status, key, owner))
+        except Exception as e:
+            log.warning("Single-flight result publish failed", extra={'error': str(e)})
+
+    async def _finish_async(self, db, key, owner, result=None, error=None):
+        message, status = error or (None, None)
+        try:
+            await db.execute(
+                FINISH_SQL.format(result='$1::jsonb', error='$2', status='$3::integer', key='$4', owner='$5'),
+                json.dumps(result) if result is not None else None, message, status, key, owner
+            )
+        except Exception as e:
+            log.warning("Single-flight result publish failed", extra={'error': str(e)})
+
+    def _outcome(self, row):
+        """The published result, LeaderFailed raised, or None while unfinished"""
+        if row['finished_at'] is None:
+            return None
+        if row['error']:
+            raise LeaderFailed(row['error'], row['error_status'] or 500)
+        return row['result']
+
+    def _wait_shared(self, key):
+        """Result published by another worker's leader, or None to compute locally"""
+        deadline = time.monotonic() + self.lease
+        interval = self.poll_interval
+        while time.monotonic() < deadline:
+            time.sleep(interval)
+            interval = min(interval * 1.5, self.max_poll_interval)
+            try:
+                with get_cursor() as cursor:
+                    cursor.execute(POLL_SQL.format(**_PG), (key,))
+                    row = cursor.fetchone()
+            except Exception as e:
+                log.warning("Single-flight poll failed", extra={'error': str(e)})
+                return None
+            if row is None:
+                return None
+            result = self._outcome(row)
+            if result is not None:
+                return result
+        return None
+
+    async def _wait_shared_async(self, db, key):
+        deadline = time.monotonic() + self.lease
+        interval = self.poll_interval
+        while time.monotonic() < deadline:
+            await asyncio.sleep(interval)
+            interval = min(interval * 1.5, self.max_poll_interval)
+            try:
+                row = await db.fetchrow(POLL_SQL.format(key='$1'), key)
+            except Exception as e:
+                log.warning("Single-flight poll failed", extra={'error': str(e)})
+                return None
+            if row is None:
+                return None
+            result = self._outcome(row)
+            if result is not None:
+                # asyncpg returns jsonb as text
+                return json.loads(result) if isinstance(result, str) else result
+        return None
+
+    def _purge_due(self, every):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_purge < every:
+                return False
+            self._last_purge = now
+            return True
+
+    def _maybe_purge(self, every=600.0):
+        # Leaders are the only writers, so they trim the table too
+        if not self._purge_due(every):
+            return
+        try:
+            self._count('purged', self.purge_finished())
+        except Exception as e:
+            log.warning("Single-flight purge failed", extra={'error': str(e)})
+
+    async def _maybe_purge_async(self, db, every=600.0, older_than=3600):
+        if not self._purge_due(every):
+            return
+        try:
+            status = await db.execute(PURGE_SQL.format(older_than='$1::float8'), older_than)
+            self._count('purged', int(status.split()[-1]))
+        except Exception as e:
+            log.warning("Single-flight purge failed", extra={'error': str(e)})
+
+    def purge_finished(self, older_than=3600):
+        """Delete finished or abandoned rows; returns the count
+
+        Runs at most every 10 minutes per worker, from the leader path.
+        """
+        with get_cursor() as cursor:
+            cursor.execute(PURGE_SQL.format(**_PG), (older_than,))
+            return cursor.rowcount
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._calls) + len(self._async_calls)
+        return stats
+
+
+recommendation_flight = SingleFlight(
+    lease=float(os.getenv('SINGLEFLIGHT_LEASE', 60)),
+)
@@ -0,0 +1,326 @@
+"""Token-bucket limits on LLM spend, per user and for the whole deployment
+
+Every recommendation that needs the LLM takes from two buckets: the user's
+and a global one. Each bucket holds requests and tokens, refilling at a
+steady rate up to a burst size. The buckets are rows in llm_spend_buckets,
+so all gunicorn workers and both serving modes share them. One statement
+refills both buckets, checks them and takes from them under row locks.
+When either bucket is empty the request gets a 429 straight away, before
+any call to OpenRouter.
+
+A request's real token count is only known after the completion. The
+admission check therefore reserves LLM_TOKEN_RESERVE tokens. Settling
+swaps that reservation for the total_tokens the completion reported. The
+token level can go negative; further requests wait until it refills.
+
+    LLM_USER_REQUESTS_PER_HOUR / LLM_USER_REQUEST_BURST
+    LLM_USER_TOKENS_PER_HOUR / LLM_USER_TOKEN_BURST
+    LLM_GLOBAL_REQUESTS_PER_HOUR / LLM_GLOBAL_REQUEST_BURST
+    LLM_GLOBAL_TOKENS_PER_HOUR / LLM_GLOBAL_TOKEN_BURST
+    LLM_SPEND_LIMITS=off disables the limiter
+"""
+import math
+import os
+import threading
+
+from db import get_cursor
+from logs import get_logger
+from metrics import observe_spend
+
+log = get_logger('spend')
+
+GLOBAL_KEY = 'global'
+
+# Every statement locks its rows in key order ('global' first), so
+# concurrent requests cannot deadlock
+TAKE_SQL = """
+    WITH limits AS (
+        SELECT * FROM unnest({keys}::text[], {request_burst}::float8[], {request_rate}::float8[],
+                             {token_burst}::float8[], {token_rate}::float8[])
+             AS l(key, request_burst, request_rate, token_burst, token_rate)
+    ), levels AS (
+        SELECT b.key,
+               LEAST(l.request_burst, b.requests + l.request_rate * e.elapsed) AS requests,
+               LEAST(l.token_burst, b.tokens + l.token_rate * e.elapsed) AS tokens
+        FROM llm_spend_buckets b
+        JOIN limits l USING (key)
+        CROSS JOIN LATERAL (SELECT GREATEST(0, EXTRACT(EPOCH FROM LOCALTIMESTAMP - b.updated_at))::float8
+                            AS elapsed) e
+        ORDER BY b.key
+        FOR UPDATE OF b
+    ), decision AS (
+        SELECT COUNT(*) = {count} AND COALESCE(bool_and(requests >= {requests} AND tokens > 0), false) AS allowed
+        FROM levels
+    )
+    UPDATE llm_spend_buckets b
+    SET requests = levels.requests - CASE WHEN decision.allowed THEN {requests} ELSE 0 END,
+        tokens = levels.tokens - CASE WHEN decision.allowed THEN {reserve} ELSE 0 END,
+        updated_at = LOCALTIMESTAMP
+    FROM levels, decision
+    WHERE b.key = levels.key
+    RETURNING b.key, b.requests, b.tokens, decision.allowed
+"""
+
+CREATE_SQL = """
+    INSERT INTO llm_spend_buckets (key, requests, tokens, updated_at)
+    SELECT key, request_burst, token_burst, LOCALTIMESTAMP
+    FROM unnest({keys}::text[], {request_burst}::float8[], {token_burst}::float8[])
+         AS l(key, request_burst, token_burst)
+    ON CONFLICT (key) DO NOTHING
+"""
+
+SETTLE_SQL = """
+    WITH locked AS (
+        SELECT key FROM llm_spend_buckets WHERE key = ANY({keys}::text[]) ORDER BY key FOR UPDATE
+    )
+    UPDATE llm_spend_buckets b SET tokens = b.tokens - {extra} FROM locked WHERE b.key = locked.key
+"""
+
+# Current levels without taking anything; a bucket never used is full
+LEVELS_SQL = """
+    SELECT l.key,
+           COALESCE(LEAST(l.request_burst, b.requests + l.request_rate * e.elapsed), l.request_burst) AS requests,
+           COALESCE(LEAST(l.token_burst, b.tokens + l.token_rate * e.elapsed), l.token_burst) AS tokens
+    FROM unnest(%s::text[], %s::float8[], %s::float8[], %s::float8[], %s::float8[])
+         AS l(key, request_burst, request_rate, token_burst, token_rate)
+    LEFT JOIN llm_spend_buckets b USING (key)
+    LEFT JOIN LATERAL (SELECT GREATEST(0, EXTRACT(EPOCH FROM LOCALTIMESTAMP - b.updated_at))::float8
+                       AS elapsed) e ON true
+"""
+
+_PSYCOPG = dict(keys='%s', request_burst='%s', request_rate='%s', token_burst='%s', token_rate='%s',
+                count='%s', requests='%s', reserve='%s', extra='%s')
+_ASYNCPG = dict(keys='$1', request_burst='$2', request_rate='$3', token_burst='$4', token_rate='$5',
+                count='$6::integer', requests='$7::float8', reserve='$8::float8')
+_ASYNCPG_CREATE = dict(keys='$1', request_burst='$2', token_burst='$3')
+_ASYNCPG_SETTLE = dict(keys='$1', extra='$2::float8')
+
+
+class SpendLimited(Exception):
+    """Raised when the user's or the global bucket cannot pay for another LLM request"""
+
+    def __init__(self, scope, retry_after, levels):
+        super().__init__(f'{scope} LLM spend limit reached; retry in {retry_after}s')
+        self.scope = scope
+        self.retry_after = retry_after
+        self.levels = levels
+
+
+class Limits:
+    """Burst sizes and hourly refill rates of one bucket"""
+
+    def __init__(self, request_burst, requests_per_hour, token_burst, tokens_per_hour):
+        self.request_burst = float(request_burst)
+        self.request_rate = requests_per_hour / 3600.0
+        self.token_burst = float(token_burst)
+        self.token_rate = tokens_per_hour / 3600.0
+
+    def retry_after(self, requests, tokens, needed=1):
+        """Whole seconds until this bucket holds `needed` requests and has tokens left"""
+        waits = [1.0]
+        if requests < needed:
+            waits.append((needed - requests) / self.request_rate if self.request_rate else math.inf)
+        if tokens <= 0:
+            waits.append(-tokens / self.token_rate if self.token_rate else math.inf)
+        wait = max(waits)
+        return math.ceil(wait) if math.isfinite(wait) else 3600
+
+    def describe(self, requests, tokens):
+        return {'requests': round(requests, 2), 'request_burst': self.request_burst,
+                'tokens': round(tokens), 'token_burst': self.token_burst}
+
+
+class Reservation:
+    """The spend taken for one admitted request or batch; settles when used as a context manager
+
+    Pass record() as model_router's on_usage callback. If no usage is
+    reported (a stream stopped early), fallback_tokens is charged instead;
+    a call that failed before any output reports nothing and is refunded.
+    """
+
+    def __init__(self, limiter, keys, reserved):
+        self._limiter = limiter
+        self.keys = keys
+        self.reserved = reserved
+        self.tokens = 0
+        self.fallback_tokens = 0
+        self.settled = False
+        self._lock = threading.Lock()
+
+    def record(self, model, usage):
+        with self._lock:
+            self.tokens += getattr(usage, 'total_tokens', 0) or 0
+
+    def charge(self):
+        return self.tokens or self.fallback_tokens
+
+    def settle(self):
+        self._limiter.settle(self)
+
+    async def settle_async(self, db):
+        await self._limiter.settle_async(db, self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.settle()
+
+
+class SpendLimiter:
+    """The user and global buckets, and this worker's count of decisions"""
+
+    def __init__(self, user_limits, global_limits, reserve=1000, enabled=True):
+        self.user_limits = user_limits
+        self.global_limits = global_limits
+        self.reserve_tokens = reserve
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stats = {'admitted': 0, 'limited_user': 0, 'limited_global': 0, 'tokens_charged': 0}
+        self._global_levels = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            Limits(float(os.getenv('LLM_USER_REQUEST_BURST', 10)),
+                   float(os.getenv('LLM_USER_REQUESTS_PER_HOUR', 60)),
+                   float(os.getenv('LLM_USER_TOKEN_BURST', 15000)),
+                   float(os.getenv('LLM_USER_TOKENS_PER_HOUR', 60000))),
+            Limits(float(os.getenv('LLM_GLOBAL_REQUEST_BURST', 200)),
+                   float(os.getenv('LLM_GLOBAL_REQUESTS_PER_HOUR', 3000)),
+                   float(os.getenv('LLM_GLOBAL_TOKEN_BURST', 200000)),
+                   float(os.getenv('LLM_GLOBAL_TOKENS_PER_HOUR', 3000000))),
+            reserve=float(os.getenv('LLM_TOKEN_RESERVE', 1000)),
+            enabled=os.getenv('LLM_SPEND_LIMITS', 'on').lower() not in ('off', 'false', '0'),
+        )
+
+    def _buckets(self, user_id):
+        return [(f'user:{user_id}', self.user_limits, 'user'), (GLOBAL_KEY, self.global_limits, 'global')]
+
+    def _columns(self, user_id):
+        buckets = self._buckets(user_id)
+        return ([key for key, _, _ in buckets],
+                [limits.request_burst for _, limits, _ in buckets],
+                [limits.request_rate for _, limits, _ in buckets],
+                [limits.token_burst for _, limits, _ in buckets],
+                [limits.token_rate for _, limits, _ in buckets])
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _decide(self, user_id, rows, requests=1):
+        """A Reservation, SpendLimited, or None when a bucket row does not exist yet"""
+        buckets = self._buckets(user_id)
+        levels = {row['key']: row for row in rows}
+        if len(levels) < len(buckets):
+            return None
+        described = {scope: limits.describe(levels[key]['requests'], levels[key]['tokens'])
+                     for key, limits, scope in buckets}
+        with self._lock:
+            self._global_levels = described['global']
+        if rows[0]['allowed']:
+            self._count('admitted')
+            observe_spend('admitted', described['global'])
+            return Reservation(self, [key for key, _, _ in buckets], self.reserve_tokens * requests)
+
+        # Report the bucket that will take longest to allow a request
+        waits = [(limits.retry_after(levels[key]['requests'], levels[key]['tokens'], requests), scope)
+                 for key, limits, scope in buckets
+                 if levels[key]['requests'] < requests or levels[key]['tokens'] <= 0]
+        retry_after, scope = max(waits)
+        self._count(f'limited_{scope}')
+        observe_spend(f'limited_{scope}', described['global'])
+        log.info("LLM spend limited", extra={'user_id': user_id, 'scope': scope, 'retry_after': retry_after})
+        return SpendLimited(scope, retry_after, described)
+
+    def reserve(self, user_id, requests=1):
+        """Take `requests` requests and their token reservation from both buckets
+
+        Returns a Reservation to settle once the completions are done.
+        Raises SpendLimited when either bucket cannot cover them all.
+        """
+        if not self.enabled:
+            return Reservation(self, [], 0)
+        keys, request_burst, request_rate, token_burst, token_rate = self._columns(user_id)
+        with get_cursor() as cursor:
+            for _ in range(2):
+                cursor.execute(TAKE_SQL.format(**_PSYCOPG), (keys, request_burst, request_rate, token_burst,
+                                                             token_rate, len(keys), requests, requests,
+                                                             self.reserve_tokens * requests))
+                outcome = self._decide(user_id, cursor.fetchall(), requests)
+                if outcome is not None:
+                    break
+                # First request from this user (or ever): create the full buckets and retry
+                cursor.execute(CREATE_SQL.format(**_PSYCOPG), (keys, request_burst, token_burst))
+        if isinstance(outcome, SpendLimited):
+            raise outcome
+        return outcome
+
+    async def reserve_async(self, db, user_id, requests=1):
+        """asyncpg twin of reserve(); db is a pool or connection"""
+        if not self.enabled:
+            return Reservation(self, [], 0)
+        keys, request_burst, request_rate, token_burst, token_rate = self._columns(user_id)
+        for _ in range(2):
+            rows = await db.fetch(TAKE_SQL.format(**_ASYNCPG), keys, request_burst, request_rate, token_burst,
+                                  token_rate, len(keys), requests, self.reserve_tokens * requests)
+            outcome = self._decide(user_id, rows, requests)
+            if outcome is not None:
+                break
+            await db.execute(CREATE_SQL.format(**_ASYNCPG_CREATE), keys, request_burst, token_burst)
+        if isinstance(outcome, SpendLimited):
+            raise outcome
+        return outcome
+
+    def _settlement(self, reservation):
+        """Tokens to take beyond the reservation (negative: refund), or None if nothing to do"""
+        if reservation.settled or not reservation.keys:
+            return None
+        reservation.settled = True
+        charged = reservation.charge()
+        self._count('tokens_charged', charged)
+        return (charged - reservation.reserved) or None
+
+    def settle(self, reservation):
+        extra = self._settlement(reservation)
+        if extra is None:
+            return
+        try:
+            with get_cursor() as cursor:
+                cursor.execute(SETTLE_SQL.format(**_PSYCOPG), (reservation.keys, extra))
+        except Exception:
+            # The response is already decided; a lost settlement only skews the buckets
+            log.exception("Spend settlement failed", extra={'keys': reservation.keys, 'tokens': extra})
+
+    async def settle_async(self, db, reservation):
+        extra = self._settlement(reservation)
+        if extra is None:
+            return
+        try:
+            await db.execute(SETTLE_SQL.format(**_ASYNCPG_SETTLE), reservation.keys, extra)
+        except Exception:
+            log.exception("Spend settlement failed", extra={'keys': reservation.keys, 'tokens': extra})
+
+    def levels(self, user_id):
+        """Current (refilled) levels of the user's and the global bucket, without taking anything"""
+        with get_cursor() as cursor:
+            cursor.execute(LEVELS_SQL, self._columns(user_id))
+            rows = {row['key']: row for row in cursor.fetchall()}
+        return {scope: limits.describe(rows[key]['requests'], rows[key]['tokens'])
+                for key, limits, scope in self._buckets(user_id)}
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['global'] = self._global_levels
+        stats['enabled'] = self.enabled
+        return stats
+
+
+def approx_tokens(*texts):
+    """Rough token count of some text (4 characters a token), for completions that reported no usage"""
+    return sum(len(text) for text in texts) // 4 + 1
+
+
+spend_limiter = SpendLimiter.from_env()
@@ -61,7 +61,8 @@ class RecipeRecommender {
         this.recipesContainer.innerHTML = '';
         
         try {
-            const response = await fetch('/get_recommendations', {
+            // Submit a job, then long-poll for its result
+            const response = await fetch('/recommendation_jobs', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -71,17 +72,16 @@ class RecipeRecommender {
             
             const data = await response.json();
             
-            if (response.ok) {
-                this.displayRecipes(data.recipes, 'AI Recommended Recipes');
-            } else if (response.status === 402) {
-                // Subscription required
-                this.showMessage(data.error + ' Please upgrade your subscription.', 'error');
-                // Redirect to subscription page after 2 seconds
-                setTimeout(() => {
-                    window.location.href = '/subscription';
-                }, 2000);
+            if (!response.ok) {
+                this.handleRecipeError(response.status, data);
+                return;
+            }
+            
+            const job = await this.waitForJob(data.poll);
+            if (job.status === 'done') {
+                this.displayRecipes(job.recipes, 'AI Recommended Recipes');
             } else {
-                this.showMessage(data.error || 'Failed to get recipes', 'error');
+                this.handleRecipeError(job.error_status, job);
             }
         } catch (error) {
             console.error('Error:', error);
@@ -91,16 +91,83 @@ class RecipeRecommender {
         }
     }
     
-    async showMyRecipes() {
-        this.showLoading(true);
-        this.recipesContainer.innerHTML = '';
+    async waitForJob(url) {
+        // Each poll waits up to 20s on the server for the job to finish
+        let failures = 0;
+        while (true) {
+            try {
+                const response = await fetch(`${url}?wait=20`);
+                const job = await response.json();
+                if (!response.ok) {
+                    return { status: 'failed', error: job.error, error_status: response.status };
+                }
+                if (job.status === 'done' || job.status === 'failed') {
+                    return job;
+                }
+                failures = 0;
+            } catch (error) {
+                // Ride out a brief network blip; the job keeps running on the server
+                if (++failures >= 3) throw error;
+                await new Promise(resolve => setTimeout(resolve, 1000));
+            }
+        }
+    }
+    
+    handleRecipeError(status, data) {
+        if (status === 402) {
+            // Subscription required
+            this.showMessage(data.error + ' Please upgrade your subscription.', 'error');
+            // Redirect to subscription page after 2 seconds
+            setTimeout(() => {
+                window.location.href = '/subscription';
+            }, 2000);
+        } else {
+            this.showMessage(data.error || 'Failed to get recipes', 'error');
+        }
+    }
+    
+    appendRecipe(recipe, showMeta = false) {
+        this.recipesContainer.insertAdjacentHTML('beforeend', this.createRecipeCard(recipe, showMeta));
+        
+        // Same entrance animation as displayRecipes
+        const card = this.recipesContainer.lastElementChild;
+        card.style.opacity = '0';
+        card.style.transform = 'translateY(20px)';
+        setTimeout(() => {
+            card.style.transition = 'all 0.5s ease';
+            card.style.opacity = '1';
+            card.style.transform = 'translateY(0)';
+        }, 50);
+    }
+    
+    async showMyRecipes(cursor = null) {
+        const loadMoreBtn = this.recipesContainer.querySelector('.load-more-btn');
+        if (loadMoreBtn) loadMoreBtn.remove();
+        
+        if (!cursor) {
+            this.showLoading(true);
+            this.recipesContainer.innerHTML = '';
+        }
         
         try {
-            const response = await fetch('/get_user_recipes');
+            const url = cursor ? `/get_user_recipes?cursor=${encodeURIComponent(cursor)}` : '/get_user_recipes';
+            const response = await fetch(url);
             const data = await response.json();
             
             if (response.ok) {
-                this.displayRecipes(data.recipes, 'My Saved Recipes', true);
+                if (cursor) {
+                    data.recipes.forEach(recipe => this.appendRecipe(recipe, true));
+                } else {
+                    this.displayRecipes(data.recipes, 'My Saved Recipes', true);
+                }
+                
+                // Older recipes are fetched a page at a time
+                if (data.next_cursor) {
+                    this.recipesContainer.insertAdjacentHTML('beforeend',
+                        '<button class="secondary-btn load-more-btn">Load more</button>');
+                    this.recipesContainer.querySelector('.load-more-btn')
+                        .addEventListener('click', () => this.showMyRecipes(data.next_cursor));
+                }
             } else {
                 this.showMessage(data.error || 'Failed to load your recipes', 'error');
             }
@@ -0,0 +1,223 @@
+"""Durable inbox for payment webhooks
+
+The webhook route only verifies, records the raw event in webhook_events and
+acknowledges. Workers started with
+
+    python webhook_queue.py [--threads N] [--batch-size N]
+
+drain the table: each batch is claimed with FOR UPDATE SKIP LOCKED, so any
+number of worker threads and processes can run side by side without taking
+the same event. A handler that raises is retried with jittered exponential
+backoff; after max_attempts, or on PermanentWebhookError, the event is
+dead-lettered (status 'dead') with its last error kept for inspection.
+"""
+import argparse
+import hashlib
+import os
+import random
+import signal
+import threading
+import time
+
+from prometheus_client import start_http_server
+from psycopg2.extras import Json
+
+from db import get_cursor, get_db
+from logs import get_logger
+from metrics import observe_webhook, registry
+
+log = get_logger('webhooks')
+
+
+class PermanentWebhookError(Exception):
+    """The event can never succeed; dead-letter it without retrying"""
+
+
+def webhook_event_id(data, raw_body):
+    """Provider event key: one invoice emits one event per state change"""
+    invoice_id = data.get('invoice_id') or data.get('id') or data.get('api_ref')
+    state = data.get('state') or data.get('status')
+    if invoice_id and state:
+        return f"{invoice_id}:{state}"
+    return hashlib.sha256(raw_body).hexdigest()
+
+
+def enqueue(provider, event_id, payload):
+    """Record an event; returns False if it was already received"""
+    with get_cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO webhook_events (provider, event_id, payload)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (provider, event_id) DO NOTHING
+            RETURNING id
+        """, (provider, event_id, Json(payload)))
+        return cursor.fetchone() is not None
+
+
+class WebhookWorker:
+    """Claims due events in batches and runs the provider's handler on each
+
+    A handler returns True when it acted on the event and False when the
+    event needs no action (it is then marked 'ignored').
+    """
+
+    def __init__(self, handlers, batch_size=20, max_attempts=8,
+                 base_backoff=5.0, max_backoff=900.0, idle_sleep=1.0):
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.idle_sleep = idle_sleep
+        self._lock = threading.Lock()
+        self._stats = {
+            'batches': 0,
+            'processed': 0,
+            'ignored': 0,
+            'retried': 0,
+            'dead': 0,
+        }
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def backoff(self, attempts):
+        """Seconds before the next attempt, with full jitter"""
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** (attempts - 1)))
+
+    def _handle(self, event):
+        """(status, error, delay) for one event"""
+        handler = self.handlers.get(event['provider'])
+        if handler is None:
+            return 'dead', f"No handler for provider {event['provider']}", 0
+
+        attempts = event['attempts'] + 1
+        try:
+            acted = handler(event['payload'])
+        except PermanentWebhookError as e:
+            return 'dead', str(e), 0
+        except Exception as e:
+            if attempts >= self.max_attempts:
+                return 'dead', str(e), 0
+            return 'pending', str(e), self.backoff(attempts)
+        return ('processed' if acted else 'ignored'), None, 0
+
+    def run_once(self):
+        """Process one batch; returns the number of events claimed"""
+        with get_db() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    SELECT id, provider, event_id, payload, attempts,
+                           EXTRACT(EPOCH FROM NOW() - received_at) AS lag
+                    FROM webhook_events
+                    WHERE status = 'pending' AND next_attempt_at <= NOW()
+                    ORDER BY next_attempt_at, id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                """, (self.batch_size,))
+                events = cursor.fetchall()
+                if not events:
+                    return 0
+
+                ids, statuses, errors, delays = [], [], [], []
+                claimed_at = time.monotonic()
+                for event in events:
+                    status, error, delay = self._handle(event)
+                    observe_webhook(event['provider'], 'retried' if status == 'pending' else status,
+                                    float(event['lag']) + time.monotonic() - claimed_at)
+                    if status == 'dead':
+                        log.error("Webhook event dead-lettered", extra={'event_id': event['event_id'], 'error': error})
+                    self._count('retried' if status == 'pending' else status)
+                    ids.append(event['id'])
+                    statuses.append(status)
+                    errors.append(error)
+                    delays.append(delay)
+
+                # Record every outcome of the batch in one statement
+                cursor.execute("""
+                    UPDATE webhook_events e
+                    SET status = r.status,
+                        attempts = e.attempts + 1,
+                        last_error = r.error,
+                        next_attempt_at = NOW() + r.delay * INTERVAL '1 second',
+                        processed_at = CASE WHEN r.status = 'pending' THEN NULL ELSE NOW() END
+                    FROM unnest(%s::bigint[], %s::text[], %s::text[], %s::float8[])
+                         AS r(id, status, error, delay)
+                    WHERE e.id = r.id
+                """, (ids, statuses, errors, delays))
+            finally:
+                cursor.close()
+
+        self._count('batches')
+        return len(events)
+
+    def run(self, stop=None):
+        """Drain the queue until `stop` is set, sleeping while it is empty"""
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                claimed = self.run_once()
+            except Exception:
+                log.exception("Webhook worker batch failed")
+                claimed = 0
+            if claimed < self.batch_size:
+                stop.wait(self.idle_sleep)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+def backlog():
+    """Pending and dead-lettered event counts"""
+    with get_cursor() as cursor:
+        cursor.execute("""
+            SELECT COUNT(*) FILTER (WHERE status = 'pending') AS pending,
+                   COUNT(*) FILTER (WHERE status = 'dead') AS dead
+            FROM webhook_events
+        """)
+        return cursor.fetchone()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process queued payment webhooks')
+    parser.add_argument('--threads', type=int, default=int(os.getenv('WEBHOOK_WORKER_THREADS', 2)))
+    parser.add_argument('--batch-size', type=int, default=int(os.getenv('WEBHOOK_BATCH_SIZE', 20)))
+    parser.add_argument('--max-attempts', type=int, default=int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 8)))
+    parser.add_argument('--once', action='store_true', help='process due events once and exit')
+    parser.add_argument('--metrics-port', type=int, default=int(os.getenv('WEBHOOK_METRICS_PORT', 0)),
+                        help='serve Prometheus metrics on this port')
+    args = parser.parse_args()
+
+    if args.metrics_port:
+        start_http_server(args.metrics_port, registry=registry())
+
+    from app import handle_intasend_event
+
+    worker = WebhookWorker({'intasend': handle_intasend_event},
+                           batch_size=args.batch_size, max_attempts=args.max_attempts)
+    if args.once:
+        while worker.run_once():
+            pass
+        log.info("Webhook queue drained", extra=worker.stats())
+        return
+
+    stop = threading.Event()
+    threads = [threading.Thread(target=worker.run, args=(stop,), daemon=True) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    log.info("Webhook worker started", extra={'threads': args.threads})
+
+    # Finish the current batch on shutdown; unfinished ones roll back and are retried
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    while not stop.wait(60):
+        log.info("Webhook worker stats", extra=worker.stats())
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == '__main__':
+    main()